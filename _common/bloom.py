@@ -0,0 +1,73 @@
+import math
+import struct
+
+
+class BloomFilter():
+    """
+    Compact probabilistic set of sha1s - no false negatives, `error_rate` false positives
+    sha1s are already uniformly distributed so the k bit positions are derived from the digest (double hashing) rather than rehashing
+
+    >>> import hashlib
+    >>> sha1s = [hashlib.sha1(str(i).encode()).hexdigest() for i in range(2000)]
+    >>> bloom = BloomFilter.for_capacity(1000, error_rate=0.01)
+    >>> bloom.update(sha1s[::2])
+    >>> all(sha1 in bloom for sha1 in sha1s[::2])
+    True
+    >>> sum(sha1 in bloom for sha1 in sha1s[1::2]) < 50
+    True
+
+    Serialised for transfer to verify
+    >>> data = bloom.to_bytes()
+    >>> len(data) < 1300
+    True
+    >>> bloom2 = BloomFilter.from_bytes(data)
+    >>> all(sha1 in bloom2 for sha1 in sha1s[::2])
+    True
+    >>> BloomFilter.from_bytes(b'nonsense')
+    Traceback (most recent call last):
+    ...
+    ValueError: Not a bloom filter
+    """
+    MAGIC = b'BLM1'
+    HEADER = struct.Struct('>4sQI')
+
+    def __init__(self, size_bits, hashes, bits=None):
+        self.size_bits = size_bits
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        size_bits = max(8, math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hashes = max(1, round(size_bits / capacity * math.log(2)))
+        return cls(size_bits, hashes)
+
+    def _indexes(self, sha1):
+        h1 = int(sha1[0:16], 16)
+        h2 = int(sha1[16:32], 16) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size_bits
+
+    def add(self, sha1):
+        for index in self._indexes(sha1):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def update(self, sha1s):
+        for sha1 in sha1s:
+            self.add(sha1)
+
+    def __contains__(self, sha1):
+        return all(self.bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(sha1))
+
+    def to_bytes(self):
+        return self.HEADER.pack(self.MAGIC, self.size_bits, self.hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) < cls.HEADER.size:
+            raise ValueError('Not a bloom filter')
+        magic, size_bits, hashes = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or len(data) - cls.HEADER.size != (size_bits + 7) // 8:
+            raise ValueError('Not a bloom filter')
+        return cls(size_bits, hashes, bytearray(data[cls.HEADER.size:]))
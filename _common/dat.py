@@ -0,0 +1,110 @@
+import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DAT_FORMATS = ('logiqx', 'clrmamepro')
+
+
+def _rom_attrs(rom):
+    return (
+        ('name', rom.file_name),
+        *((('size', str(rom.size)), ) if rom.size is not None else ()),
+        *((('crc', rom.crc), ) if rom.crc else ()),
+        *((('md5', rom.md5), ) if rom.md5 else ()),
+        ('sha1', rom.sha1),
+    )
+
+
+def iter_logiqx_dat(archives, name='catalog', description=None, version=None):
+    """
+    Logiqx xml datafile (read by ClrMamePro, RomVault, RomCenter ...) as a stream of strings
+    `archives` is an iterable of (archive_name, roms) - only one archive is held at a time
+
+    >>> from _common.roms import Rom
+    >>> print(''.join(iter_logiqx_dat(
+    ...     (('sfa3', (Rom('0'*40, 'sfa3', 'sz3.01', size=4, crc='0a0b0c0d'), )), ('b&b', (Rom('1'*40, 'b&b', 'a"b.bin'), ))),
+    ...     version='1',
+    ... )).replace('\\t', '  '))
+    <?xml version="1.0"?>
+    <!DOCTYPE datafile PUBLIC "-//Logiqx//DTD ROM Management Datafile//EN" "http://www.logiqx.com/Dats/datafile.dtd">
+    <datafile>
+      <header>
+        <name>catalog</name>
+        <description>catalog</description>
+        <version>1</version>
+      </header>
+      <game name="sfa3">
+        <description>sfa3</description>
+        <rom name="sz3.01" size="4" crc="0a0b0c0d" sha1="0000000000000000000000000000000000000000"/>
+      </game>
+      <game name="b&amp;b">
+        <description>b&amp;b</description>
+        <rom name='a"b.bin' sha1="1111111111111111111111111111111111111111"/>
+      </game>
+    </datafile>
+    <BLANKLINE>
+    """
+    version = version or datetime.date.today().isoformat()
+    yield '<?xml version="1.0"?>\n'
+    yield '<!DOCTYPE datafile PUBLIC "-//Logiqx//DTD ROM Management Datafile//EN" "http://www.logiqx.com/Dats/datafile.dtd">\n'
+    yield '<datafile>\n'
+    yield f'\t<header>\n\t\t<name>{escape(name)}</name>\n\t\t<description>{escape(description or name)}</description>\n\t\t<version>{escape(version)}</version>\n\t</header>\n'
+    for archive_name, roms in archives:
+        yield ''.join((
+            f'\t<game name={quoteattr(archive_name)}>\n',
+            f'\t\t<description>{escape(archive_name)}</description>\n',
+            *(
+                '\t\t<rom ' + ' '.join(f'{key}={quoteattr(value)}' for key, value in _rom_attrs(rom)) + '/>\n'
+                for rom in sorted(roms, key=lambda rom: rom.file_name)
+            ),
+            '\t</game>\n',
+        ))
+    yield '</datafile>\n'
+
+
+def _clrmamepro_quote(value):
+    """
+    >>> _clrmamepro_quote('sz3.01'), _clrmamepro_quote('a b.bin')
+    ('sz3.01', '"a b.bin"')
+    """
+    return f'"{value}"' if any(c in value for c in ' ()"\t') else value
+
+
+def iter_clrmamepro_dat(archives, name='catalog', description=None, version=None):
+    """
+    Legacy ClrMamePro text datafile
+
+    >>> from _common.roms import Rom
+    >>> print(''.join(iter_clrmamepro_dat((('sfa3', (Rom('0'*40, 'sfa3', 'sz3 01.bin', size=4, crc='0a0b0c0d'), )), ), version='1')).replace('\\t', '  '))
+    clrmamepro (
+      name catalog
+      description catalog
+      version 1
+    )
+    <BLANKLINE>
+    game (
+      name sfa3
+      description sfa3
+      rom ( name "sz3 01.bin" size 4 crc 0a0b0c0d sha1 0000000000000000000000000000000000000000 )
+    )
+    <BLANKLINE>
+    <BLANKLINE>
+    """
+    version = version or datetime.date.today().isoformat()
+    yield f'clrmamepro (\n\tname {_clrmamepro_quote(name)}\n\tdescription {_clrmamepro_quote(description or name)}\n\tversion {_clrmamepro_quote(version)}\n)\n\n'
+    for archive_name, roms in archives:
+        yield ''.join((
+            f'game (\n\tname {_clrmamepro_quote(archive_name)}\n\tdescription {_clrmamepro_quote(archive_name)}\n',
+            *(
+                '\trom ( ' + ' '.join(f'{key} {_clrmamepro_quote(value)}' for key, value in _rom_attrs(rom)) + ' )\n'
+                for rom in sorted(roms, key=lambda rom: rom.file_name)
+            ),
+            ')\n\n',
+        ))
+
+
+def iter_dat(archives, format='logiqx', **kwargs):
+    return {'logiqx': iter_logiqx_dat, 'clrmamepro': iter_clrmamepro_dat}[format](archives, **kwargs)
@@ -0,0 +1,36 @@
+import zlib
+import hashlib
+
+CHUNK_SIZE = 1 << 20
+
+
+def _read(filehandle, size):
+    return filehandle.read(size)
+
+
+def hash_filehandle(filehandle, read=_read, chunk_size=CHUNK_SIZE):
+    """
+    size, crc32, md5 and sha1 from a single read of every byte
+
+    >>> import io
+    >>> hash_filehandle(io.BytesIO(b'abcdefghijklmnopqrstuvwxyz\\n'), chunk_size=4)
+    {'size': 27, 'crc': '874beef2', 'md5': 'e302f9ecd2d189fa80aac1c3392e9b9c', 'sha1': '8c723a0fa70b111017b4a6f06afe1c0dbcec14e3'}
+    """
+    size = 0
+    crc = 0
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    while chunk := read(filehandle, chunk_size):
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+        md5.update(chunk)
+        sha1.update(chunk)
+    return {'size': size, 'crc': f'{crc:08x}', 'md5': md5.hexdigest(), 'sha1': sha1.hexdigest()}
+
+
+def hash_file(filename, read=_read):
+    """
+    `read(filehandle, size)` can be replaced with a throttled read
+    """
+    with open(filename, 'rb') as filehandle:
+        return hash_filehandle(filehandle, read=read)
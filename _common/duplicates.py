@@ -0,0 +1,123 @@
+from itertools import islice
+
+import requests
+import falcon
+
+from _common.falcon_helpers import response_media, msgpack, MEDIA_SHA1
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def duplicate_report(sha1, roms, expected_archive_names=None):
+    """
+    A sha1 held in more than one archive (the same data under two file names in one archive is not a redundant file). Copies in archives romdata lists for the sha1 (shared bios, parent/clone roms in non-merged sets) are expected;
+    the rest are redundant. `wasted_bytes` needs rom sizes (recorded by the catalog worker)
+
+    >>> from _common.roms import Rom
+    >>> roms = {Rom('0'*40, 'neogeo', 'sp-s2.sp1'), Rom('0'*40, 'mslug', 'sp-s2.sp1'), Rom('0'*40, 'backup/neogeo', 'sp-s2.sp1')}
+    >>> report = duplicate_report('0'*40, roms, expected_archive_names={'neogeo', 'mslug'})
+    >>> report['copies'], report['redundant_copies'], report['expected']
+    (3, 1, False)
+    >>> report['unexpected_archives']
+    ('backup/neogeo',)
+    >>> duplicate_report('0'*40, roms)['redundant_copies']
+    2
+    >>> duplicate_report('0'*40, {Rom('0'*40, 'neogeo', 'a')}) is None
+    True
+    >>> duplicate_report('0'*40, {Rom('0'*40, 'sfa3', 'sz3.01'), Rom('0'*40, 'sfa3', 'sz3.01a')}) is None
+    True
+    >>> duplicate_report('0'*40, {Rom('0'*40, 'sfa3', 'sz3.01'), Rom('0'*40, 'sfa3', 'sz3.01a'), Rom('0'*40, 'sfa3u', 'sz3.01')})['copies']
+    2
+    """
+    archive_names = {rom.archive_name for rom in roms}
+    if len(archive_names) < 2:
+        return None
+    expected_archive_names = expected_archive_names or set()
+    expected_copies = len(archive_names & expected_archive_names)
+    redundant_copies = len(archive_names) - max(1, expected_copies)
+    size = next((rom.size for rom in roms if rom.size), None)
+    return {
+        'sha1': sha1,
+        'copies': len(archive_names),
+        'redundant_copies': redundant_copies,
+        'expected': redundant_copies == 0,
+        'wasted_bytes': size * redundant_copies if size is not None else None,
+        'unexpected_archives': tuple(sorted(archive_names - expected_archive_names)),
+        'roms': tuple({'archive_name': rom.archive_name, 'file_name': rom.file_name} for rom in sorted(roms, key=lambda rom: (rom.archive_name, rom.file_name))),
+    }
+
+
+def iter_duplicates(sha1_index, get_expected=None, batch_size=1000, unexpected_only=False):
+    """
+    Single pass over a sha1 -> roms index. Expectations are looked up in batches of `batch_size` duplicate sha1s
+    `get_expected(sha1s)` returns {sha1: archive_names} from romdata
+
+    >>> from _common.roms import Rom
+    >>> index = {
+    ...     '0'*40: {Rom('0'*40, 'neogeo', 'sp-s2.sp1'), Rom('0'*40, 'mslug', 'sp-s2.sp1')},
+    ...     '1'*40: {Rom('1'*40, 'sfa3', 'a.bin'), Rom('1'*40, 'sfa3_copy', 'a.bin')},
+    ...     '2'*40: {Rom('2'*40, 'sfa3', 'b.bin')},
+    ...     '3'*40: {Rom('3'*40, 'sfa3', 'c.bin'), Rom('3'*40, 'sfa3', 'c_alt.bin')},
+    ... }
+    >>> expected = lambda sha1s: {'0'*40: {'neogeo', 'mslug'}}
+    >>> [(r['sha1'][0], r['expected']) for r in iter_duplicates(index, expected)]
+    [('0', True), ('1', False)]
+    >>> [r['sha1'][0] for r in iter_duplicates(index, expected, unexpected_only=True)]
+    ['1']
+    """
+    duplicates = ((sha1, roms) for sha1, roms in tuple(sha1_index.items()) if len(roms) > 1 and len({rom.archive_name for rom in roms}) > 1)
+    while True:
+        batch = tuple(islice(duplicates, batch_size))
+        if not batch:
+            return
+        expected = get_expected(tuple(sha1 for sha1, _ in batch)) if get_expected else {}
+        for sha1, roms in batch:
+            report = duplicate_report(sha1, tuple(roms), expected.get(sha1))
+            if report and not (unexpected_only and report['expected']):
+                yield report
+
+
+def summarise(reports):
+    """
+    >>> summarise(({'expected': True, 'redundant_copies': 0, 'wasted_bytes': 0}, {'expected': False, 'redundant_copies': 2, 'wasted_bytes': None}))
+    {'duplicated_sha1': 2, 'unexpected_sha1': 1, 'redundant_copies': 2, 'wasted_bytes': 0}
+    """
+    summary = {'duplicated_sha1': 0, 'unexpected_sha1': 0, 'redundant_copies': 0, 'wasted_bytes': 0}
+    for report in reports:
+        summary['duplicated_sha1'] += 1
+        summary['unexpected_sha1'] += not report['expected']
+        summary['redundant_copies'] += report['redundant_copies']
+        summary['wasted_bytes'] += report['wasted_bytes'] or 0
+    return summary
+
+
+# Expectations -----------------------------------------------------------------
+
+def expected_from_rom_data(rom_data):
+    """
+    `get_expected` from a loaded `RomData`
+    """
+    def get_expected(sha1s):
+        return {sha1: {rom.archive_name for rom in rom_data.sha1.get(sha1, ())} for sha1 in sha1s}
+    return get_expected
+
+
+def expected_from_romdata_api(url_api_romdata, layout=None):
+    """
+    `get_expected` from the romdata `/sets` api
+    """
+    def get_expected(sha1s):
+        response = requests.get(
+            f'{url_api_romdata}/sets',
+            data=b''.join(map(bytes.fromhex, sha1s)),
+            params={'fields': 'matched', **({'layout': layout} if layout else {})},
+            headers={'Content-Type': MEDIA_SHA1, 'Accept': falcon.MEDIA_MSGPACK if msgpack else falcon.MEDIA_JSON},
+        )
+        response.raise_for_status()
+        expected = {}
+        for archive_name, romset in response_media(response)['romsets'].items():
+            for sha1 in romset['matched']:
+                expected.setdefault(sha1, set()).add(archive_name)
+        return expected
+    return get_expected
@@ -3,10 +3,20 @@ import re
 from pathlib import Path
 from functools import partial
 import json
+from itertools import islice
 from types import MappingProxyType
 
+import falcon
 from falcon import media
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+MEDIA_SHA1 = 'application/x-sha1'  # Concatenated raw 20 byte sha1s
+
 
 def func_path_normalizer(path):
     return str(path)
@@ -22,18 +32,123 @@ def func_path_normalizer_no_extension(path):
     return os.path.join(str(path.parent), path.stem).strip('./')
 
 
+def _media_default(obj):
+    if isinstance(obj, (dict, MappingProxyType)):
+        return dict(obj)
+    if isinstance(obj, set):
+        return tuple(obj)
+    return obj
+
 def update_json_handlers(app):
-    def _json_dumps(obj):
-        if isinstance(obj, (dict, MappingProxyType)):
-            return dict(obj)
-        if isinstance(obj, set):
-            return tuple(obj)
-        return obj
     media_handlers = {
         'application/json': media.JSONHandler(
-            dumps=partial(json.dumps, default=_json_dumps),
+            dumps=partial(json.dumps, default=_media_default),
             loads=json.loads,
         ),
     }
     app.req_options.media_handlers.update(media_handlers)
     app.resp_options.media_handlers.update(media_handlers)
+
+
+# Compact encodings ------------------------------------------------------------
+
+class MessagePackHandler(media.BaseHandler):
+    def deserialize(self, stream, content_type, content_length):
+        return msgpack.unpackb(stream.read(), raw=False)
+    def serialize(self, media, content_type):
+        return msgpack.packb(media, default=_media_default, use_bin_type=True)
+
+class SHA1Handler(media.BaseHandler):
+    """
+    >>> handler = SHA1Handler()
+    >>> data = handler.serialize(('91424d481ff99a8d3f4c45cea6d3f0eada049a6d', '2f32caf3906fc1408fd8126a500e74c682ff20fa'), MEDIA_SHA1)
+    >>> len(data)
+    40
+    >>> import io
+    >>> handler.deserialize(io.BytesIO(data), MEDIA_SHA1, len(data))
+    ('91424d481ff99a8d3f4c45cea6d3f0eada049a6d', '2f32caf3906fc1408fd8126a500e74c682ff20fa')
+    """
+    def deserialize(self, stream, content_type, content_length):
+        data = stream.read()
+        return tuple(data[i:i+20].hex() for i in range(0, len(data), 20))
+    def serialize(self, media, content_type):
+        return b''.join(map(bytes.fromhex, media))
+
+
+RESPONSE_MEDIA_TYPES = (falcon.MEDIA_JSON, falcon.MEDIA_MSGPACK) if msgpack else (falcon.MEDIA_JSON, )
+
+
+def negotiated_media_type(request, media_types=RESPONSE_MEDIA_TYPES):
+    """
+    The response media type `Accept` selects (json by default) - part of any cache key for a negotiated response
+    """
+    return request.client_prefers(media_types) or falcon.MEDIA_JSON
+
+
+class ContentNegotiationMiddleware():
+    """
+    Select the response media handler from the `Accept` header (json remains the default)
+    """
+    def __init__(self, media_types):
+        self.media_types = media_types
+    def process_request(self, request, response):
+        response.content_type = negotiated_media_type(request, self.media_types)
+
+
+def update_media_handlers(app):
+    """
+    json (with set/MappingProxy support), raw sha1 request bodies and msgpack (when installed) with `Accept` negotiation
+    """
+    update_json_handlers(app)
+    media_handlers = {MEDIA_SHA1: SHA1Handler()}
+    if msgpack:
+        media_handlers[falcon.MEDIA_MSGPACK] = MessagePackHandler()
+    app.req_options.media_handlers.update(media_handlers)
+    app.resp_options.media_handlers.update(media_handlers)
+    app.add_middleware(ContentNegotiationMiddleware(RESPONSE_MEDIA_TYPES))
+
+
+def stream_json_array(items, chunk_size=1000):
+    """
+    Encode a (possibly huge) iterable as a json array in chunks rather than one string
+
+    >>> b''.join(stream_json_array(iter(('a', 'b', 'c')), chunk_size=2))
+    b'["a", "b", "c"]'
+    >>> b''.join(stream_json_array(()))
+    b'[]'
+    """
+    yield b'['
+    items = iter(items)
+    separator = b''
+    while True:
+        chunk = tuple(islice(items, chunk_size))
+        if not chunk:
+            break
+        yield separator + ', '.join(map(json.dumps, chunk)).encode('utf8')
+        separator = b', '
+    yield b']'
+
+
+def respond_index(request, response, keys, total):
+    """
+    Paginated (`?offset=&limit=`) index of keys. json is streamed, other encodings are returned as media
+    """
+    offset = request.get_param_as_int('offset', default=0, min_value=0)
+    limit = request.get_param_as_int('limit', min_value=0)
+    keys = islice(keys, offset, offset + limit if limit is not None else None)
+    response.set_header('X-Total-Count', str(total))
+    if response.content_type == falcon.MEDIA_MSGPACK:
+        response.media = tuple(keys)
+    else:
+        response.content_type = falcon.MEDIA_JSON
+        response.stream = stream_json_array(keys)
+    response.status = falcon.HTTP_200
+
+
+def response_media(response):
+    """
+    Decode a `requests` response in any of the encodings above
+    """
+    if msgpack and response.headers.get('Content-Type', '').startswith(falcon.MEDIA_MSGPACK):
+        return msgpack.unpackb(response.content, raw=False)
+    return response.json()
@@ -0,0 +1,185 @@
+import os
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+import falcon
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(labels, **extra):
+    """
+    >>> _labels({'route': '/sets', 'method': 'GET'})
+    '{method="GET",route="/sets"}'
+    >>> _labels({}, le='0.5')
+    '{le="0.5"}'
+    >>> _labels({})
+    ''
+    """
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in sorted(labels.items())) + '}'
+
+
+def rss_bytes():
+    """
+    Current resident set size. Falls back to peak rss where /proc is not available (macOS)
+    """
+    try:
+        with open('/proc/self/statm', 'rt') as filehandle:
+            return int(filehandle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics():
+    r"""
+    Minimal thread safe registry of counters, gauges and histograms rendered in Prometheus text format
+
+    >>> metrics = Metrics()
+    >>> metrics.inc('requests_total', route='/sets')
+    >>> metrics.inc('requests_total', 2, route='/sets')
+    >>> metrics.set('queue_depth', 5)
+    >>> metrics.gauge('archives', lambda: 42)
+    >>> metrics.observe('duration_seconds', 0.02, buckets=(0.01, 0.1), route='/sets')
+    >>> metrics.observe('duration_seconds', 0.5, buckets=(0.01, 0.1), route='/sets')
+    >>> print(metrics.render())
+    # TYPE requests_total counter
+    requests_total{route="/sets"} 3
+    # TYPE queue_depth gauge
+    queue_depth 5
+    # TYPE archives gauge
+    archives 42
+    # TYPE duration_seconds histogram
+    duration_seconds_bucket{le="0.01",route="/sets"} 0
+    duration_seconds_bucket{le="0.1",route="/sets"} 1
+    duration_seconds_bucket{le="+Inf",route="/sets"} 2
+    duration_seconds_sum{route="/sets"} 0.52
+    duration_seconds_count{route="/sets"} 2
+    <BLANKLINE>
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_funcs = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            _counter = self.counters.setdefault(name, {})
+            _counter[key] = _counter.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def gauge(self, name, func, **labels):
+        """
+        Register a callable evaluated at render time (e.g. index sizes)
+        """
+        with self.lock:
+            self.gauge_funcs.setdefault(name, {})[tuple(sorted(labels.items()))] = func
+
+    def remove_gauges(self, name):
+        """
+        Drop every label set for `name` - for gauges whose labels come and go (loaded versions)
+        """
+        with self.lock:
+            self.gauges.pop(name, None)
+            self.gauge_funcs.pop(name, None)
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            _buckets, _histogram = self.histograms.setdefault(name, (buckets, {}))
+            counts, _sum, count = _histogram.get(key) or ([0] * len(_buckets), 0, 0)
+            for i, le in enumerate(_buckets):
+                if value <= le:
+                    counts[i] += 1
+            _histogram[key] = (counts, _sum + value, count + 1)
+
+    @contextmanager
+    def timer(self, name, buckets=DEFAULT_BUCKETS, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, buckets=buckets, **labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, values in self.counters.items():
+                lines.append(f'# TYPE {name} counter')
+                lines += (f'{name}{_labels(dict(key))} {value}' for key, value in values.items())
+            gauges = {name: dict(values) for name, values in self.gauges.items()}
+            for name, funcs in self.gauge_funcs.items():
+                gauges.setdefault(name, {}).update({key: func() for key, func in funcs.items()})
+            for name, values in gauges.items():
+                lines.append(f'# TYPE {name} gauge')
+                lines += (f'{name}{_labels(dict(key))} {value}' for key, value in values.items())
+            for name, (buckets, values) in self.histograms.items():
+                lines.append(f'# TYPE {name} histogram')
+                for key, (counts, _sum, count) in values.items():
+                    labels = dict(key)
+                    lines += (f'{name}_bucket{_labels(labels, le=le)} {c}' for le, c in zip(buckets, counts))
+                    lines.append(f'{name}_bucket{_labels(labels, le="+Inf")} {count}')
+                    lines.append(f'{name}_sum{_labels(labels)} {round(_sum, 6)}')
+                    lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+# Falcon -----------------------------------------------------------------------
+
+class MetricsMiddleware():
+    """
+    Per route request latency histogram
+    Sinks have no `uri_template` so are labeled by their prefix e.g. `/archive/`
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+    def process_request(self, request, response):
+        request.context.metrics_start = time.perf_counter()
+    def process_response(self, request, response, resource, req_succeeded):
+        start = getattr(request.context, 'metrics_start', None)
+        if start is None:
+            return
+        route = request.uri_template or '/' + request.path.strip('/').split('/')[0] + '/'
+        self.metrics.observe(
+            'http_request_duration_seconds',
+            time.perf_counter() - start,
+            route=route,
+            method=request.method,
+            status=falcon.http_status_to_code(response.status),
+        )
+
+
+class MetricsResource():
+    def __init__(self, metrics):
+        self.metrics = metrics
+    def on_get(self, request, response):
+        response.content_type = 'text/plain; version=0.0.4'
+        response.text = self.metrics.render()
+        response.status = falcon.HTTP_200
+
+
+def add_metrics(app, metrics=None, **gauges):
+    """
+    Add `/metrics` and request timing middleware to `app`. `gauges` are name=callable evaluated on each scrape
+    """
+    metrics = metrics or Metrics()
+    metrics.gauge('process_resident_memory_bytes', rss_bytes)
+    for name, func in gauges.items():
+        metrics.gauge(name, func)
+    app.add_middleware(MetricsMiddleware(metrics))
+    app.add_route(r'/metrics', MetricsResource(metrics))
+    return metrics
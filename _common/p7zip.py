@@ -1,11 +1,55 @@
 import os
 import re
+import tempfile
 import subprocess
+from typing import NamedTuple
 
 import logging
 log = logging.getLogger(__name__)
 
 
+class Member(NamedTuple):
+    path: str
+    size: int
+    crc: str  # crc32 hex - empty when the archive format does not store it
+
+
+def parse_list(stdout):
+    r"""
+    Files from the technical listing `7z l -slt`
+
+    >>> parse_list('''
+    ... Path = sfa3.7z
+    ... Type = 7z
+    ... Physical Size = 1024
+    ...
+    ... ----------
+    ... Path = sfa3u
+    ... Folder = +
+    ... Size = 0
+    ...
+    ... Path = sfa3u/sz3u.03c
+    ... Folder = -
+    ... Size = 524288
+    ... CRC = 1F3A6C5B
+    ...
+    ... Path = sz3.01
+    ... Folder = -
+    ... Size = 1048576
+    ... CRC = 0A2B3C4D
+    ... ''')
+    (Member(path='sfa3u/sz3u.03c', size=524288, crc='1f3a6c5b'), Member(path='sz3.01', size=1048576, crc='0a2b3c4d'))
+    """
+    _, _, listing = stdout.partition('----------')
+    members = []
+    for block in listing.strip().split('\n\n'):
+        attrs = dict(line.split(' = ', 1) for line in block.splitlines() if ' = ' in line)
+        if not attrs.get('Path') or attrs.get('Folder') == '+' or 'D' in attrs.get('Attributes', '').split('_')[0]:
+            continue
+        members.append(Member(attrs['Path'], int(attrs.get('Size') or 0), attrs.get('CRC', '').lower()))
+    return tuple(members)
+
+
 class P7Zip():
     r"""
     Simplified opinionated wrapper for 7z
@@ -46,6 +90,17 @@ class P7Zip():
 
     REGEX_HASH_SHA1 = re.compile(b'[A-Fa-f0-9]{40}')
 
+    def __init__(self, throttle=None):
+        self.throttle = throttle
+
+    def _run(self, args, cwd=None):
+        """
+        7z runs under `throttle` (nice/ionice/read bandwidth) when set
+        """
+        if self.throttle:
+            return self.throttle.run(args, cwd=cwd)
+        return subprocess.run(args, cwd=cwd, capture_output=True)
+
     def hash(self, cwd, source):
         """
         TODO:
@@ -54,10 +109,9 @@ class P7Zip():
         We would need a way for 7z to output to file contents to stdout and pipe into python hash function
         """
         assert os.path.isfile(os.path.abspath(os.path.join(cwd, source)))
-        output = subprocess.run(
+        output = self._run(
             ("7z", "h", "-scrcSHA1", source),
             cwd=cwd,
-            capture_output=True,
         )
         match = self.REGEX_HASH_SHA1.search(output.stdout)
         if match:
@@ -71,20 +125,35 @@ class P7Zip():
         assert not os.path.isfile(destination_file)
         for f in files:
             assert os.path.isfile(os.path.join(cwd, f))
-        output = subprocess.run(
+        output = self._run(
             ("7z", "a", "-t7z", "-mx=9", "-ms=on", "-md=128m", "-mmt=on", destination_file, *files),
             cwd=cwd,
-            capture_output=True,
         )
         assert os.path.isfile(destination_file)
 
-    def extract(self, cwd, source_file, destination_folder='./'):
+    def list(self, source_file):
+        output = self._run(
+            ("7z", "l", "-slt", "-sccUTF-8", source_file),
+        )
+        if output.returncode:
+            raise IOError(f'Unable to list {source_file} {output.stderr.decode("utf8", "replace")}')
+        return parse_list(output.stdout.decode('utf8', 'replace'))
+
+    def extract(self, cwd, source_file, destination_folder='./', files=None):
+        """
+        `files` extracts only those members (passed as a listfile - there can be thousands)
+        """
         #assert source_file.endswith('.7z')
         assert os.path.isfile(os.path.join(cwd, source_file))
         assert os.path.isdir(os.path.join(cwd, destination_folder))
-        output = subprocess.run(
-            ("7z", "x", source_file, f"-o{destination_folder}"),
-            cwd=cwd,
-            capture_output=True,
-        )
-        assert len(tuple(os.scandir(os.path.abspath(os.path.join(cwd, destination_folder)))))
+        with tempfile.NamedTemporaryFile('wt', encoding='utf8', suffix='.txt') as listfile:
+            if files is not None:
+                listfile.write(''.join(f'{f}\n' for f in files))
+                listfile.flush()
+            output = self._run(
+                ("7z", "x", "-aoa", "-scsUTF-8", source_file, f"-o{destination_folder}", *((f'@{listfile.name}', ) if files is not None else ())),
+                cwd=cwd,
+            )
+        if output.returncode:
+            raise IOError(f'Unable to extract {source_file} {output.stderr.decode("utf8", "replace")}')
+        assert files is not None or len(tuple(os.scandir(os.path.abspath(os.path.join(cwd, destination_folder)))))
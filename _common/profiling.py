@@ -0,0 +1,277 @@
+import os
+import io
+import re
+import sys
+import time
+import random
+import signal
+import pstats
+import cProfile
+import datetime
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+import falcon
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def _safe_filename(name):
+    """
+    >>> _safe_filename('GET /sha1/{sha1}')
+    'GET_sha1_sha1'
+    """
+    return re.sub(r'[^A-Za-z0-9.-]+', '_', name).strip('_')
+
+
+def frame_stack(frame):
+    """
+    Collapsed (flamegraph.pl / speedscope) representation of a stack - root first, `;` separated
+
+    >>> def outer():
+    ...     return inner()
+    >>> def inner():
+    ...     return frame_stack(sys._getframe())
+    >>> [f.split(' ')[0] for f in outer().split(';')[-2:]]
+    ['outer', 'inner']
+    """
+    stack = []
+    while frame:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Profiler():
+    """
+    Opt-in profiling
+     - cProfile per request/archive (sampled with `sample_rate`). One cProfile can be active per process (python 3.12+ raises otherwise) - concurrent requests are only stack sampled. Aggregated in memory; individual profiles slower than `slow_seconds` are dumped to `path` as `.prof` (snakeviz/flameprof/gprof2dot)
+     - A stack sampler for profiled threads producing collapsed stacks for flamegraphs
+     - tracemalloc snapshots on demand
+
+    >>> import tempfile
+    >>> tempdir = tempfile.TemporaryDirectory()
+    >>> profiler = Profiler(tempdir.name, slow_seconds=0)
+    >>> with profiler.profile('test'):
+    ...     _ = sorted(range(1000))
+    >>> 'sorted' in profiler.stats_text()
+    True
+    >>> [f.endswith('.prof') for f in os.listdir(tempdir.name)]
+    [True]
+
+    Concurrent requests (ThreadingMixIn) skip cProfile while another is active
+    >>> def concurrent(tokens):
+    ...     token = profiler.start('concurrent')
+    ...     tokens.append(token)
+    ...     profiler.stop(token)
+    >>> tokens = []
+    >>> with profiler.profile('test'):
+    ...     thread = threading.Thread(target=concurrent, args=(tokens, ))
+    ...     thread.start()
+    ...     thread.join()
+    >>> tokens[0][1] is None
+    True
+    >>> token = profiler.start('after')
+    >>> token[1] is not None
+    True
+    >>> profiler.stop(token)
+    >>> profiler.tracemalloc_text()
+    'tracemalloc started - request again for a snapshot'
+    >>> 'Top' in profiler.tracemalloc_text()
+    True
+    >>> tracemalloc.stop()
+    >>> profiler.stop_sampler()
+    >>> tempdir.cleanup()
+    """
+    def __init__(self, path, sample_rate=1.0, slow_seconds=1.0, interval=0.005):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.active = threading.Lock()  # held while a cProfile is enabled
+        self.stats = None
+        self.stacks = Counter()
+        self._tracked = {}
+        self._sampler = None
+        self._sampler_stop = threading.Event()
+
+    def _filename(self, name, ext):
+        return os.path.join(self.path, f'{datetime.datetime.now().strftime("%Y%m%d-%H%M%S.%f")}_{_safe_filename(name)}.{ext}')
+
+    # Stack sampler
+
+    def _sample(self):
+        while not self._sampler_stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id, name in tuple(self._tracked.items()):
+                frame = frames.get(thread_id)
+                if frame:
+                    self.stacks[f'{name};{frame_stack(frame)}'] += 1
+
+    def start_sampler(self):
+        if not self._sampler:
+            self._sampler_stop.clear()
+            self._sampler = threading.Thread(target=self._sample, daemon=True, name='profiler_sampler')
+            self._sampler.start()
+
+    def stop_sampler(self):
+        if self._sampler:
+            self._sampler_stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    # cProfile
+
+    def start(self, name):
+        if random.random() >= self.sample_rate:
+            return None
+        self.start_sampler()
+        self._tracked[threading.get_ident()] = _safe_filename(name)
+        profile = None
+        if self.active.acquire(blocking=False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:  # another profiler (outside this class) is active
+                self.active.release()
+                profile = None
+        return (name, profile, time.perf_counter())
+
+    def stop(self, token):
+        if not token:
+            return
+        name, profile, start = token
+        self._tracked.pop(threading.get_ident(), None)
+        if not profile:
+            return
+        profile.disable()
+        self.active.release()
+        with self.lock:
+            if self.stats:
+                self.stats.add(profile)
+            else:
+                self.stats = pstats.Stats(profile)
+        if time.perf_counter() - start >= self.slow_seconds:
+            profile.dump_stats(self._filename(name, 'prof'))
+
+    @contextmanager
+    def profile(self, name):
+        token = self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(token)
+
+    # Output
+
+    def stats_text(self, sort='cumulative', limit=50):
+        if not self.stats:
+            return 'no profiles captured'
+        output = io.StringIO()
+        with self.lock:
+            self.stats.stream = output
+            self.stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def collapsed_text(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in tuple(self.stacks.items()))
+
+    def tracemalloc_text(self, limit=50):
+        """
+        First call starts tracing. Following calls snapshot (dumped to `path` for `tracemalloc.Snapshot.load`)
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            return 'tracemalloc started - request again for a snapshot'
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(self._filename('tracemalloc', 'snapshot'))
+        return f'Top {limit}\n' + '\n'.join(map(str, snapshot.statistics('lineno')[:limit]))
+
+    def reset(self):
+        with self.lock:
+            self.stats = None
+            self.stacks.clear()
+
+    def dump(self, *args):
+        """
+        Write collapsed stacks, aggregate stats and a tracemalloc snapshot to `path` - bound to SIGUSR1
+        """
+        with open(self._filename('collapsed', 'txt'), 'wt') as filehandle:
+            filehandle.write(self.collapsed_text())
+        with self.lock:
+            if self.stats:
+                self.stats.dump_stats(self._filename('aggregate', 'prof'))
+        log.info(self.tracemalloc_text(limit=10))
+        log.info(f'profile dumped to {self.path}')
+
+
+# Falcon -----------------------------------------------------------------------
+
+class ProfilingMiddleware():
+    def __init__(self, profiler):
+        self.profiler = profiler
+    def process_request(self, request, response):
+        if not request.path.startswith('/profile'):
+            request.context.profile_token = self.profiler.start(f'{request.method} {request.path}')
+    def process_response(self, request, response, resource, req_succeeded):
+        self.profiler.stop(getattr(request.context, 'profile_token', None))
+
+
+class ProfileResource():
+    """
+    GET /profile                aggregate cProfile stats (?sort=tottime&limit=100)
+    GET /profile/collapsed      collapsed stacks for flamegraph.pl/speedscope
+    GET /profile/tracemalloc    start tracemalloc / take a snapshot
+    DELETE /profile             reset
+    """
+    def __init__(self, profiler):
+        self.profiler = profiler
+    def on_get(self, request, response):
+        response.content_type = falcon.MEDIA_TEXT
+        response.text = self.profiler.stats_text(
+            sort=request.get_param('sort', default='cumulative'),
+            limit=request.get_param_as_int('limit', default=50),
+        )
+    def on_delete(self, request, response):
+        self.profiler.reset()
+        response.status = falcon.HTTP_204
+    def on_get_collapsed(self, request, response):
+        response.content_type = falcon.MEDIA_TEXT
+        response.text = self.profiler.collapsed_text()
+    def on_get_tracemalloc(self, request, response):
+        response.content_type = falcon.MEDIA_TEXT
+        response.text = self.profiler.tracemalloc_text(limit=request.get_param_as_int('limit', default=50))
+
+
+def init_profile_signal_handler(profiler):
+    signal.signal(signal.SIGUSR1, profiler.dump)
+
+
+def add_profiling(app, profile=False, profile_path='./profile', profile_sample_rate=1.0, profile_slow_seconds=1.0, **kwargs):
+    """
+    No-op unless `profile` - takes the `--profile*` commandline kwargs of each service
+    """
+    if not profile:
+        return None
+    profiler = Profiler(profile_path, sample_rate=profile_sample_rate, slow_seconds=profile_slow_seconds)
+    app.add_middleware(ProfilingMiddleware(profiler))
+    resource = ProfileResource(profiler)
+    app.add_route(r'/profile', resource)
+    app.add_route(r'/profile/collapsed', resource, suffix='collapsed')
+    app.add_route(r'/profile/tracemalloc', resource, suffix='tracemalloc')
+    init_profile_signal_handler(profiler)
+    log.info(f'profiling enabled {profile_sample_rate=} {profile_path=}')
+    return profiler
+
+
+def add_profile_args(parser):
+    parser.add_argument('--profile', action='store_true', help='cProfile requests/archives. Admin endpoints /profile, SIGUSR1 dumps to --profile_path')
+    parser.add_argument('--profile_path', action='store', default='./profile', help='folder for .prof/collapsed/tracemalloc dumps')
+    parser.add_argument('--profile_sample_rate', action='store', type=float, default=1.0, help='proportion of requests/archives profiled')
+    parser.add_argument('--profile_slow_seconds', action='store', type=float, default=1.0, help='dump individual .prof for requests/archives slower than this')
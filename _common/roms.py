@@ -7,23 +7,61 @@ from types import MappingProxyType # https://stackoverflow.com/questions/4179511
 
 log = logging.getLogger(__name__)
 
+LAYOUTS = ('merged', 'split', 'nonmerged')  # merged: clones in the parent archive `clone/` folder, bios separate
+
+
+REGEX_ROM = re.compile(
+    r"""(?P<sha1>[0-9A-Fa-f]{40}) (?P<archive_name>.+):(?P<file_name>[^\t\n]+)(?:\t(?P<size>\d*)\t(?P<crc>[0-9a-f]*)\t(?P<md5>[0-9a-f]*))?"""
+)
+
 
 class Rom(NamedTuple):
+    r"""
+    `size`/`crc`/`md5` are recorded by the catalog worker. They are tab separated after the file name when present
+
+    >>> Rom.parse('0000000000000000000000000000000000000000 sfa3:sz3.01')
+    Rom(sha1='0000000000000000000000000000000000000000', archive_name='sfa3', file_name='sz3.01', size=None, crc=None, md5=None)
+    >>> rom = Rom('0'*40, 'sfa3', 'sz3.01', size=524288, crc='1f3a6c5b', md5='d41d8cd98f00b204e9800998ecf8427e')
+    >>> str(rom)
+    '0000000000000000000000000000000000000000 sfa3:sz3.01\t524288\t1f3a6c5b\td41d8cd98f00b204e9800998ecf8427e'
+    >>> Rom.parse(str(rom)) == rom
+    True
+    >>> Rom.parse(str(rom._replace(md5=None)) + '\n').md5 is None
+    True
+    """
     sha1: str
     archive_name: str
     file_name: str
+    size: int = None
+    crc: str = None
+    md5: str = None
 
     @staticmethod
     def parse(line):
-        match = re.match(
-            r"""(?P<sha1>[0-9A-Fa-f]{40}) (?P<archive_name>.+):(?P<file_name>.+)""",
-            line,
-        )
+        match = REGEX_ROM.match(line)
         if match:
-            return Rom(**match.groupdict())
+            sha1, archive_name, file_name, size, crc, md5 = match.groups()
+            if size is None:
+                return Rom(sha1, archive_name, file_name)
+            return Rom(sha1, archive_name, file_name, int(size) if size else None, crc or None, md5 or None)
 
     def __str__(self) -> str:
-        return f"{self.sha1} {self.archive_name}:{self.file_name}"
+        if self.size is None and not self.crc and not self.md5:
+            return f"{self.sha1} {self.archive_name}:{self.file_name}"
+        return f"{self.sha1} {self.archive_name}:{self.file_name}\t{'' if self.size is None else self.size}\t{self.crc or ''}\t{self.md5 or ''}"
+
+
+def layout_filename(filename, layout):
+    """
+    >>> layout_filename('roms.txt', 'merged')
+    'roms.txt'
+    >>> layout_filename('/data/roms.txt', 'split')
+    '/data/roms.split.txt'
+    """
+    if layout == 'merged':
+        return filename
+    base, ext = os.path.splitext(filename)
+    return f'{base}.{layout}{ext}'
 
 
 # ------------------------------------------------------------------------------
@@ -32,8 +70,19 @@ class Rom(NamedTuple):
 class RomData():
     """
     Romdata for 364682 in python3 memory takes 185Mb RAM
+
+    `share` - already loaded `RomData` (other versions/layouts). Roms and rom sets identical to theirs are reused rather than
+    duplicated, so holding several MAME versions costs little more than their differences. Index values become frozensets
+
+    >>> import io
+    >>> v1 = RomData(io.StringIO('0000000000000000000000000000000000000000 sfa3:sz3.01\\n1111111111111111111111111111111111111111 sfa3:sz3.02\\n'), share=())
+    .
+    >>> v2 = RomData(io.StringIO('0000000000000000000000000000000000000000 sfa3:sz3.01\\n1111111111111111111111111111111111111111 sfa3:sz3.02\\n2222222222222222222222222222222222222222 sfa3u:sz3.03\\n'), share=(v1, ))
+    .
+    >>> v2.archive['sfa3'] is v1.archive['sfa3'], v2.sha1['0'*40] is v1.sha1['0'*40]
+    (True, True)
     """
-    def __init__(self, filehandle, readonly=True):
+    def __init__(self, filehandle, readonly=True, share=None):
         self.sha1 = {}
         self.archive = {}
 
@@ -43,18 +92,36 @@ class RomData():
                 return  # sort of a bug because readonly is not preserved
             filehandle = open(filehandle, 'rt')
 
+        shared_roms = {rom: rom for rom_data in share or () for roms in rom_data.archive.values() for rom in roms}
+
         log.info('Loading rom data ...')
         count = 0
         for count, rom in enumerate(filter(None, map(Rom.parse, filehandle))):
+            if shared_roms:
+                rom = shared_roms.get(rom, rom)
             self.sha1.setdefault(rom.sha1, set()).add(rom)
             self.archive.setdefault(rom.archive_name, set()).add(rom)
             if count % 10000 == 0:
                 print('.', end='', flush=True)
         print()
         log.info(f'Loaded dataset for {count} roms')
+        del shared_roms
 
+        if share is not None:
+            self._freeze(share)
         if readonly:
             self.sha1 = MappingProxyType(self.sha1)
             self.archive = MappingProxyType(self.archive)
         if hasattr(filehandle, 'close'):
             filehandle.close()
+
+    def _freeze(self, share):
+        shared_sets = {
+            roms: roms
+            for rom_data in share for index in (rom_data.sha1, rom_data.archive) for roms in index.values()
+            if isinstance(roms, frozenset)
+        }
+        for index in (self.sha1, self.archive):
+            for key, roms in index.items():
+                roms = frozenset(roms)
+                index[key] = shared_sets.get(roms, roms)
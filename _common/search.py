@@ -0,0 +1,175 @@
+import time
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+import falcon
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def trigrams(text):
+    """
+    >>> sorted(trigrams('sfa3u'))
+    ['a3u', 'fa3', 'sfa']
+    >>> trigrams('ab')
+    set()
+    """
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+class PrefixIndex():
+    """
+    Sorted array of names - prefix queries are two binary searches
+
+    >>> index = PrefixIndex(('sfa3', 'sfa2', 'sfa3u', 'sf2', 'sfa3', 'dino'))
+    >>> tuple(index.prefix('sfa3'))
+    ('sfa3', 'sfa3u')
+    >>> tuple(index.prefix('sf', limit=2))
+    ('sf2', 'sfa2')
+    >>> tuple(index.prefix('zzz'))
+    ()
+    """
+    def __init__(self, names):
+        self.names = sorted(set(names))
+    def prefix(self, prefix, limit=None):
+        start = bisect_left(self.names, prefix)
+        end = bisect_left(self.names, prefix + '\U0010ffff')
+        return islice(self.names, start, end if limit is None else min(end, start + limit))
+
+
+class SubstringIndex():
+    """
+    Case insensitive substring search using a trigram inverted index (posting lists of ids as compact arrays)
+    `values[id]` is returned for each matching `keys[id]`
+
+    >>> index = SubstringIndex(('Alex Kidd (USA).bin', 'Sonic (Europe).bin', 'alex kidd (japan).bin'), values=('a', 'b', 'c'))
+    >>> sorted(index.search('alex kidd'))
+    ['a', 'c']
+    >>> tuple(index.search('europe'))
+    ('b',)
+    >>> sorted(index.search('.b'))
+    ['a', 'b', 'c']
+    >>> tuple(index.search('zzzz'))
+    ()
+    """
+    def __init__(self, keys, values=None):
+        self.keys = tuple(key.lower() for key in keys)
+        self.values = values if values is not None else keys
+        postings = {}
+        for id, key in enumerate(self.keys):
+            for trigram in trigrams(key):
+                postings.setdefault(trigram, []).append(id)
+        self.postings = {trigram: array('I', ids) for trigram, ids in postings.items()}
+
+    def _candidates(self, query):
+        _trigrams = trigrams(query)
+        if not _trigrams:
+            return range(len(self.keys))  # Too short for the index - scan
+        postings = sorted((self.postings.get(trigram, ()) for trigram in _trigrams), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+        return sorted(candidates)
+
+    def search(self, query, limit=None):
+        query = query.lower()
+        return islice(
+            (self.values[id] for id in self._candidates(query) if query in self.keys[id]),
+            limit,
+        )
+
+
+class NameIndex():
+    """
+    Archive name prefix/substring and file name substring search over a `Rom` stream
+
+    >>> from _common.roms import Rom
+    >>> index = NameIndex((
+    ...     Rom('0'*40, 'sfa3', 'sz3.01'),
+    ...     Rom('1'*40, 'sfa3', 'sfa3u/sz3u.03c'),
+    ...     Rom('2'*40, 'sms/alexkidd', 'alex kidd in miracle world (usa, europe).bin'),
+    ... ))
+    >>> tuple(index.search_archives('sfa*'))
+    ('sfa3',)
+    >>> tuple(index.search_archives('*kidd'))
+    ('sms/alexkidd',)
+    >>> tuple(index.search_files('sz3'))
+    ({'archive_name': 'sfa3', 'file_name': 'sfa3u/sz3u.03c'}, {'archive_name': 'sfa3', 'file_name': 'sz3.01'})
+    """
+    def __init__(self, roms):
+        archive_names = set()
+        file_roms = {}
+        for rom in roms:
+            archive_names.add(rom.archive_name)
+            file_roms.setdefault(rom.file_name, []).append(rom)
+        self.archive_prefix = PrefixIndex(archive_names)
+        self.archive_substring = SubstringIndex(self.archive_prefix.names)
+        file_names = sorted(file_roms.keys())
+        self.file_substring = SubstringIndex(file_names, values=tuple(tuple(file_roms[f]) for f in file_names))
+
+    def search_archives(self, query, limit=None):
+        """
+        `sfa3*` (or no wildcard) is a prefix query, `*sfa3*` a substring query
+        """
+        if query.startswith('*'):
+            return self.archive_substring.search(query.strip('*'), limit)
+        return self.archive_prefix.prefix(query.rstrip('*'), limit)
+
+    def search_files(self, query, limit=None):
+        return islice(
+            (
+                {'archive_name': rom.archive_name, 'file_name': rom.file_name}
+                for roms in self.file_substring.search(query.strip('*'))
+                for rom in roms
+            ),
+            limit,
+        )
+
+
+# Falcon -----------------------------------------------------------------------
+
+class SearchResource():
+    """
+    GET /search?archive=sfa3*&limit=100
+    GET /search?file=alex kidd&limit=100
+
+    The index is built on first use. `get_version` lets mutable data (catalog) trigger a rebuild, at most every `rebuild_seconds`
+    """
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 10000
+    def __init__(self, get_roms, get_version=lambda: None, rebuild_seconds=60):
+        self.get_roms = get_roms
+        self.get_version = get_version
+        self.rebuild_seconds = rebuild_seconds
+        self.lock = threading.Lock()
+        self._index = None
+        self._index_version = None
+        self._index_time = 0
+    @property
+    def index(self):
+        with self.lock:
+            version = self.get_version()
+            if not self._index or (version != self._index_version and time.time() - self._index_time > self.rebuild_seconds):
+                log.info('Building search index ...')
+                self._index_version = version
+                self._index = NameIndex(self.get_roms())
+                self._index_time = time.time()
+                log.info('Built search index')
+            return self._index
+    def on_get(self, request, response):
+        limit = request.get_param_as_int('limit', default=self.DEFAULT_LIMIT, min_value=1, max_value=self.MAX_LIMIT)
+        archive = request.get_param('archive')
+        file = request.get_param('file')
+        if not archive and not file:
+            raise falcon.HTTPBadRequest(description='`archive` or `file` query param required')
+        response.media = {}
+        if archive:
+            response.media['archives'] = tuple(self.index.search_archives(archive, limit))
+        if file:
+            response.media['files'] = tuple(self.index.search_files(file, limit))
+        response.status = falcon.HTTP_200
@@ -0,0 +1,138 @@
+import os
+import hashlib
+from bisect import bisect
+from itertools import chain
+
+from _common.scan import fast_scan, fast_scan_regex_filter, FileScan
+
+import logging
+log = logging.getLogger(__name__)
+
+
+DEFAULT_FILTER = fast_scan_regex_filter()
+SHARD_BY = ('archive', 'folder')  # folder: every archive in a top level folder (softlist) is held by the same shard
+
+
+def shard_key(archive_name, by='archive'):
+    """
+    >>> shard_key('nes/smb', by='archive')
+    'nes/smb'
+    >>> shard_key('nes/smb', by='folder')
+    'nes'
+    >>> shard_key('sfa3', by='folder')
+    'sfa3'
+    """
+    if by == 'folder':
+        return archive_name.split('/')[0]
+    return archive_name
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8], 'big')
+
+
+class HashRing():
+    """
+    Consistent hashing of keys to `nodes` - adding/removing a node only moves ~1/n of the keys
+
+    >>> ring = HashRing(range(4))
+    >>> ring.node('sfa3') == ring.node('sfa3')
+    True
+    >>> keys = tuple(f'archive{i}' for i in range(2000))
+    >>> sorted(set(map(ring.node, keys)))
+    [0, 1, 2, 3]
+    >>> moved = sum(ring.node(key) != HashRing(range(5)).node(key) for key in keys)
+    >>> moved < len(keys) * 0.35
+    True
+    """
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = tuple(nodes)
+        points = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = tuple(h for h, _ in points)
+        self._nodes = tuple(node for _, node in points)
+    def node(self, key):
+        return self._nodes[bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+class Shard():
+    """
+    The portion of the rom tree held by one catalog process
+
+    >>> shards = tuple(Shard(index, 3) for index in range(3))
+    >>> [sum(shard.owns(f'archive{i}') for i in range(300)) > 50 for shard in shards]
+    [True, True, True]
+    >>> sum(shard.owns('sfa3') for shard in shards)
+    1
+    >>> Shard().owns('anything')
+    True
+
+    >>> import tempfile, pathlib
+    >>> tempdir = tempfile.TemporaryDirectory()
+    >>> for f in ('sfa3.7z', 'dino.7z', 'nes/smb.7z', 'nes/zelda.7z', 'megadriv/sonic.7z', 'snes/smw.7z'):
+    ...     pathlib.Path(tempdir.name, f).parent.mkdir(exist_ok=True)
+    ...     pathlib.Path(tempdir.name, f).touch()
+    >>> scans = [sorted(f.relative for f in Shard(index, 2, by='folder').scan(tempdir.name)) for index in range(2)]
+    >>> sorted(chain.from_iterable(scans))
+    ['dino.7z', 'megadriv/sonic.7z', 'nes/smb.7z', 'nes/zelda.7z', 'sfa3.7z', 'snes/smw.7z']
+    >>> [('nes/smb.7z' in scan) == ('nes/zelda.7z' in scan) for scan in scans]
+    [True, True]
+    >>> tempdir.cleanup()
+    """
+    def __init__(self, index=0, count=1, by='archive'):
+        assert 0 <= index < count, f'{index=} must be in range of {count=}'
+        assert by in SHARD_BY
+        self.index = index
+        self.count = count
+        self.by = by
+        self.ring = HashRing(range(count))
+    def owns(self, archive_name):
+        return self.count == 1 or self.ring.node(shard_key(archive_name, self.by)) == self.index
+    def scan(self, root):
+        """
+        `fast_scan` of the archives this shard owns. Sharding by folder skips walking other shards top level folders entirely
+        """
+        def _owned(f):
+            return self.owns(os.path.join(f.folder, f.file_no_ext))
+        if self.count == 1:
+            return fast_scan(root)
+        if self.by != 'folder' or not os.path.isdir(root):
+            return filter(_owned, fast_scan(root))
+        with os.scandir(root) as scanner:
+            dir_entries = tuple(scanner)
+        return chain(
+            filter(_owned, (FileScan(root, '', dir_entry) for dir_entry in dir_entries if dir_entry.is_file() and DEFAULT_FILTER(dir_entry.name))),
+            chain.from_iterable(
+                fast_scan(root, dir_entry.name)
+                for dir_entry in dir_entries
+                if dir_entry.is_dir() and DEFAULT_FILTER(dir_entry.name) and self.owns(dir_entry.name)
+            ),
+        )
+    def __repr__(self):
+        return f'Shard({self.index}/{self.count} by {self.by})'
+
+
+class ShardRouter():
+    """
+    Route an archive to the catalog that holds it. `urls` are in shard index order
+
+    >>> router = ShardRouter('http://catalog0:9002,http://catalog1:9002')
+    >>> router.url('sfa3') in router.urls
+    True
+    >>> ShardRouter('http://catalog:9002').url('sfa3')
+    'http://catalog:9002'
+    """
+    def __init__(self, urls, by='archive'):
+        self.urls = tuple(url.strip() for url in urls.split(',')) if isinstance(urls, str) else tuple(urls)
+        self.by = by
+        self.ring = HashRing(range(len(self.urls)))
+    def url(self, archive_name):
+        if len(self.urls) == 1:
+            return self.urls[0]
+        return self.urls[self.ring.node(shard_key(archive_name, self.by))]
+
+
+def add_shard_args(parser, catalog=False):
+    parser.add_argument('--shard_by', action='store', choices=SHARD_BY, default='archive', help='consistent hash archives by name or by top level folder (softlist)')
+    if catalog:
+        parser.add_argument('--shard_index', action='store', type=int, default=0, help='')
+        parser.add_argument('--shard_count', action='store', type=int, default=1, help='number of catalog processes the rom tree is split across')
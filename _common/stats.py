@@ -0,0 +1,298 @@
+import time
+import threading
+from typing import NamedTuple
+
+import numpy as np
+import requests
+
+from _common.roms import Rom
+
+import logging
+log = logging.getLogger(__name__)
+
+
+COUNTS = ('roms', 'matched', 'misplaced', 'missing', 'missing_bytes', 'missing_unknown_size', 'unknown')
+
+
+# Encoding ---------------------------------------------------------------------
+
+class RomArrays(NamedTuple):
+    sha1: np.ndarray  # uint64 - leading 64 bits of the sha1
+    archive: np.ndarray  # int32 archive id
+    size: np.ndarray  # int64 (-1 unknown)
+
+
+def sha1_array(sha1s):
+    """
+    Leading 64 bits of each sha1 - sorts/compares as a machine integer. A prefix collision needs ~2**32 distinct roms
+
+    >>> sha1_array(('00'*19 + 'ff', 'ff'*20))
+    array([                   0, 18446744073709551615], dtype=uint64)
+    """
+    return np.frombuffer(bytes.fromhex(''.join([sha1[:16] for sha1 in sha1s])), dtype='>u8').astype(np.uint64)
+
+
+def sha1_array_from_bytes(data):
+    """
+    `sha1_array` of concatenated raw 20 byte sha1s (`MEDIA_SHA1`)
+
+    >>> sha1s = ('00'*19 + 'ff', 'ff'*20)
+    >>> sha1_array_from_bytes(bytes.fromhex(''.join(sha1s))).tolist() == sha1_array(sha1s).tolist()
+    True
+    """
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, 20)[:, :8].copy().view('>u8').ravel().astype(np.uint64)
+
+
+def encode_archives(archives, archive_ids, new_archive_ids=None):
+    """
+    `archives` {archive_name: roms}. Archive names not in `archive_ids` are numbered on from it in `new_archive_ids`
+    """
+    ids, lengths, sha1s, sizes = [], [], [], []
+    for archive_name, roms in archives.items():
+        _id = archive_ids.get(archive_name)
+        if _id is None:
+            _id = new_archive_ids.setdefault(archive_name, len(archive_ids) + len(new_archive_ids))
+        ids.append(_id)
+        lengths.append(len(roms))
+        sha1s += [rom.sha1 for rom in roms]
+        sizes += [-1 if rom.size is None else rom.size for rom in roms]
+    return RomArrays(
+        sha1_array(sha1s),
+        np.repeat(np.array(ids, dtype=np.int32), lengths),
+        np.array(sizes, dtype=np.int64),
+    )
+
+
+def _isin_sorted(values, sorted_unique):
+    if not len(sorted_unique):
+        return np.zeros(len(values), dtype=bool)
+    index = np.searchsorted(sorted_unique, values).clip(max=len(sorted_unique) - 1)
+    return sorted_unique[index] == values
+
+
+def archive_group(archive_name):
+    """
+    Softlist (or DAT tag) of an archive - '' for MAME machines
+
+    >>> archive_group('sms/alexkidd'), archive_group('sfa3')
+    ('sms', '')
+    """
+    group, _, name = archive_name.partition('/')
+    return group if name else ''
+
+
+# Stats ------------------------------------------------------------------------
+
+class CompletenessStats():
+    """
+    Romdata encoded once as numpy arrays. Each catalog snapshot is encoded and compared with sorted array set operations
+
+     - matched   romdata rom present in the archive it belongs to
+     - misplaced romdata rom present, but only in other archives
+     - missing   romdata rom not in the collection (`missing_bytes` where romdata knows the size)
+     - unknown   catalogued rom romdata does not know
+
+    A sharded catalog only holds its own archives - roms misplaced into another shard's archives count as missing
+    unless that shard's sha1s are given as `present_elsewhere` (see `ShardPresence`)
+
+    >>> from _common.roms import Rom
+    >>> stats = CompletenessStats({
+    ...     'sfa3': (Rom('0'*40, 'sfa3', 'sz3.01', size=4), Rom('1'*40, 'sfa3', 'sz3.02', size=8)),
+    ...     'sms/alexkidd': (Rom('2'*40, 'sms/alexkidd', 'a.bin', size=16), ),
+    ...     'sms/sonic': (Rom('3'*40, 'sms/sonic', 's.bin'), ),
+    ... })
+    >>> counts = stats.counts({'sfa3': (Rom('0'*40, 'sfa3', 'sz3.01'), ), 'sms/sonic': (Rom('2'*40, 'sms/sonic', 'a.bin'), Rom('9'*40, 'sms/sonic', 'junk.bin'))})
+    >>> report(counts)
+    {'roms': 4, 'matched': 1, 'misplaced': 1, 'missing': 2, 'missing_bytes': 8, 'missing_unknown_size': 1, 'unknown': 1, 'archives': 3, 'archives_complete': 0, 'archives_partial': 1, 'archives_missing': 2, 'archives_unknown': 0}
+    >>> report(counts, by='group')['sms']['misplaced'], report(counts, by='group')['']['matched']
+    (1, 1)
+    >>> report(counts, by='archive', group='sms')
+    {'sms/alexkidd': {'roms': 1, 'matched': 0, 'misplaced': 1, 'missing': 0, 'missing_bytes': 0, 'missing_unknown_size': 0, 'unknown': 0}, 'sms/sonic': {'roms': 1, 'matched': 0, 'misplaced': 0, 'missing': 1, 'missing_bytes': 0, 'missing_unknown_size': 1, 'unknown': 1}}
+    >>> counts = stats.counts({'sfa3': (Rom('0'*40, 'sfa3', 'sz3.01'), )}, present_elsewhere=sha1_array(('1'*40, )))
+    >>> report(counts)['misplaced'], report(counts)['missing']
+    (1, 2)
+    """
+    def __init__(self, romdata_archives):
+        """
+        `romdata_archives` {archive_name: roms} (`RomData.archive`)
+        """
+        self.archive_ids = {archive_name: _id for _id, archive_name in enumerate(romdata_archives.keys())}
+        self.archive_names = tuple(self.archive_ids.keys())
+        self.archive_groups = tuple(map(archive_group, self.archive_names))
+        self.romdata = encode_archives(romdata_archives, self.archive_ids)
+        self.sha1s = np.unique(self.romdata.sha1)  # sorted - a sha1's position is its id
+        self.romdata_sha1_id = np.searchsorted(self.sha1s, self.romdata.sha1)
+        self.romdata_pairs = self._pairs(self.romdata.archive, self.romdata_sha1_id)
+        log.info(f'Encoded {len(self.romdata.sha1)} romdata roms in {len(self.archive_ids)} archives')
+
+    def _pairs(self, archive, sha1_id):
+        """
+        (archive, sha1) as a single int64 key
+        """
+        return archive.astype(np.int64) * len(self.sha1s) + sha1_id
+
+    def counts(self, catalog_archives, present_elsewhere=None):
+        """
+        {name: per archive id array} for `COUNTS`, plus `archive_names` and their `groups`
+        `catalog_archives` {archive_name: roms} (`CatalogData.archive`)
+        `present_elsewhere` `sha1_array` of roms held outside `catalog_archives` (other catalog shards)
+        """
+        new_archive_ids = {}
+        catalog = encode_archives(catalog_archives, self.archive_ids, new_archive_ids)
+        n = len(self.archive_ids) + len(new_archive_ids)
+        romdata = self.romdata
+
+        sha1_id = np.searchsorted(self.sha1s, catalog.sha1).clip(max=max(len(self.sha1s) - 1, 0))
+        known = self.sha1s[sha1_id] == catalog.sha1 if len(self.sha1s) else np.zeros(len(catalog.sha1), dtype=bool)
+        present = np.zeros(len(self.sha1s), dtype=bool)
+        present[sha1_id[known]] = True
+        if present_elsewhere is not None:
+            present |= _isin_sorted(self.sha1s, np.unique(present_elsewhere))
+        present = present[self.romdata_sha1_id]
+        matched = _isin_sorted(self.romdata_pairs, np.unique(self._pairs(catalog.archive[known], sha1_id[known])))
+        missing = ~present
+        missing_known = missing & (romdata.size >= 0)
+
+        def _bincount(archive, weights=None):
+            return np.bincount(archive, weights=weights, minlength=n).astype(np.int64)
+        return {
+            'archive_names': np.array(self.archive_names + tuple(new_archive_ids.keys()), dtype=object),
+            'groups': np.array(self.archive_groups + tuple(map(archive_group, new_archive_ids.keys())), dtype=object),
+            'roms': _bincount(romdata.archive),
+            'matched': _bincount(romdata.archive[matched]),
+            'misplaced': _bincount(romdata.archive[present & ~matched]),
+            'missing': _bincount(romdata.archive[missing]),
+            'missing_bytes': _bincount(romdata.archive[missing_known], weights=romdata.size[missing_known]),
+            'missing_unknown_size': _bincount(romdata.archive[missing & ~missing_known]),
+            'unknown': _bincount(catalog.archive[~known]),
+        }
+
+
+def _totals(counts, index, group_ids, n_groups):
+    """
+    Sum the archives in `index` into `n_groups` by their `group_ids`
+    """
+    roms, matched, unknown = counts['roms'][index], counts['matched'][index], counts['unknown'][index]
+    def _sum(weights):
+        return np.bincount(group_ids, weights=weights, minlength=n_groups).astype(np.int64).tolist()
+    columns = {
+        **{key: _sum(counts[key][index]) for key in COUNTS},
+        'archives': _sum(roms > 0),
+        'archives_complete': _sum((roms > 0) & (matched == roms)),
+        'archives_partial': _sum((matched > 0) & (matched < roms)),
+        'archives_missing': _sum((roms > 0) & (matched == 0)),
+        'archives_unknown': _sum((roms == 0) & (unknown > 0)),
+    }
+    return [{key: column[i] for key, column in columns.items()} for i in range(n_groups)]
+
+
+def report(counts, by='collection', group=None, incomplete=False):
+    """
+    `by` collection (totals), group (softlist/DAT tag - '' is MAME machines) or archive
+    `group` limits to one softlist, `incomplete` (archives only) drops archives with every rom matched
+    """
+    names, groups = counts['archive_names'], counts['groups']
+    mask = np.ones(len(names), dtype=bool) if group is None else groups == group
+    if by == 'collection':
+        index = np.flatnonzero(mask)
+        return _totals(counts, index, np.zeros(len(index), dtype=np.int64), 1)[0]
+    if by == 'group':
+        index = np.flatnonzero(mask)
+        group_names, group_ids = np.unique(groups[index].astype(str), return_inverse=True)
+        return dict(zip(group_names.tolist(), _totals(counts, index, group_ids, len(group_names))))
+    if by == 'archive':
+        if incomplete:
+            mask &= counts['matched'] < counts['roms']
+        index = np.flatnonzero(mask & ((counts['roms'] > 0) | (counts['unknown'] > 0)))
+        columns = {key: counts[key][index].tolist() for key in COUNTS}
+        return {
+            names[i]: {key: columns[key][row] for key in COUNTS}
+            for row, i in enumerate(index)
+        }
+    raise ValueError(f'{by=}')
+
+
+# Romdata ----------------------------------------------------------------------
+
+def iter_romdata_api(url_api_romdata, layout=None, response=None):
+    """
+    Every rom from the romdata `/roms` export (streamed `roms.txt` lines) - or from an already made `/roms` `response`
+    """
+    if response is None:
+        response = requests.get(f'{url_api_romdata}/roms', params={'layout': layout} if layout else None, stream=True)
+    response.raise_for_status()
+    for line in response.iter_lines(decode_unicode=True):
+        rom = Rom.parse(line)
+        if rom:
+            yield rom
+
+
+def group_archives(roms, owns=None):
+    """
+    >>> group_archives((Rom('0'*40, 'sfa3', 'a'), Rom('1'*40, 'sfa3', 'b'), Rom('2'*40, 'mslug', 'c')), owns=lambda archive_name: archive_name != 'mslug')
+    {'sfa3': [Rom(sha1='0000000000000000000000000000000000000000', archive_name='sfa3', file_name='a', size=None, crc=None, md5=None), Rom(sha1='1111111111111111111111111111111111111111', archive_name='sfa3', file_name='b', size=None, crc=None, md5=None)]}
+    """
+    archives = {}
+    for rom in roms:
+        if owns is None or owns(rom.archive_name):
+            archives.setdefault(rom.archive_name, []).append(rom)
+    return archives
+
+
+class RomdataStats():
+    """
+    `CompletenessStats` per romdata layout - re-encoded only when the romdata content changes
+    The `/roms` export of the current version is fetched from its `/version/{tag}/` route (the version can't switch mid
+    download) at most every `version_seconds`, with `If-None-Match` - its ETag changes with the loaded files, so a
+    restart with a new `roms.txt` under the same version name is noticed. Encoding happens outside the lock - a
+    concurrent first request may encode twice, but requests for already encoded stats are never held up
+    `owns(archive_name)` limits romdata to the archives a catalog shard holds
+    """
+    def __init__(self, url_api_romdata, owns=None, version_seconds=60):
+        self.url_api_romdata = url_api_romdata
+        self.owns = owns
+        self.version_seconds = version_seconds
+        self.lock = threading.Lock()
+        self._stats = {}  # layout: (etag, stats)
+        self._checked = {}  # layout: time
+    def get(self, layout=None):
+        etag, stats = self._stats.get(layout, (None, None))
+        if stats and time.time() - self._checked.get(layout, 0) <= self.version_seconds:
+            return stats
+        version = requests.get(self.url_api_romdata).json().get('version')
+        response = requests.get(
+            f'{self.url_api_romdata}/version/{version}/roms',
+            params={'layout': layout} if layout else None,
+            headers={'If-None-Match': etag} if etag else None,
+            stream=True,
+        )
+        self._checked[layout] = time.time()
+        if stats and response.status_code == 304:
+            response.close()
+            return stats
+        stats = CompletenessStats(group_archives(iter_romdata_api(self.url_api_romdata, response=response), self.owns))
+        with self.lock:
+            self._stats = {**self._stats, layout: (response.headers.get('ETag'), stats)}
+        return stats
+
+
+class ShardPresence():
+    """
+    The sha1s held by the other catalog shards (`GET /sha1s` of each) as one `sha1_array` - refetched at most every `refresh_seconds`
+    `urls` are every shard in shard index order (as `ShardRouter`); `index` is this shard
+    The same array object is returned until refreshed, so callers can cache on it
+    """
+    def __init__(self, urls, index, refresh_seconds=60):
+        self.urls = tuple(url for i, url in enumerate(urls) if i != index)
+        self.refresh_seconds = refresh_seconds
+        self._present = (None, 0)
+    def _fetch(self, url):
+        response = requests.get(f'{url}/sha1s')
+        response.raise_for_status()
+        return sha1_array_from_bytes(response.content)
+    def get(self):
+        present, _time = self._present
+        if time.time() - _time > self.refresh_seconds:
+            present = np.unique(np.concatenate([self._fetch(url) for url in self.urls] or [np.zeros(0, dtype=np.uint64)]))
+            self._present = (present, time.time())
+        return present
@@ -0,0 +1,238 @@
+import os
+import time
+import shutil
+import signal
+import threading
+import subprocess
+
+import logging
+log = logging.getLogger(__name__)
+
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+MB = 1024 * 1024
+
+
+class TokenBucket():
+    """
+    `rate` bytes per second with up to `burst` bytes in hand. `consume` returns the seconds the caller owes (pause for)
+
+    >>> now = [0.0]
+    >>> bucket = TokenBucket(100, burst=100, clock=lambda: now[0])
+    >>> bucket.consume(100)
+    0
+    >>> bucket.consume(50)
+    0.5
+    >>> now[0] = 1.5
+    >>> bucket.consume(50)
+    0
+    >>> TokenBucket(None).consume(10 * MB)
+    0
+    """
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst or rate
+        self.clock = clock
+        self.tokens = self.burst or 0
+        self.last = clock()
+    def consume(self, amount):
+        if not self.rate:
+            return 0
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        return max(0, -self.tokens / self.rate)
+
+
+def parse_pressure(text):
+    """
+    Pressure stall information https://docs.kernel.org/accounting/psi.html
+
+    >>> parse_pressure('some avg10=1.50 avg60=0.80 avg300=0.10 total=12345\\nfull avg10=0.50 avg60=0.20 avg300=0.00 total=6789\\n')
+    {'some': {'avg10': 1.5, 'avg60': 0.8, 'avg300': 0.1, 'total': 12345.0}, 'full': {'avg10': 0.5, 'avg60': 0.2, 'avg300': 0.0, 'total': 6789.0}}
+    """
+    return {
+        kind: {key: float(value) for key, value in (field.split('=') for field in fields)}
+        for kind, *fields in (line.split() for line in text.splitlines() if line.strip())
+    }
+
+
+def io_pressure(filename='/proc/pressure/io'):
+    """
+    % of the last 10 seconds some task was stalled on I/O. None without PSI (non Linux, kernel < 4.20, psi=0)
+    """
+    try:
+        with open(filename, 'rt') as filehandle:
+            return parse_pressure(filehandle.read())['some']['avg10']
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class AdaptiveRate():
+    """
+    Additive increase/multiplicative decrease of a `TokenBucket` rate driven by host I/O pressure
+
+    >>> bucket = TokenBucket(100 * MB)
+    >>> pressure = [0.0]
+    >>> adaptive = AdaptiveRate(bucket, max_rate=100 * MB, min_rate=1 * MB, pressure_threshold=10, read_pressure=lambda: pressure[0])
+    >>> pressure[0] = 40.0
+    >>> adaptive.update(); adaptive.update(); int(bucket.rate // MB)
+    25
+    >>> pressure[0] = 2.0
+    >>> adaptive.update(); int(bucket.rate // MB)
+    35
+    """
+    def __init__(self, bucket, max_rate, min_rate=1 * MB, pressure_threshold=10.0, read_pressure=io_pressure):
+        self.bucket = bucket
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.pressure_threshold = pressure_threshold
+        self.read_pressure = read_pressure
+        self.pressure = None
+        if read_pressure() is None:
+            log.warning('I/O pressure (/proc/pressure/io) unavailable - adaptive throttling disabled')
+            self.read_pressure = lambda: None
+    def update(self):
+        self.pressure = self.read_pressure()
+        if self.pressure is None:
+            return
+        if self.pressure > self.pressure_threshold:
+            self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+        else:
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate / 10)
+        self.bucket.burst = self.bucket.rate
+
+
+def process_read_bytes(pid):
+    """
+    Bytes read by a process (all `read()` calls - counts network filesystems where `read_bytes` does not)
+
+    >>> process_read_bytes(os.getpid()) > 0
+    True
+    """
+    try:
+        with open(f'/proc/{pid}/io', 'rt') as filehandle:
+            for line in filehandle:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        return None
+
+
+class Throttle():
+    """
+    Share the host with interactive users
+     - spawned processes run under `nice`/`ionice`
+     - reads are limited to `read_bytes_per_second`. A process can't be throttled per read, so it is paused (SIGSTOP) while over budget
+     - `adaptive` halves the rate while host I/O pressure is above `pressure_threshold` and recovers it gradually
+
+    >>> throttle = Throttle(read_bytes_per_second=1 * MB)
+    >>> throttle.run(('cat', '/dev/null')).returncode
+    0
+    >>> import io
+    >>> len(throttle.read(io.BytesIO(b'x' * 10), 4))
+    4
+    """
+    def __init__(self, read_bytes_per_second=None, adaptive=False, pressure_threshold=10.0, nice=None, ionice_class=None, ionice_level=None, interval=0.1):
+        self.bucket = TokenBucket(read_bytes_per_second or (adaptive and 200 * MB) or None)
+        self.adaptive = AdaptiveRate(self.bucket, max_rate=self.bucket.rate, pressure_threshold=pressure_threshold) if adaptive else None
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.paused_seconds = 0.0
+        self._last_adapt = 0
+        self.command_prefix = ()
+        if nice:
+            self.command_prefix += ('nice', '-n', str(nice))
+        if ionice_class:
+            if shutil.which('ionice'):
+                self.command_prefix += ('ionice', '-c', str(IONICE_CLASSES[ionice_class]), *(('-n', str(ionice_level)) if ionice_level is not None and ionice_class != 'idle' else ()))
+            else:
+                log.warning('ionice not found - spawned processes keep their I/O priority')
+
+    @property
+    def rate(self):
+        return self.bucket.rate or 0
+
+    def _owed(self, amount):
+        with self.lock:
+            if self.adaptive and time.monotonic() - self._last_adapt > 1:
+                self._last_adapt = time.monotonic()
+                self.adaptive.update()
+            return self.bucket.consume(amount)
+
+    def read(self, filehandle, size=-1):
+        """
+        Throttled read for I/O done in this process
+        """
+        data = filehandle.read(size)
+        owed = self._owed(len(data))
+        if owed:
+            self.paused_seconds += owed
+            time.sleep(owed)
+        return data
+
+    def _monitor(self, process, done):
+        last = 0
+        while not done.wait(self.interval):
+            total = process_read_bytes(process.pid)
+            if total is None:
+                return
+            owed = self._owed(total - last)
+            last = total
+            if not owed:
+                continue
+            try:
+                os.kill(process.pid, signal.SIGSTOP)
+                self.paused_seconds += owed
+                done.wait(owed)
+            finally:
+                try:
+                    os.kill(process.pid, signal.SIGCONT)
+                except ProcessLookupError:
+                    return
+
+    def run(self, args, cwd=None):
+        """
+        `subprocess.run(args, capture_output=True)` with priority and read limits applied
+        """
+        process = subprocess.Popen((*self.command_prefix, *args), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        done = threading.Event()
+        monitor = None
+        if self.bucket.rate:
+            monitor = threading.Thread(target=self._monitor, args=(process, done), daemon=True, name='throttle')
+            monitor.start()
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            done.set()
+            if monitor:
+                monitor.join()
+        return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+
+def create_throttle(throttle_read_mbps=None, throttle_adaptive=False, throttle_pressure_threshold=10.0, nice=None, ionice_class=None, ionice_level=None, **kwargs):
+    """
+    None unless a limit is set - takes the `--throttle*`/`--nice`/`--ionice*` commandline kwargs
+    """
+    if not (throttle_read_mbps or throttle_adaptive or nice or ionice_class):
+        return None
+    throttle = Throttle(
+        read_bytes_per_second=throttle_read_mbps * MB if throttle_read_mbps else None,
+        adaptive=throttle_adaptive,
+        pressure_threshold=throttle_pressure_threshold,
+        nice=nice,
+        ionice_class=ionice_class,
+        ionice_level=ionice_level,
+    )
+    log.info(f'throttling enabled {throttle_read_mbps=} {throttle_adaptive=} {nice=} {ionice_class=}')
+    return throttle
+
+
+def add_throttle_args(parser):
+    parser.add_argument('--throttle_read_mbps', action='store', type=float, help='limit read bandwidth (MB/s) of hashing/extraction')
+    parser.add_argument('--throttle_adaptive', action='store_true', help='back off while host I/O pressure (/proc/pressure/io) is high')
+    parser.add_argument('--throttle_pressure_threshold', action='store', type=float, default=10.0, help='I/O pressure some avg10 %% above which to back off')
+    parser.add_argument('--nice', action='store', type=int, help='nice level for spawned 7z processes')
+    parser.add_argument('--ionice_class', action='store', choices=tuple(IONICE_CLASSES.keys()), help='ionice class for spawned 7z processes')
+    parser.add_argument('--ionice_level', action='store', type=int, help='ionice level 0-7 (best-effort/realtime)')
@@ -0,0 +1,313 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import random
+import pathlib
+import platform
+import statistics
+import tempfile
+import tracemalloc
+import datetime
+from contextlib import redirect_stdout
+
+from benchmark.synthetic import SyntheticRomset
+
+import logging
+log = logging.getLogger(__name__)
+
+
+BENCHMARKS = {}
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timeit(func, repeat=5):
+    """
+    >>> result = timeit(lambda: None, repeat=3)
+    >>> sorted(result.keys())
+    ['max', 'median', 'min', 'runs']
+    >>> result['runs']
+    3
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):  # `RomData` prints progress dots
+            func()
+        timings.append(time.perf_counter() - start)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'runs': repeat,
+    }
+
+
+def peak_memory(func):
+    """
+    Peak python heap allocated while running `func` (bytes)
+    Run separately from `timeit` as tracemalloc slows execution
+    """
+    tracemalloc.start()
+    try:
+        with redirect_stdout(io.StringIO()):
+            func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Context ----------------------------------------------------------------------
+
+class BenchmarkContext():
+    """
+    Synthetic dataset on disk shared by all benchmarks in a run
+    """
+    def __init__(self, path, romset):
+        self.path = pathlib.Path(path)
+        self.romset = romset
+        self.mame_xml = self.path.joinpath('mame.xml')
+        self.software_xml = self.path.joinpath('software.xml')
+        self.roms_txt = self.path.joinpath('roms.txt')
+        self.collection = self.path.joinpath('collection')
+        self.collection_7z = self.path.joinpath('collection_7z')
+        self._rom_data = None
+
+    def generate(self):
+        log.info(f'Generating synthetic dataset in {self.path}')
+        with open(self.mame_xml, 'wb') as filehandle:
+            self.romset.write_mame_xml(filehandle)
+        with open(self.software_xml, 'wb') as filehandle:
+            self.romset.write_software_xml(filehandle)
+        with open(self.roms_txt, 'wt') as filehandle:
+            self.romset.write_roms_txt(filehandle)
+        self.romset.write_collection(self.collection)
+        return self
+
+    @property
+    def rom_data(self):
+        if not self._rom_data:
+            from _common.roms import RomData
+            with redirect_stdout(io.StringIO()):
+                self._rom_data = RomData(str(self.roms_txt))
+        return self._rom_data
+
+    def sample_sha1s(self, count, seed=0):
+        """
+        A `/sets` style query - all sha1s from a sample of archives (bios archives always included as they are the heaviest to resolve)
+        """
+        _random = random.Random(seed)
+        archive_names = sorted(self.rom_data.archive.keys())
+        bioss = [a for a in archive_names if a.startswith('bios')]
+        archive_names = bioss + _random.sample(archive_names, min(count, len(archive_names)))
+        return [rom.sha1 for archive_name in archive_names for rom in self.rom_data.archive[archive_name]]
+
+
+# Benchmarks -------------------------------------------------------------------
+
+@benchmark
+def iter_mame(context, repeat):
+    from romdata.parse_mame_xml import iter_mame
+    return timeit(lambda: sum(1 for _ in iter_mame(lambda: open(context.mame_xml, 'rb'))), repeat)
+
+@benchmark
+def iter_software(context, repeat):
+    from romdata.parse_mame_xml import iter_software
+    return timeit(lambda: sum(1 for _ in iter_software(lambda: open(context.software_xml, 'rb'))), repeat)
+
+@benchmark
+def romdata_load(context, repeat):
+    from _common.roms import RomData
+    _return = timeit(lambda: RomData(str(context.roms_txt)), repeat)
+    _return['peak_bytes'] = peak_memory(lambda: RomData(str(context.roms_txt)))
+    return _return
+
+@benchmark
+def romdata_version_shared(context, repeat):
+    """
+    A second romdata version loaded alongside the first - identical roms/sets are shared rather than held twice
+    """
+    from _common.roms import RomData
+    with redirect_stdout(io.StringIO()):
+        first = RomData(str(context.roms_txt), share=())
+    _return = timeit(lambda: RomData(str(context.roms_txt), share=(first, )), repeat)
+    _return['peak_bytes'] = peak_memory(lambda: RomData(str(context.roms_txt), share=(first, )))
+    return _return
+
+@benchmark
+def romdata_sets(context, repeat):
+    from falcon import testing
+    from romdata.romdata import create_wsgi_app
+    with redirect_stdout(io.StringIO()):
+        client = testing.TestClient(create_wsgi_app(str(context.roms_txt)))
+    queries = [context.sample_sha1s(count=10, seed=seed) for seed in range(20)]
+    def _query():
+        for sha1s in queries:
+            assert client.simulate_get('/sets', json=sha1s).status_code == 200
+    return timeit(_query, repeat)
+
+@benchmark
+def verify_results(context, repeat):
+    from falcon import testing
+    from romdata.romdata import create_wsgi_app
+    from verify.verify import verify_results
+    with redirect_stdout(io.StringIO()):
+        client = testing.TestClient(create_wsgi_app(str(context.roms_txt)))
+    inputs = []
+    for archive_name, archive_roms in sorted(context.rom_data.archive.items())[:200]:
+        catalog = {rom.sha1: rom.file_name for rom in archive_roms}
+        inputs.append((archive_name, catalog, client.simulate_get('/sets', json=list(catalog.keys())).json))
+    def _verify():
+        for archive_name, catalog, romdata in inputs:
+            verify_results(archive_name, catalog, romdata)
+    return timeit(_verify, repeat)
+
+@benchmark
+def search(context, repeat):
+    from itertools import chain
+    from _common.search import NameIndex
+    roms = tuple(chain.from_iterable(context.rom_data.archive.values()))
+    index = NameIndex(roms)
+    def _query():
+        for query in ('machine1*', 'softlist2/*', 'bios'):
+            tuple(index.search_archives(query, limit=100))
+        for query in ('_1.bin', 'software12_', 'machine3'):
+            tuple(index.search_files(query, limit=100))
+    _return = timeit(_query, repeat)
+    _return['build'] = timeit(lambda: NameIndex(roms), repeat=1)['median']
+    return _return
+
+@benchmark
+def fast_scan(context, repeat):
+    from _common.scan import fast_scan
+    return timeit(lambda: sum(1 for _ in fast_scan(str(context.collection))), repeat)
+
+@benchmark
+def hash_archive(context, repeat):
+    if not shutil.which('7z'):
+        log.warning('7z not found - skipping hash_archive')
+        return None
+    from _common.p7zip import P7Zip
+    from _common.scan import fast_scan
+    from worker_catalog.worker_catalog import hash_archive
+    if not context.collection_7z.exists():
+        romset = SyntheticRomset(**{**vars(context.romset), 'machines': 20, 'software': 20, 'softwarelists': 1})
+        romset.write_collection(context.collection_7z, compress=P7Zip().compress)
+    archives = tuple(pathlib.Path(f.relative) for f in fast_scan(str(context.collection_7z)))
+    return timeit(lambda: tuple(hash_archive(context.collection_7z, archive) for archive in archives), repeat)
+
+
+# Compare ----------------------------------------------------------------------
+
+def compare(results, baseline, threshold=1.25, metric='median'):
+    """
+    Return regressions where `results` are slower (or larger) than `baseline` by more than `threshold`
+
+    >>> baseline = {'results': {'a': {'median': 1.0, 'peak_bytes': 100}, 'b': {'median': 1.0}, 'c': None}}
+    >>> results = {'results': {'a': {'median': 1.1, 'peak_bytes': 200}, 'b': {'median': 3.0}, 'c': None, 'd': {'median': 1.0}}}
+    >>> compare(results, baseline)
+    {'a': {'peak_bytes': 2.0}, 'b': {'median': 3.0}}
+    """
+    regressions = {}
+    for name, result in results['results'].items():
+        _baseline = baseline['results'].get(name)
+        if not result or not _baseline:
+            continue
+        for key in (metric, 'peak_bytes'):
+            if key in result and _baseline.get(key):
+                ratio = result[key] / _baseline[key]
+                if ratio > threshold:
+                    regressions.setdefault(name, {})[key] = round(ratio, 2)
+    return regressions
+
+
+# Main -------------------------------------------------------------------------
+
+def run(context, names, repeat):
+    results = {}
+    for name in names:
+        log.info(f'benchmark {name}')
+        results[name] = BENCHMARKS[name](context, repeat)
+    return {
+        'meta': {
+            'datetime': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'romset': vars(context.romset),
+            'roms': sum(map(len, context.rom_data.archive.values())),
+            'archives': len(context.rom_data.archive),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def get_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description='''
+        Micro-benchmarks for hot paths against a deterministic synthetic romset
+        ''',
+    )
+
+    parser.add_argument('benchmarks', nargs='*', help=f'benchmarks to run (default all) {tuple(BENCHMARKS.keys())}')
+    parser.add_argument('--machines', action='store', type=int, default=5000, help='')
+    parser.add_argument('--bioss', action='store', type=int, default=20, help='')
+    parser.add_argument('--softwarelists', action='store', type=int, default=20, help='')
+    parser.add_argument('--software', action='store', type=int, default=5000, help='')
+    parser.add_argument('--seed', action='store', type=int, default=0, help='')
+    parser.add_argument('--repeat', action='store', type=int, default=5, help='')
+    parser.add_argument('--path', action='store', help='folder for generated dataset (default tempdir). Reused if it already exists')
+
+    parser.add_argument('--output', action='store', help='json results filename')
+    parser.add_argument('--baseline', action='store', help='json results from a previous run to compare against')
+    parser.add_argument('--threshold', action='store', type=float, default=1.25, help='ratio to baseline considered a regression')
+
+    parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stdout', default=logging.INFO)
+
+    kwargs = vars(parser.parse_args())
+    for name in kwargs['benchmarks']:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+    return kwargs
+
+
+def main(benchmarks, path, seed, repeat, output, baseline, threshold, **kwargs):
+    romset = SyntheticRomset(
+        machines=kwargs['machines'],
+        bioss=kwargs['bioss'],
+        softwarelists=kwargs['softwarelists'],
+        software=kwargs['software'],
+        seed=seed,
+    )
+    with tempfile.TemporaryDirectory() as tempdir:
+        context = BenchmarkContext(path or tempdir, romset)
+        if not context.roms_txt.exists():
+            os.makedirs(context.path, exist_ok=True)
+            context.generate()
+        results = run(context, benchmarks or tuple(BENCHMARKS.keys()), repeat)
+
+    for name, result in results['results'].items():
+        print(f'{name:20} ' + (f"{result['median']:10.4f}s" if result else 'skipped') + (f"  {result['peak_bytes']/1024/1024:8.1f}MB" if result and 'peak_bytes' in result else ''))
+    if output:
+        with open(output, 'wt') as filehandle:
+            json.dump(results, filehandle, indent=2)
+    if baseline:
+        with open(baseline, 'rt') as filehandle:
+            regressions = compare(results, json.load(filehandle), threshold)
+        for name, ratios in regressions.items():
+            log.error(f'regression {name} {ratios}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    kwargs = get_args()
+    logging.basicConfig(level=kwargs['log_level'])
+    main(**kwargs)
@@ -0,0 +1,267 @@
+import os
+import io
+import json
+import time
+import random
+import hashlib
+import tempfile
+import threading
+import socketserver
+from contextlib import redirect_stdout
+from wsgiref import simple_server
+
+import requests
+
+from benchmark.synthetic import SyntheticRomset
+from benchmark.benchmark import BenchmarkContext
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile
+
+    >>> percentile(range(1, 101), 50)
+    50
+    >>> percentile(range(1, 101), 99)
+    99
+    >>> percentile([3.0], 95)
+    3.0
+    >>> percentile([], 50)
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))]
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+SERVERS = {
+    'wsgiref': simple_server.WSGIServer,  # What the services run in production today
+    'threading': ThreadingWSGIServer,
+}
+
+
+def serve(app, server_class, host='127.0.0.1'):
+    """
+    Start `app` on an ephemeral port in a background thread - returns (url, httpd)
+    """
+    httpd = simple_server.make_server(host, 0, app, server_class=server_class, handler_class=_QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f'http://{host}:{httpd.server_port}', httpd
+
+
+# Dataset ----------------------------------------------------------------------
+
+class LoadTestContext(BenchmarkContext):
+    """
+    Extends the benchmark dataset with placeholder archive files (the catalog only scans names/mtimes)
+    and a pre-populated `catalog.txt` so `/verify` has realistic (missing/unknown) work
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.catalog_txt = self.path.joinpath('catalog.txt')
+        self.mtimes_txt = self.path.joinpath('mtimes.txt')
+        self.archives = {}
+
+    def generate(self):
+        log.info(f'Generating synthetic dataset in {self.path}')
+        with open(self.roms_txt, 'wt') as filehandle:
+            self.romset.write_roms_txt(filehandle)
+        _random = random.Random(self.romset.seed)
+        with open(self.catalog_txt, 'wt') as filehandle:
+            for archive_name, files in self.romset.iter_archive_files():
+                if _random.random() < 0.1:
+                    files['readme.txt'] = archive_name.encode('utf8')
+                self.archives[archive_name] = {
+                    hashlib.sha1(data).hexdigest(): file_name
+                    for file_name, data in files.items()
+                    if _random.random() > 0.05
+                }
+                for sha1, file_name in self.archives[archive_name].items():
+                    filehandle.write(f'{sha1} {archive_name}:{file_name}\n')
+                filename = self.collection.joinpath(f'{archive_name}.7z')
+                filename.parent.mkdir(parents=True, exist_ok=True)
+                filename.touch()
+        return self
+
+
+# Traffic ----------------------------------------------------------------------
+
+class Recorder():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.errors = {}
+    def record(self, name, seconds, ok=True):
+        with self.lock:
+            self.latency.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+    def timed(self, name, func):
+        start = time.perf_counter()
+        try:
+            ok = func().status_code < 500
+        except requests.RequestException:
+            ok = False
+        self.record(name, time.perf_counter() - start, ok)
+    def report(self, duration):
+        return {
+            name: {
+                'requests': len(latency),
+                'errors': self.errors.get(name, 0),
+                'throughput': len(latency) / duration,
+                'p50': percentile(latency, 50),
+                'p95': percentile(latency, 95),
+                'p99': percentile(latency, 99),
+            }
+            for name, latency in sorted(self.latency.items())
+        }
+
+
+DEFAULT_MIX = {
+    'romdata_sha1': 30,
+    'romdata_sets': 20,
+    'verify': 30,
+    'catalog_archive': 20,
+}
+
+def client(urls, context, mix, recorder, stop, seed):
+    _random = random.Random(seed)
+    session = requests.Session()
+    sha1s = tuple(context.rom_data.sha1.keys())
+    archive_names = tuple(context.archives.keys())
+    requests_by_name = {
+        'romdata_sha1': lambda: session.get(f"{urls['romdata']}/sha1/{_random.choice(sha1s)}"),
+        'romdata_sets': lambda: session.get(f"{urls['romdata']}/sets", json=context.sample_sha1s(count=5, seed=_random.random())),
+        'verify': lambda: session.get(f"{urls['verify']}/verify/{_random.choice(archive_names)}"),
+        'catalog_archive': lambda: session.get(f"{urls['catalog']}/archive/{_random.choice(archive_names)}"),
+    }
+    names, weights = zip(*mix.items())
+    while not stop.is_set():
+        name = _random.choices(names, weights)[0]
+        recorder.timed(name, requests_by_name[name])
+
+def fake_worker(urls, context, recorder, stop, hash_seconds):
+    """
+    Claim `/next_file` and post back the known roms for the archive - no real extraction/hashing
+    """
+    session = requests.Session()
+    while not stop.is_set():
+        response = {}
+        def _next_file():
+            nonlocal response
+            _response = session.get(f"{urls['catalog']}/next_file")
+            response = _response.json()
+            return _response
+        recorder.timed('catalog_next_file', _next_file)
+        if not response.get('file'):
+            stop.wait(0.1)
+            continue
+        stop.wait(hash_seconds)
+        archive_name = os.path.splitext(response['file'])[0]
+        recorder.timed('catalog_ingest', lambda: session.post(f"{urls['catalog']}/archive/{response['file']}", json={
+            'mtime': str(time.time()),
+            'roms': [
+                dict(sha1=sha1, archive_name=archive_name, file_name=file_name)
+                for sha1, file_name in context.archives.get(archive_name, {}).items()
+            ],
+        }))
+
+
+def run(urls, context, clients, workers, duration, mix, hash_seconds=0.01, seed=0):
+    context.rom_data  # load before threads start - `redirect_stdout` is not thread safe
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=client, args=(urls, context, mix, recorder, stop, seed + i), daemon=True)
+        for i in range(clients)
+    ] + [
+        threading.Thread(target=fake_worker, args=(urls, context, recorder, stop, hash_seconds), daemon=True)
+        for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    stop.wait(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return recorder.report(duration)
+
+
+# Main -------------------------------------------------------------------------
+
+def start_services(context, server_class):
+    from romdata.romdata import create_wsgi_app as create_wsgi_app_romdata
+    from catalog.catalog import create_wsgi_app as create_wsgi_app_catalog
+    from verify.verify import create_wsgi_app as create_wsgi_app_verify
+    urls = {}
+    with redirect_stdout(io.StringIO()):
+        urls['romdata'], _ = serve(create_wsgi_app_romdata(str(context.roms_txt)), server_class)
+        urls['catalog'], _ = serve(create_wsgi_app_catalog(
+            rom_path=str(context.collection),
+            catalog_data_filename=str(context.catalog_txt),
+            catalog_mtime_filename=str(context.mtimes_txt),
+        ), server_class)
+    urls['verify'], _ = serve(create_wsgi_app_verify(url_api_romdata=urls['romdata'], url_api_catalog=urls['catalog']), server_class)
+    return urls
+
+
+def get_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description='''
+        Start romdata, catalog and verify against a synthetic dataset and replay a traffic mix.
+        Reports throughput and p50/p95/p99 latency per request type
+        ''',
+    )
+
+    parser.add_argument('--machines', action='store', type=int, default=5000, help='')
+    parser.add_argument('--software', action='store', type=int, default=5000, help='')
+    parser.add_argument('--seed', action='store', type=int, default=0, help='')
+
+    parser.add_argument('--server', action='store', choices=tuple(SERVERS.keys()), default='wsgiref', help='wsgi server mode to test')
+    parser.add_argument('--clients', action='store', type=int, default=8, help='concurrent read clients')
+    parser.add_argument('--workers', action='store', type=int, default=2, help='fake catalog workers ingesting')
+    parser.add_argument('--hash_seconds', action='store', type=float, default=0.01, help='simulated time a fake worker spends hashing an archive')
+    parser.add_argument('--duration', action='store', type=float, default=30, help='seconds')
+    parser.add_argument('--mix', action='store', type=json.loads, default=DEFAULT_MIX, help=f'json weights {DEFAULT_MIX}')
+
+    parser.add_argument('--output', action='store', help='json results filename')
+    parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stdout', default=logging.WARNING)
+
+    kwargs = vars(parser.parse_args())
+    return kwargs
+
+
+def main(machines, software, seed, server, clients, workers, hash_seconds, duration, mix, output, **kwargs):
+    romset = SyntheticRomset(machines=machines, software=software, seed=seed)
+    with tempfile.TemporaryDirectory() as tempdir:
+        context = LoadTestContext(tempdir, romset).generate()
+        urls = start_services(context, SERVERS[server])
+        report = run(urls, context, clients=clients, workers=workers, duration=duration, mix=mix, hash_seconds=hash_seconds, seed=seed)
+
+    print(f"{'':20} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for name, result in report.items():
+        print(f"{name:20} {result['requests']:9} {result['errors']:7} {result['throughput']:8.1f} " + ' '.join(
+            f'{result[p]*1000:6.1f}ms' for p in ('p50', 'p95', 'p99')
+        ))
+    if output:
+        with open(output, 'wt') as filehandle:
+            json.dump({'server': server, 'clients': clients, 'workers': workers, 'duration': duration, 'mix': mix, 'results': report}, filehandle, indent=2)
+
+
+if __name__ == '__main__':
+    kwargs = get_args()
+    logging.basicConfig(level=kwargs['log_level'])
+    main(**kwargs)
@@ -0,0 +1,231 @@
+import os
+import random
+import hashlib
+import zlib
+from itertools import chain
+from xml.sax.saxutils import quoteattr
+
+from _common.roms import Rom
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class SyntheticRom():
+    r"""
+    Deterministic rom content - the same `seed` and `name` always produce the same bytes (and so the same sha1)
+
+    >>> rom = SyntheticRom(seed=0, name='sfa3/sz3.01', size=8)
+    >>> rom.data
+    b'0:sfa3/s'
+    >>> rom.sha1 == hashlib.sha1(rom.data).hexdigest()
+    True
+    >>> len(SyntheticRom(seed=0, name='a', size=100).data)
+    100
+    """
+    def __init__(self, seed, name, size):
+        self.name = name
+        _block = f'{seed}:{name}:'.encode('utf8')
+        self.data = (_block * (size // len(_block) + 1))[:size]
+    @property
+    def sha1(self):
+        return hashlib.sha1(self.data).hexdigest()
+    @property
+    def crc(self):
+        return f'{zlib.crc32(self.data):08x}'
+    def xml_attrs(self, name, **kwargs):
+        return ' '.join(
+            f'{k}={quoteattr(str(v))}'
+            for k, v in dict(name=name, size=len(self.data), crc=self.crc, sha1=self.sha1, **kwargs).items()
+        )
+
+
+class SyntheticRomset():
+    r"""
+    Generator for large synthetic `-listxml`/softlist xml, `roms.txt` and rom collections
+
+    The shape (bios/parent/clone/merge) mirrors real mame output so the parsers take the same code paths
+
+    >>> romset = SyntheticRomset(machines=6, bioss=1, softwarelists=1, software=3, seed=1)
+    >>> import io
+    >>> mame_xml = io.BytesIO()
+    >>> romset.write_mame_xml(mame_xml)
+    >>> b'isbios="yes"' in mame_xml.getvalue() and b'cloneof=' in mame_xml.getvalue()
+    True
+
+    >>> from romdata.parse_mame_xml import iter_mame, iter_software
+    >>> roms = tuple(iter_mame(lambda: io.BytesIO(mame_xml.getvalue())))
+    >>> len(roms) == len(set(roms))
+    True
+
+    Generation is deterministic
+    >>> mame_xml2 = io.BytesIO()
+    >>> SyntheticRomset(machines=6, bioss=1, softwarelists=1, software=3, seed=1).write_mame_xml(mame_xml2)
+    >>> mame_xml.getvalue() == mame_xml2.getvalue()
+    True
+
+    >>> software_xml = io.BytesIO()
+    >>> romset.write_software_xml(software_xml)
+    >>> tuple(iter_software(lambda: io.BytesIO(software_xml.getvalue())))[0].archive_name
+    'softlist0/software0'
+
+    >>> roms_txt = io.StringIO()
+    >>> romset.write_roms_txt(roms_txt)
+    >>> Rom.parse(roms_txt.getvalue().split('\n')[0]).archive_name
+    'bios0'
+    """
+    def __init__(self, machines=1000, bioss=10, softwarelists=10, software=1000, roms_per_set=(2, 12), rom_size=(64, 1024), clone_ratio=0.4, seed=0):
+        self.machines = machines
+        self.bioss = bioss
+        self.softwarelists = softwarelists
+        self.software = software
+        self.roms_per_set = roms_per_set
+        self.rom_size = rom_size
+        self.clone_ratio = clone_ratio
+        self.seed = seed
+
+    def _random(self, *names):
+        return random.Random(':'.join(map(str, (self.seed, *names))))
+
+    def _roms(self, set_name):
+        _random = self._random(set_name)
+        return tuple(
+            SyntheticRom(self.seed, f'{set_name}/{set_name}_{i}.bin', _random.randint(*self.rom_size))
+            for i in range(_random.randint(*self.roms_per_set))
+        )
+
+    def _machine_names(self):
+        return tuple(f'bios{i}' for i in range(self.bioss)), tuple(f'machine{i}' for i in range(self.machines))
+
+    def _iter_machine_xml(self):
+        bioss, machines = self._machine_names()
+        for bios in bioss:
+            yield f'\t<machine name="{bios}" isbios="yes">\n'
+            for rom in self._roms(bios):
+                yield f'\t\t<rom {rom.xml_attrs(os.path.basename(rom.name), bios="bios0")}/>\n'
+            yield '\t</machine>\n'
+        parent = None
+        for index, machine in enumerate(machines):
+            _random = self._random(machine)
+            bios = bioss[index % len(bioss)] if bioss and _random.random() < 0.5 else None
+            is_clone = parent and _random.random() < self.clone_ratio
+            attrs = f'name="{machine}"'
+            if is_clone:
+                attrs += f' cloneof="{parent}" romof="{parent}"'
+            elif bios:
+                attrs += f' romof="{bios}"'
+            yield f'\t<machine {attrs}>\n'
+            if bios and not is_clone:
+                for rom in self._roms(bios):
+                    name = os.path.basename(rom.name)
+                    yield f'\t\t<rom {rom.xml_attrs(name, merge=name)}/>\n'
+            if is_clone:
+                for rom in self._roms(parent):
+                    name = os.path.basename(rom.name)
+                    yield f'\t\t<rom {rom.xml_attrs(name, merge=name)}/>\n'
+            for rom in self._roms(machine):
+                yield f'\t\t<rom {rom.xml_attrs(os.path.basename(rom.name))}/>\n'
+            if _random.random() < 0.05:
+                yield f'\t\t<rom name="{machine}_nodump.bin" status="nodump"/>\n'
+            yield '\t</machine>\n'
+            if not is_clone:
+                parent = machine
+
+    def write_mame_xml(self, filehandle):
+        filehandle.write(b'<?xml version="1.0"?>\n<mame build="synthetic" debug="no" mameconfig="10">\n')
+        for line in self._iter_machine_xml():
+            filehandle.write(line.encode('utf8'))
+        filehandle.write(b'</mame>\n')
+
+    def _iter_software_xml(self):
+        for softwarelist_index in range(self.softwarelists):
+            softwarelist = f'softlist{softwarelist_index}'
+            yield f'\t<softwarelist name="{softwarelist}" description="Synthetic {softwarelist}">\n'
+            parent = None
+            for software_index in range(self.software // max(self.softwarelists, 1)):
+                software = f'software{software_index}'
+                is_clone = parent and self._random(softwarelist, software).random() < self.clone_ratio
+                yield f'\t\t<software name="{software}"{f" cloneof={quoteattr(parent)}" if is_clone else ""}>\n'
+                yield '\t\t\t<part name="cart" interface="synthetic_cart">\n\t\t\t\t<dataarea name="rom">\n'
+                for rom in self._roms(f'{softwarelist}_{software}'):
+                    yield f'\t\t\t\t\t<rom {rom.xml_attrs(os.path.basename(rom.name))}/>\n'
+                yield '\t\t\t\t</dataarea>\n\t\t\t</part>\n\t\t</software>\n'
+                if not is_clone:
+                    parent = software
+            yield '\t</softwarelist>\n'
+
+    def write_software_xml(self, filehandle):
+        filehandle.write(b'<?xml version="1.0"?>\n<softwarelists>\n')
+        for line in self._iter_software_xml():
+            filehandle.write(line.encode('utf8'))
+        filehandle.write(b'</softwarelists>\n')
+
+    def iter_roms(self):
+        """
+        The `Rom` stream the real parser produces for this synthetic data
+        """
+        import io
+        from romdata.parse_mame_xml import iter_mame, iter_software
+        mame_xml = io.BytesIO()
+        self.write_mame_xml(mame_xml)
+        software_xml = io.BytesIO()
+        self.write_software_xml(software_xml)
+        return chain(
+            iter_mame(lambda: io.BytesIO(mame_xml.getvalue())),
+            iter_software(lambda: io.BytesIO(software_xml.getvalue())),
+        )
+
+    def write_roms_txt(self, filehandle):
+        for rom in self.iter_roms():
+            filehandle.write(f'{rom}\n')
+
+    def iter_archive_files(self):
+        """
+        yield (archive_name, {file_name: bytes}) for every romset
+        Clone/bios layout follows the merged `iter_mame`/`iter_software` output
+        """
+        data = {
+            rom.sha1: rom.data
+            for set_name in chain(*self._machine_names())
+            for rom in self._roms(set_name)
+        }
+        data.update({
+            rom.sha1: rom.data
+            for softwarelist_index in range(self.softwarelists)
+            for software_index in range(self.software // max(self.softwarelists, 1))
+            for rom in self._roms(f'softlist{softwarelist_index}_software{software_index}')
+        })
+        archives = {}
+        for rom in self.iter_roms():
+            archives.setdefault(rom.archive_name, {})[rom.file_name] = data[rom.sha1]
+        yield from archives.items()
+
+    def write_collection(self, path, compress=None, missing_ratio=0.05, unknown_ratio=0.05):
+        """
+        Write a rom collection to `path`
+        `compress` is a callable(cwd, files, destination_file) e.g. `P7Zip().compress`. When None the raw files are written to folders (enough for `fast_scan`)
+        A proportion of files are dropped (missing) and junk files added (unknown) so verify has realistic work
+        """
+        import tempfile
+        _random = self._random('collection')
+        for archive_name, files in self.iter_archive_files():
+            files = {
+                file_name: data
+                for file_name, data in files.items()
+                if _random.random() >= missing_ratio
+            }
+            if _random.random() < unknown_ratio:
+                files['readme.txt'] = f'{archive_name} {self.seed}'.encode('utf8')
+            if not files:
+                continue
+            with tempfile.TemporaryDirectory() as tempdir:
+                _path = tempdir if compress else os.path.join(path, archive_name)
+                for file_name, data in files.items():
+                    filename = os.path.join(_path, file_name)
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                    with open(filename, 'wb') as filehandle:
+                        filehandle.write(data)
+                if compress:
+                    destination_file = os.path.abspath(os.path.join(path, f'{archive_name}.7z'))
+                    os.makedirs(os.path.dirname(destination_file), exist_ok=True)
+                    compress(cwd=tempdir, files=tuple(files.keys()), destination_file=destination_file)
@@ -2,30 +2,65 @@ import os
 import datetime
 import logging
 import re
+import uuid
+import time
+import threading
 from functools import reduce
+from itertools import chain, islice
+from collections import deque
+from typing import NamedTuple
 from pathlib import Path
 
 import falcon
+import requests
 
-from _common.scan import fast_scan
+from _common.scan import fast_scan, FileScan
 from _common.roms import RomData, Rom
-from _common.falcon_helpers import add_sink, func_path_normalizer_no_extension
+from _common.search import SearchResource
+from _common.shard import Shard, add_shard_args, DEFAULT_FILTER
+from _common.duplicates import iter_duplicates, summarise, expected_from_romdata_api
+from _common.dat import iter_dat, DAT_FORMATS
+from _common.stats import RomdataStats, ShardPresence, report
+from _common.falcon_helpers import MEDIA_SHA1, add_sink, func_path_normalizer_no_extension, update_media_handlers, respond_index, stream_json_array
+from _common.profiling import add_profiling, add_profile_args
+from _common.metrics import add_metrics
 
 
 log = logging.getLogger(__name__)
 
 FILE_RESCAN_SECONDS = 60
+CLAIM_TIMEOUT_SECONDS = 15 * 60  # a claim not renewed (`POST /claim/`), posted or failed by then is assumed lost with its worker
+CHANGE_LOG_SIZE = 100000
+
+
+class Change(NamedTuple):
+    sequence: int
+    op: str  # 'replace' or 'remove'
+    archive_name: str
+    roms: tuple = ()
+    def asdict(self):
+        return {**self._asdict(), 'roms': tuple(map(str, self.roms))}
+    @staticmethod
+    def parse(change):
+        return Change(**{**change, 'roms': tuple(filter(None, map(Rom.parse, change['roms'])))})
 
 
 class CatalogData(RomData):
-    def __init__(self, catalog_data_filename, catalog_mtime_filename):
+    """
+    Every change is numbered with `sequence` and held in a bounded `changes` log so read replicas can follow the primary
+    `epoch` identifies this process - sequence numbers restart with it
+    """
+    def __init__(self, catalog_data_filename, catalog_mtime_filename=None):
         super().__init__(catalog_data_filename, readonly=False)
+        self.sequence = 0
+        self.epoch = uuid.uuid4().hex
+        self.changes = deque(maxlen=CHANGE_LOG_SIZE)
         self.catalog_data_filename = catalog_data_filename
         self.catalog_mtime_filename = catalog_mtime_filename
         self._open_mtime()
     def _open_mtime(self):
         self.mtime = {}
-        if not os.path.isfile(self.catalog_mtime_filename):
+        if not self.catalog_mtime_filename or not os.path.isfile(self.catalog_mtime_filename):
             return
         with open(self.catalog_mtime_filename, 'r') as filehandle:
             for line in filehandle:
@@ -35,6 +70,8 @@ class CatalogData(RomData):
         """
         Save state of in memory object back to disk
         """
+        if not isinstance(self.catalog_data_filename, str):
+            return  # replica - bootstrapped from the primary
         log.info('Saving catalog_data in memory to disk')
         with open(self.catalog_data_filename, 'w') as filehandle:
             for count, rom in enumerate(
@@ -48,48 +85,159 @@ class CatalogData(RomData):
         with open(self.catalog_mtime_filename, 'w') as filehandle:
             for archive_name, mtime in self.mtime.items():
                     filehandle.write(f'{archive_name}:{mtime}\n')
+    def _log(self, op, archive_name, roms=()):
+        self.sequence += 1
+        self.changes.append(Change(self.sequence, op, archive_name, tuple(roms)))
+    def _remove(self, archive_name):
+        for rom in self.archive.pop(archive_name, ()):
+            _roms_with_sha1 = self.sha1.get(rom.sha1, set())
+            _roms_with_sha1.discard(rom)
+            if not _roms_with_sha1:
+                self.sha1.pop(rom.sha1, None)
+    def _replace(self, archive_name, roms):
+        self._remove(archive_name)
+        self.archive[archive_name] = roms
+        for rom in roms:
+            self.sha1.setdefault(rom.sha1, set()).add(rom)
     def remove(self, archive_name):
-        raise NotImplementedError()
+        self._remove(archive_name)
+        self.mtime.pop(archive_name, None)
+        self._log('remove', archive_name)
     def remove_rom(self, rom):
         """
         TODO: doctest
         """
-        _roms_with_sha1 = self.sha1.get(rom.sha1)
-        _roms_with_sha1.discard({r for r in _roms_with_sha1 if r.archive_name == rom.archive_name})
-        _roms_from_archive_name = self.archive.get(rom.archive_name)
-        _roms_from_archive_name.discard({r for r in _roms_from_archive_name if r.sha1 == rom.sha1})
+        self.sha1.get(rom.sha1, set()).discard(rom)
+        self.archive.get(rom.archive_name, set()).discard(rom)
     def replace_roms(self, roms):
         """
-        TODO: doctest
+        >>> import tempfile
+        >>> tempdir = tempfile.TemporaryDirectory()
+        >>> catalog_data = CatalogData(os.path.join(tempdir.name, 'catalog.txt'), os.path.join(tempdir.name, 'mtimes.txt'))
+        >>> catalog_data.replace_roms((Rom('0'*40, 'sfa3', 'a.bin'), Rom('1'*40, 'sfa3', 'b.bin'), Rom('0'*40, 'sfa3u', 'a.bin')))
+        >>> sorted(rom.archive_name for rom in catalog_data.sha1['0'*40])
+        ['sfa3', 'sfa3u']
+        >>> catalog_data.replace_roms((Rom('2'*40, 'sfa3', 'c.bin'), ))
+        >>> sorted(catalog_data.sha1.keys()) == ['0'*40, '2'*40]
+        True
+        >>> catalog_data.remove('sfa3u')
+        >>> sorted(catalog_data.sha1.keys()) == ['2'*40]
+        True
+        >>> tempdir.cleanup()
         """
         def _group_roms_by_archive_name(acc, rom):
             acc.setdefault(rom.archive_name, set()).add(rom)
             return acc
         for archive_name, roms in reduce(_group_roms_by_archive_name, roms, {}).items():
-            _old_roms = self.archive.get(archive_name, ())
-            self.archive[archive_name] = roms
-            for _old_rom in _old_roms:
-                _roms_with_sha1 = self.sha1.get(_old_rom.sha1)
-                _roms_with_sha1.discard({r for r in _roms_with_sha1 if r.archive_name == archive_name})
+            self._replace(archive_name, roms)
+            self._log('replace', archive_name, roms)
+
+    # Replication
+
+    def changes_since(self, sequence):
+        """
+        Ordered changes after `sequence` - None if they are no longer held (the follower must re-snapshot)
+
+        >>> catalog_data = CatalogData(iter(()))
+        <BLANKLINE>
+        >>> catalog_data.replace_roms((Rom('0'*40, 'sfa3', 'a.bin'), Rom('1'*40, 'sfa2', 'b.bin')))
+        >>> catalog_data.remove('sfa2')
+        >>> [(change.sequence, change.op, change.archive_name) for change in catalog_data.changes_since(1)]
+        [(2, 'replace', 'sfa2'), (3, 'remove', 'sfa2')]
+        >>> catalog_data.changes_since(3)
+        ()
+        >>> catalog_data.changes_since(4)
+
+        >>> replica = CatalogData(iter(()))
+        <BLANKLINE>
+        >>> replica.apply_snapshot(iter(()), sequence=0, epoch=catalog_data.epoch)
+        <BLANKLINE>
+        >>> replica.apply_changes(catalog_data.changes_since(0))
+        >>> replica.sequence, sorted(replica.archive.keys()), sorted(replica.sha1.keys()) == ['0'*40]
+        (3, ['sfa3'], True)
+        """
+        if sequence > self.sequence:
+            return None
+        if sequence == self.sequence:
+            return ()
+        if not self.changes or self.changes[0].sequence > sequence + 1:
+            return None
+        return tuple(islice(self.changes, sequence + 1 - self.changes[0].sequence, None))
+    def iter_snapshot(self):
+        """
+        (sequence, lines) consistent at call time. Archive rom sets are replaced rather than mutated so holding the values is enough
+        """
+        archives = tuple(self.archive.values())
+        return self.sequence, (f'{rom}\n' for roms in archives for rom in roms)
+    def apply_snapshot(self, lines, sequence, epoch):
+        """
+        Load a snapshot alongside the current data and swap it in - readers never see a partial catalog
+        """
+        snapshot = RomData(lines, readonly=False)
+        self.changes.clear()
+        self.sha1, self.archive = snapshot.sha1, snapshot.archive
+        self.sequence = sequence
+        self.epoch = epoch
+    def apply_changes(self, changes):
+        """
+        Each batch is applied to copies that are swapped in (like `apply_snapshot`) - request threads iterating
+        `sha1`/`archive` never see a dict or rom set change underneath them, or a half applied batch
+
+        >>> replica = CatalogData(iter(()))
+        <BLANKLINE>
+        >>> replica.apply_changes((Change(1, 'replace', 'sfa3', (Rom('0'*40, 'sfa3', 'a.bin'), )), ))
+        >>> sha1, roms = replica.sha1, replica.sha1['0'*40]
+        >>> replica.apply_changes((Change(2, 'replace', 'sfa3u', (Rom('0'*40, 'sfa3u', 'a.bin'), )), Change(3, 'remove', 'sfa3')))
+        >>> len(sha1), len(roms), sorted(rom.archive_name for rom in replica.sha1['0'*40])
+        (1, 1, ['sfa3u'])
+        """
+        if not changes:
+            return
+        sha1, archive = dict(self.sha1), dict(self.archive)
+        copied = set()
+        def _roms_with_sha1(key):
+            if key not in copied:
+                sha1[key] = set(sha1.get(key, ()))
+                copied.add(key)
+            return sha1[key]
+        for change in changes:
+            for rom in archive.pop(change.archive_name, ()):
+                _roms = _roms_with_sha1(rom.sha1)
+                _roms.discard(rom)
+                if not _roms:
+                    del sha1[rom.sha1]
+                    copied.discard(rom.sha1)
+            if change.op == 'replace':
+                archive[change.archive_name] = set(change.roms)
+                for rom in change.roms:
+                    _roms_with_sha1(rom.sha1).add(rom)
+        self.sha1, self.archive = sha1, archive
+        for change in changes:
+            self.sequence = change.sequence - 1
+            self._log(change.op, change.archive_name, change.roms)
 
 
 
 # Resources --------------------------------------------------------------------
 
 class IndexResource():
-    def __init__(self, catalog_data):
+    def __init__(self, catalog_data, shard=None):
         self.catalog_data = catalog_data
+        self.shard = shard or Shard()
     def on_get(self, request, response):
         response.media = {
             'sha1': len(self.catalog_data.sha1.keys()),
             'archive': len(self.catalog_data.archive.keys()),
+            'shard': {'index': self.shard.index, 'count': self.shard.count, 'by': self.shard.by},
         }
         response.status = falcon.HTTP_200
 
 
 class ArchiveResource():
-    def __init__(self, catalog_data):
+    def __init__(self, catalog_data, readonly=False, on_catalogued=None):
         self.catalog_data = catalog_data
+        self.readonly = readonly
+        self.on_catalogued = on_catalogued
     def _sink(self, request, response):
         """
         """
@@ -99,8 +247,8 @@ class ArchiveResource():
             return self.on_index(request, response)  # This is really bad - my implementation of sink is horrible
         return getattr(self, f'on_{request.method.lower()}')(request, response, archive_name)
     def on_index(self, request, response):
-        response.media = tuple(self.catalog_data.archive.keys())
-        response.status = falcon.HTTP_200
+        archive_names = tuple(self.catalog_data.archive.keys())  # snapshot - the catalog can change while streaming
+        respond_index(request, response, iter(archive_names), len(archive_names))
     def on_get(self, request, response, archive_name):
         """
         TODO: I don't like the return - multiple archives?
@@ -117,67 +265,440 @@ class ArchiveResource():
             #}
         }
     def on_post(self, request, response, archive_name):
-        raise NotImplementedError()
+        if self.readonly:
+            raise falcon.HTTPMethodNotAllowed(('GET', ), description='read replica - post to the primary')
         self.catalog_data.replace_roms(Rom(**rom_dict) for rom_dict in request.media['roms'])
         self.catalog_data.mtime[archive_name] = request.media['mtime']
+        if self.on_catalogued:
+            self.on_catalogued(archive_name)
+        response.status = falcon.HTTP_200
+
+
+class DuplicatesResource():
+    """
+    GET /duplicates                     every sha1 held in more than one archive (streamed)
+    GET /duplicates?unexpected=true     only duplication romdata does not expect (needs `--url_api_romdata`)
+    GET /duplicates?summary=true        totals only
+    """
+    def __init__(self, catalog_data, get_expected=None):
+        self.catalog_data = catalog_data
+        self.get_expected = get_expected
+    def on_get(self, request, response):
+        reports = iter_duplicates(
+            self.catalog_data.sha1,
+            get_expected=self.get_expected,
+            unexpected_only=request.get_param_as_bool('unexpected', default=False),
+        )
+        if request.get_param_as_bool('summary', default=False):
+            response.media = summarise(reports)
+        else:
+            response.content_type = falcon.MEDIA_JSON
+            response.stream = stream_json_array(reports)
+        response.status = falcon.HTTP_200
+
+
+class StatsResource():
+    """
+    GET /stats                                          collection matched/misplaced/missing/unknown rom counts against romdata
+    GET /stats?by=group                                 per softlist/DAT tag ('' is MAME machines)
+    GET /stats?by=archive&group=sms&incomplete=true     per archive
+    `?layout=` compares against another romdata archive layout
+    Counts are recomputed when the catalog changes, at most every `rebuild_seconds` - reports come from the cached counts
+    A shard reports on the romdata archives it owns. `shard_presence` (the other shards sha1s) lets roms misplaced into
+    another shard count as misplaced - without it they count as missing
+    """
+    BY = ('collection', 'group', 'archive')
+    def __init__(self, catalog_data, romdata_stats, shard_presence=None, rebuild_seconds=10):
+        self.catalog_data = catalog_data
+        self.romdata_stats = romdata_stats
+        self.shard_presence = shard_presence
+        self.rebuild_seconds = rebuild_seconds
+        self.lock = threading.Lock()
+        self._counts = {}
+    def counts(self, layout=None):
+        stats = self.romdata_stats.get(layout)
+        present_elsewhere = self.shard_presence.get() if self.shard_presence else None
+        with self.lock:
+            _stats, _present_elsewhere, sequence, _time, counts = self._counts.get(layout, (None, None, None, 0, None))
+            if _stats is not stats or _present_elsewhere is not present_elsewhere or (sequence != self.catalog_data.sequence and time.time() - _time > self.rebuild_seconds):
+                sequence = self.catalog_data.sequence
+                counts = stats.counts(dict(self.catalog_data.archive), present_elsewhere=present_elsewhere)
+                self._counts[layout] = (stats, present_elsewhere, sequence, time.time(), counts)
+            return counts
+    def on_get(self, request, response):
+        by = request.get_param('by', default='collection')
+        if by not in self.BY:
+            raise falcon.HTTPBadRequest(description=f'{by=} not in {self.BY}')
+        response.media = report(
+            self.counts(request.get_param('layout')),
+            by=by,
+            group=request.get_param('group'),
+            incomplete=request.get_param_as_bool('incomplete', default=False),
+        )
+        response.status = falcon.HTTP_200
+
+
+class SHA1sResource():
+    """
+    GET /sha1s      every catalogued sha1 as concatenated raw 20 byte sha1s (`MEDIA_SHA1`) - other shards `/stats` presence
+    """
+    def __init__(self, catalog_data):
+        self.catalog_data = catalog_data
+    def on_get(self, request, response):
+        response.content_type = MEDIA_SHA1
+        response.data = bytes.fromhex(''.join(tuple(self.catalog_data.sha1.keys())))
+        response.status = falcon.HTTP_200
+
+
+class DatResource():
+    """
+    GET /dat?format=logiqx|clrmamepro&prefix=nes/     the catalogued collection as a datafile for other rom managers (streamed)
+    """
+    def __init__(self, catalog_data):
+        self.catalog_data = catalog_data
+    def on_get(self, request, response):
+        format = request.get_param('format', default=DAT_FORMATS[0])
+        if format not in DAT_FORMATS:
+            raise falcon.HTTPBadRequest(description=f'format must be one of {DAT_FORMATS}')
+        prefix = request.get_param('prefix', default='')
+        archive_names = sorted(name for name in tuple(self.catalog_data.archive.keys()) if name.startswith(prefix))
+        archives = (
+            (archive_name, roms)
+            for archive_name, roms in ((archive_name, self.catalog_data.archive.get(archive_name)) for archive_name in archive_names)
+            if roms
+        )
+        name = f"catalog{'-' + prefix.strip('/').replace('/', '-') if prefix else ''}"
+        response.content_type = 'application/xml' if format == 'logiqx' else falcon.MEDIA_TEXT
+        response.set_header('Content-Disposition', f'attachment; filename="{name}.dat"')
+        response.stream = (chunk.encode('utf8') for chunk in iter_dat(archives, format=format, name=name))
+        response.status = falcon.HTTP_200
+
+
+class ReplicationResource():
+    """
+    GET /replication/snapshot               `catalog.txt` lines - `X-Catalog-Sequence`/`X-Catalog-Epoch` headers
+    GET /replication/changes?since=N&epoch= ordered changes after N. 410 Gone when the follower must re-snapshot
+    """
+    def __init__(self, catalog_data):
+        self.catalog_data = catalog_data
+    def on_get_snapshot(self, request, response):
+        sequence, lines = self.catalog_data.iter_snapshot()
+        response.set_header('X-Catalog-Sequence', str(sequence))
+        response.set_header('X-Catalog-Epoch', self.catalog_data.epoch)
+        response.content_type = falcon.MEDIA_TEXT
+        response.stream = (''.join(chunk).encode('utf8') for chunk in iter(lambda: tuple(islice(lines, 1000)), ()))
         response.status = falcon.HTTP_200
+    def on_get_changes(self, request, response):
+        since = request.get_param_as_int('since', required=True, min_value=0)
+        limit = request.get_param_as_int('limit', default=1000, min_value=1)
+        changes = None
+        if request.get_param('epoch', default=self.catalog_data.epoch) == self.catalog_data.epoch:
+            changes = self.catalog_data.changes_since(since)
+        if changes is None:
+            raise falcon.HTTPGone(description=f'changes after {since=} are not available - re-snapshot')
+        response.media = {
+            'epoch': self.catalog_data.epoch,
+            'sequence': self.catalog_data.sequence,
+            'changes': tuple(change.asdict() for change in changes[:limit]),
+        }
+        response.status = falcon.HTTP_200
+
+
+class CatalogFollower():
+    """
+    Keep a read replica `CatalogData` up to date - bootstrap from the primary snapshot then follow the change feed
+    """
+    def __init__(self, catalog_data, url_primary, poll_seconds=5):
+        self.catalog_data = catalog_data
+        self.url_primary = url_primary
+        self.poll_seconds = poll_seconds
+    def snapshot(self):
+        log.info(f'Replica snapshot from {self.url_primary}')
+        response = requests.get(f'{self.url_primary}/replication/snapshot', stream=True)
+        response.raise_for_status()
+        self.catalog_data.apply_snapshot(
+            response.iter_lines(decode_unicode=True),
+            sequence=int(response.headers['X-Catalog-Sequence']),
+            epoch=response.headers['X-Catalog-Epoch'],
+        )
+    def poll(self):
+        response = requests.get(f'{self.url_primary}/replication/changes', params={
+            'since': self.catalog_data.sequence,
+            'epoch': self.catalog_data.epoch,
+        })
+        if response.status_code == 410:
+            self.snapshot()
+            return 0
+        response.raise_for_status()
+        changes = tuple(map(Change.parse, response.json()['changes']))
+        self.catalog_data.apply_changes(changes)
+        return len(changes)
+    def run(self):
+        while True:
+            try:
+                if self.poll():
+                    continue  # Catching up - don't wait
+            except requests.RequestException as ex:
+                log.warning(f'Replica unable to reach primary - {ex}')
+            time.sleep(self.poll_seconds)
+    def start(self):
+        self.snapshot()
+        threading.Thread(target=self.run, daemon=True, name='catalog_follower').start()
+        return self
 
 
 class NextUntrackedFileResource():
-    def __init__(self, path, catalog_data):
+    """
+    >>> import tempfile, pathlib
+    >>> tempdir = tempfile.TemporaryDirectory()
+    >>> pathlib.Path(tempdir.name, 'sfa3.7z').touch()
+    >>> resource = NextUntrackedFileResource(tempdir.name, CatalogData(iter(())))
+    <BLANKLINE>
+    >>> resource.files
+    {'sfa3': 'sfa3.7z'}
+
+    Archives added since the last scan are found directly. Claimed archives stay 'queued' until posted
+    >>> pathlib.Path(tempdir.name, 'nes').mkdir()
+    >>> pathlib.Path(tempdir.name, 'nes', 'smb.zip').touch()
+    >>> resource.prioritise('nes/smb'), resource.prioritise('nes/zelda')
+    ('queued', None)
+    >>> resource.claim()
+    'nes/smb.zip'
+    >>> resource.prioritise('nes/smb')
+    'queued'
+    >>> resource._claimed['nes/smb'] -= datetime.timedelta(seconds=CLAIM_TIMEOUT_SECONDS)
+    >>> resource.renew('nes/smb')
+    >>> resource.prioritise('nes/smb')
+    'queued'
+    >>> resource.catalog_data.replace_roms((Rom('0'*40, 'nes/smb', 'smb.nes'), ))
+    >>> resource.catalog_data.mtime['nes/smb'] = str(pathlib.Path(tempdir.name, 'nes', 'smb.zip').stat().st_mtime)
+    >>> resource.catalogued('nes/smb')
+    >>> resource.prioritise('nes/smb')
+    'catalogued'
+    >>> tempdir.cleanup()
+    """
+    def __init__(self, path, catalog_data, shard=None):
         self.path = path
         self.catalog_data = catalog_data
-        self._files = []
+        self.shard = shard or Shard()
+        self._files = {}
+        self._priority = {}  # archive_name: relative - claimed first, in request order
+        self._claimed = {}  # archive_name: claim/renewal time - handed to a worker, not yet posted/failed
+        self.failed = {}  # archive_name: {mtime, error, count} - not requeued until the archive changes
         self._last_scan = None
+    def _is_pending(self, archive_name, f):
+        mtime = str(f.stats.st_mtime)
+        archive_has_changed = mtime != self.catalog_data.mtime.get(archive_name)
+        archive_has_failed = mtime == self.failed.get(archive_name, {}).get('mtime')
+        return archive_has_changed and not archive_has_failed
+    def _is_claimed(self, archive_name):
+        claimed = self._claimed.get(archive_name)
+        return claimed is not None and claimed > (datetime.datetime.now() - datetime.timedelta(seconds=CLAIM_TIMEOUT_SECONDS))
     def _rescan_files(self):
         self._last_scan = datetime.datetime.now()
         archive_names = set()
-        archive_names_changed = set()
-        for f in fast_scan(self.path):
+        archive_names_changed = {}
+        for f in self.shard.scan(self.path):
             archive_name = os.path.join(f.folder, f.file_no_ext)
             archive_names.add(archive_name)
-            archive_has_changed = str(f.stats.st_mtime) != self.catalog_data.mtime.get(archive_name)
-            if archive_has_changed:
-                archive_names_changed.add(archive_name)
-        self._files = archive_names_changed
+            if self._is_pending(archive_name, f):
+                archive_names_changed[archive_name] = f.relative
+        self._claimed = {k: v for k, v in self._claimed.items() if self._is_claimed(k)}
+        self._files = {k: v for k, v in archive_names_changed.items() if k not in self._priority and k not in self._claimed}
         # Remove deleted files
         deleted_archives = set(self.catalog_data.archive.keys()) - archive_names
         for archive_name in deleted_archives:
             self.catalog_data.remove(archive_name)
 
     @property
+    def _scan_is_stale(self):
+        return (
+            self._last_scan == None
+            or
+            self._last_scan < (datetime.datetime.now() - datetime.timedelta(seconds=FILE_RESCAN_SECONDS))
+        )
+    @property
     def files(self):
-        if (
-            not self._files
-            and
-            (
-                self._last_scan == None
-                or
-                self._last_scan < (datetime.datetime.now() - datetime.timedelta(seconds=FILE_RESCAN_SECONDS))
-            )
-        ):
+        if not self._files and self._scan_is_stale:
             self._rescan_files()
         return self._files
+    def _scan_archive(self, archive_name):
+        """
+        The file for `archive_name` (any extension) in `rom_path` - one directory listing rather than a full rescan
+        """
+        folder, name = os.path.split(archive_name)
+        if not name or '..' in Path(archive_name).parts or not self.shard.owns(archive_name):
+            return None
+        try:
+            with os.scandir(os.path.join(self.path, folder)) as scanner:
+                for dir_entry in scanner:
+                    f = FileScan(self.path, folder, dir_entry)
+                    if f.file_no_ext == name and dir_entry.is_file() and DEFAULT_FILTER(f.relative):
+                        return f
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return None
+    def prioritise(self, archive_name):
+        """
+        Move `archive_name` to the front of the work queue
+        Returns 'queued' (waiting or being hashed by a worker), 'catalogued' (hashed and unchanged since) or None (not in `rom_path`)
+        """
+        if archive_name in self._priority or self._is_claimed(archive_name):
+            return 'queued'
+        relative = self._files.pop(archive_name, None)
+        if not relative:
+            f = self._scan_archive(archive_name)  # the archive may be new since the last scan
+            if f and self._is_pending(archive_name, f):
+                relative = f.relative
+        if relative:
+            self._priority[archive_name] = relative
+            return 'queued'
+        if archive_name in self.catalog_data.archive:
+            return 'catalogued'
+        if archive_name in self.failed:
+            return 'failed'
+        return None
+    def claim(self):
+        """
+        The next file (`rom_path` relative) for a worker - priority first
+        """
+        if self._priority:
+            archive_name = next(iter(self._priority))
+            _file = self._priority.pop(archive_name)
+        else:
+            files = self.files
+            if not files:
+                return None
+            archive_name, _file = files.popitem()
+        self._claimed[archive_name] = datetime.datetime.now()
+        return _file
+    def renew(self, archive_name):
+        """
+        A worker is still hashing `archive_name` (or resumed it from a checkpoint) - keep it out of the queue
+        """
+        self._files.pop(archive_name, None)
+        self._priority.pop(archive_name, None)
+        self._claimed[archive_name] = datetime.datetime.now()
+    def catalogued(self, archive_name):
+        self._claimed.pop(archive_name, None)
+    def fail(self, archive_name, mtime, error):
+        self._claimed.pop(archive_name, None)
+        self.failed[archive_name] = {
+            'mtime': mtime,
+            'error': error,
+            'count': self.failed.get(archive_name, {}).get('count', 0) + 1,
+        }
+        log.warning(f'Failed to catalog {archive_name} - {error}')
     def on_get(self, request, response):
-        files = self.files
         response.media = {
-            'file': files.pop().relative if files else None,
-            'remaining': len(files),
+            'file': self.claim(),
+            'remaining': len(self._files) + len(self._priority),
         }
         response.status = falcon.HTTP_200
 
 
+class PriorityResource():
+    """
+    POST /priority/{archive_name}   hash this archive next - 202 queued, 200 already catalogued, 404 not in the rom_path
+    GET /priority/                  the priority queue
+    """
+    def __init__(self, next_untracked_file_resource):
+        self.next_untracked_file_resource = next_untracked_file_resource
+    def on_index(self, request, response):
+        response.media = tuple(self.next_untracked_file_resource._priority.keys())
+        response.status = falcon.HTTP_200
+    def on_post(self, request, response, archive_name):
+        status = self.next_untracked_file_resource.prioritise(archive_name)
+        response.media = {'archive_name': archive_name, 'status': status}
+        response.status = {'queued': falcon.HTTP_202, 'catalogued': falcon.HTTP_200, 'failed': falcon.HTTP_200}.get(status, falcon.HTTP_404)
+
+
+class ClaimResource():
+    """
+    POST /claim/{archive_name}      a worker is still hashing the archive (or resumed it) - renews the claim
+    GET /claim/                     claimed archives and when they were last renewed
+    """
+    def __init__(self, next_untracked_file_resource):
+        self.next_untracked_file_resource = next_untracked_file_resource
+    def on_index(self, request, response):
+        response.media = {archive_name: claimed.isoformat() for archive_name, claimed in tuple(self.next_untracked_file_resource._claimed.items())}
+        response.status = falcon.HTTP_200
+    def on_post(self, request, response, archive_name):
+        self.next_untracked_file_resource.renew(archive_name)
+        response.status = falcon.HTTP_200
+
+
+class FailedResource():
+    """
+    POST /failed/{archive_name}     a worker could not hash the archive {mtime, error}
+    GET /failed/                    failed archives with their last error
+    """
+    def __init__(self, next_untracked_file_resource):
+        self.next_untracked_file_resource = next_untracked_file_resource
+    def on_index(self, request, response):
+        response.media = self.next_untracked_file_resource.failed
+        response.status = falcon.HTTP_200
+    def on_post(self, request, response, archive_name):
+        self.next_untracked_file_resource.fail(archive_name, request.media.get('mtime'), request.media.get('error'))
+        response.status = falcon.HTTP_200
+
+
 
 # Setup App -------------------------------------------------------------------
 
-def create_wsgi_app(rom_path, catalog_data_filename, catalog_mtime_filename, **kwargs):
-    catalog_data = CatalogData(catalog_data_filename, catalog_mtime_filename)
-    init_sigterm_handler(catalog_data.save)
+def create_wsgi_app(rom_path=None, catalog_data_filename=None, catalog_mtime_filename=None, replica_of=None, replica_poll_seconds=5, shard_index=0, shard_count=1, shard_by='archive', url_api_romdata=None, url_api_catalog_shards=None, **kwargs):
+    """
+    `replica_of` (url of the primary) starts a read only replica. Only the primary scans `rom_path` and takes worker ingest
+    `shard_count` > 1 splits the rom tree across catalog processes - this process scans/holds only `shard_index`
+    `url_api_catalog_shards` (every shard, in shard index order) lets `/stats` see roms held by the other shards
+    """
+    shard = Shard(shard_index, shard_count, shard_by)
+    if replica_of:
+        catalog_data = CatalogData(iter(()))
+        CatalogFollower(catalog_data, replica_of, replica_poll_seconds).start()
+    else:
+        catalog_data = CatalogData(catalog_data_filename, catalog_mtime_filename)
+        init_sigterm_handler(catalog_data.save)
 
     app = falcon.API()
-    app.add_route(r'/', IndexResource(catalog_data))
-    app.add_route(r'/next_file', NextUntrackedFileResource(rom_path, catalog_data))
-    add_sink(app, 'archive', ArchiveResource(catalog_data), func_path_normalizer=func_path_normalizer_no_extension)
+    app.add_route(r'/', IndexResource(catalog_data, shard))
+    if not replica_of:
+        next_untracked_file_resource = NextUntrackedFileResource(rom_path, catalog_data, shard)
+        app.add_route(r'/next_file', next_untracked_file_resource)
+        add_sink(app, 'priority', PriorityResource(next_untracked_file_resource), func_path_normalizer=func_path_normalizer_no_extension)
+        add_sink(app, 'failed', FailedResource(next_untracked_file_resource), func_path_normalizer=func_path_normalizer_no_extension)
+        add_sink(app, 'claim', ClaimResource(next_untracked_file_resource), func_path_normalizer=func_path_normalizer_no_extension)
+    add_sink(app, 'archive', ArchiveResource(catalog_data, readonly=bool(replica_of), on_catalogued=None if replica_of else next_untracked_file_resource.catalogued), func_path_normalizer=func_path_normalizer_no_extension)
+    app.add_route(r'/dat', DatResource(catalog_data))
+    app.add_route(r'/duplicates', DuplicatesResource(catalog_data, expected_from_romdata_api(url_api_romdata) if url_api_romdata else None))
+    if url_api_romdata:
+        shard_presence = None
+        if shard.count > 1 and url_api_catalog_shards:
+            shard_presence = ShardPresence(tuple(url.strip() for url in url_api_catalog_shards.split(',')), shard.index)
+        elif shard.count > 1:
+            log.warning(f'{shard} without --url_api_catalog_shards - /stats counts roms misplaced into other shards as missing')
+        app.add_route(r'/stats', StatsResource(catalog_data, RomdataStats(url_api_romdata, owns=shard.owns if shard.count > 1 else None), shard_presence))
+    app.add_route(r'/sha1s', SHA1sResource(catalog_data))
+    replication_resource = ReplicationResource(catalog_data)
+    app.add_route(r'/replication/snapshot', replication_resource, suffix='snapshot')
+    app.add_route(r'/replication/changes', replication_resource, suffix='changes')
+    app.add_route(r'/search', SearchResource(
+        lambda: chain.from_iterable(tuple(catalog_data.archive.values())),
+        get_version=lambda: catalog_data.sequence,
+    ))
+    update_media_handlers(app)
+    metrics = add_metrics(
+        app,
+        catalog_sha1=lambda: len(catalog_data.sha1),
+        catalog_archive=lambda: len(catalog_data.archive),
+        catalog_sequence=lambda: catalog_data.sequence,
+    )
+    if not replica_of:
+        metrics.gauge('catalog_queue', lambda: len(next_untracked_file_resource._files))
+        metrics.gauge('catalog_priority_queue', lambda: len(next_untracked_file_resource._priority))
+        metrics.gauge('catalog_failed', lambda: len(next_untracked_file_resource.failed))
+        metrics.gauge('catalog_claimed', lambda: len(next_untracked_file_resource._claimed))
+    add_profiling(app, **kwargs)
 
     return app
 
@@ -193,16 +714,28 @@ def get_args():
         ''',
     )
 
-    parser.add_argument('--rom_path', action='store', required=True, help='')
-    parser.add_argument('--catalog_data_filename', action='store', required=True, default='./catalog.txt', help='')
-    parser.add_argument('--catalog_mtime_filename', action='store', required=True, default='./mtimes.txt', help='')
+    parser.add_argument('--rom_path', action='store', help='')
+    parser.add_argument('--catalog_data_filename', action='store', default='./catalog.txt', help='')
+    parser.add_argument('--catalog_mtime_filename', action='store', default='./mtimes.txt', help='')
+
+    parser.add_argument('--replica_of', action='store', help='url of the primary catalog - run as a read only replica')
+    parser.add_argument('--replica_poll_seconds', action='store', type=float, default=5, help='')
+
+    add_shard_args(parser, catalog=True)
+    parser.add_argument('--url_api_catalog_shards', action='store', help='comma separated urls of every catalog shard (in shard index order) - `/stats` checks the other shards for misplaced roms')
+
+    parser.add_argument('--url_api_romdata', action='store', help='romdata is asked which `/duplicates` are expected (shared bios, parent/clone roms) and is the reference for `/stats`')
 
     parser.add_argument('--host', action='store', default='0.0.0.0', help='')
     parser.add_argument('--port', action='store', default=9002, type=int, help='')
 
+    add_profile_args(parser)
+
     parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stdout', default=logging.INFO)
 
     kwargs = vars(parser.parse_args())
+    if not kwargs['replica_of'] and not kwargs['rom_path']:
+        parser.error('--rom_path is required (unless --replica_of)')
     return kwargs
 
 
@@ -0,0 +1,54 @@
+import sys
+import json
+import logging
+from contextlib import redirect_stdout
+
+from _common.roms import RomData
+from _common.duplicates import iter_duplicates, summarise, expected_from_rom_data, expected_from_romdata_api
+
+
+log = logging.getLogger(__name__)
+
+
+def main(catalog_data_filename, romdata_filename=None, url_api_romdata=None, unexpected_only=False, summary=False, **kwargs):
+    with redirect_stdout(sys.stderr):  # RomData progress
+        catalog_data = RomData(catalog_data_filename)
+        get_expected = None
+        if romdata_filename:
+            get_expected = expected_from_rom_data(RomData(romdata_filename))
+        elif url_api_romdata:
+            get_expected = expected_from_romdata_api(url_api_romdata)
+    reports = iter_duplicates(catalog_data.sha1, get_expected=get_expected, unexpected_only=unexpected_only)
+    if summary:
+        print(json.dumps(summarise(reports)))
+        return
+    for report in reports:
+        print(json.dumps(report))
+
+
+def get_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description='''
+        Duplicate content report - every sha1 held in more than one catalogued archive as json lines
+        ''',
+    )
+
+    parser.add_argument('catalog_data_filename', action='store', help='catalog.txt')
+    parser.add_argument('--romdata_filename', action='store', help='roms.txt - duplication romdata expects (shared bios, parent/clone roms) is flagged `expected`')
+    parser.add_argument('--url_api_romdata', action='store', help='romdata api as an alternative to --romdata_filename')
+    parser.add_argument('--unexpected_only', action='store_true', help='')
+    parser.add_argument('--summary', action='store_true', help='totals only')
+
+    parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stderr', default=logging.WARNING)
+
+    kwargs = vars(parser.parse_args())
+    return kwargs
+
+
+if __name__ == "__main__":
+    kwargs = get_args()
+    logging.basicConfig(level=kwargs['log_level'])
+    main(**kwargs)
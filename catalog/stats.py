@@ -0,0 +1,52 @@
+import sys
+import json
+import logging
+from contextlib import redirect_stdout
+
+from _common.roms import RomData
+from _common.stats import CompletenessStats, RomdataStats, report
+
+
+log = logging.getLogger(__name__)
+
+
+def main(catalog_data_filename, romdata_filename=None, url_api_romdata=None, layout=None, by='collection', group=None, incomplete=False, **kwargs):
+    with redirect_stdout(sys.stderr):  # RomData progress
+        catalog_data = RomData(catalog_data_filename)
+        if romdata_filename:
+            stats = CompletenessStats(RomData(romdata_filename).archive)
+        elif url_api_romdata:
+            stats = RomdataStats(url_api_romdata).get(layout)
+        else:
+            raise ValueError('romdata_filename or url_api_romdata required')
+    print(json.dumps(report(stats.counts(catalog_data.archive), by=by, group=group, incomplete=incomplete), indent=2))
+
+
+def get_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description='''
+        Completeness of the catalogued collection against romdata - matched/misplaced/missing/unknown roms and missing bytes
+        ''',
+    )
+
+    parser.add_argument('catalog_data_filename', action='store', help='catalog.txt')
+    parser.add_argument('--romdata_filename', action='store', help='roms.txt')
+    parser.add_argument('--url_api_romdata', action='store', help='romdata api as an alternative to --romdata_filename')
+    parser.add_argument('--layout', action='store', help='romdata archive layout (with --url_api_romdata)')
+    parser.add_argument('--by', action='store', choices=('collection', 'group', 'archive'), default='collection', help='group is per softlist/DAT tag')
+    parser.add_argument('--group', action='store', help='only this softlist/DAT tag')
+    parser.add_argument('--incomplete', action='store_true', help='--by=archive only lists archives with roms not matched')
+
+    parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stderr', default=logging.WARNING)
+
+    kwargs = vars(parser.parse_args())
+    return kwargs
+
+
+if __name__ == "__main__":
+    kwargs = get_args()
+    logging.basicConfig(level=kwargs['log_level'])
+    main(**kwargs)
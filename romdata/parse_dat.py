@@ -0,0 +1,239 @@
+import io
+import os
+import re
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor
+
+from _common.roms import Rom
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Logiqx xml -------------------------------------------------------------------
+
+GAME_TAGS = frozenset(('game', 'machine', 'software'))
+
+
+def _rom_from_attrs(attrs, archive_name):
+    sha1 = (attrs.get('sha1') or '').lower()
+    if len(sha1) != 40 or attrs.get('status') == 'nodump':
+        return None
+    return Rom(
+        sha1=sha1,
+        archive_name=archive_name,
+        file_name=attrs.get('name').replace('\\', '/'),
+        size=int(attrs['size']) if attrs.get('size', '').isdigit() else None,
+        crc=(attrs.get('crc') or '').lower() or None,
+        md5=(attrs.get('md5') or '').lower() or None,
+    )
+
+
+def iter_logiqx(filehandle, tag=''):
+    r"""
+    Stream roms from a Logiqx xml datafile. Each game is cleared once read - memory stays flat however large the DAT
+    Roms without a sha1 can't be indexed and are skipped
+
+    >>> import io
+    >>> data = b'''<?xml version="1.0"?>
+    ... <datafile>
+    ...     <header><name>Nintendo - NES</name></header>
+    ...     <game name="Super Mario Bros. (World)">
+    ...         <description>Super Mario Bros. (World)</description>
+    ...         <rom name="Super Mario Bros. (World).nes" size="40976" crc="3337EC46" md5="811b027eaf99c2def7b933c5208636de" sha1="EA343F4E445A9050D4B4FBAC2C77D0693B1D0922"/>
+    ...     </game>
+    ...     <game name="crc only"><rom name="a.bin" size="1" crc="00000000"/></game>
+    ...     <machine name="sfa3"><rom name="sz3.01" sha1="0000000000000000000000000000000000000000" status="nodump"/><rom name="sz3.02" sha1="1111111111111111111111111111111111111111"/></machine>
+    ... </datafile>'''
+    >>> for rom in iter_logiqx(io.BytesIO(data), tag='nes'):
+    ...     print(str(rom).replace('\t', '  '))
+    ea343f4e445a9050d4b4fbac2c77d0693b1d0922 nes/Super Mario Bros. (World):Super Mario Bros. (World).nes  40976  3337ec46  811b027eaf99c2def7b933c5208636de
+    1111111111111111111111111111111111111111 nes/sfa3:sz3.02
+    """
+    iterparse = ET.iterparse(filehandle, events=('start', 'end'))
+    _, root = next(iterparse)
+    for event, e in iterparse:
+        if event != 'end' or e.tag not in GAME_TAGS:
+            continue
+        archive_name = os.path.join(tag, e.get('name'))
+        for rom in e.iter('rom'):
+            rom = _rom_from_attrs(rom.attrib, archive_name)
+            if rom:
+                yield rom
+        root.clear()  # drop the games read so far
+
+
+# ClrMamePro text --------------------------------------------------------------
+
+REGEX_TOKEN = re.compile(r'"([^"]*)"|(\()|(\))|([^\s()"]+)')
+
+
+def _tokens(filehandle):
+    """
+    >>> import io
+    >>> tuple(_tokens(io.StringIO('game (\\n\\tname "a b"\\n\\trom ( name x.bin )\\n)')))
+    ('game', '(', 'name', 'a b', 'rom', '(', 'name', 'x.bin', ')', ')')
+    """
+    for line in filehandle:
+        for quoted, open_, close, word in REGEX_TOKEN.findall(line):
+            yield open_ or close or (quoted if not word else word)
+
+
+def _block(tokens):
+    """
+    The key/value pairs of a `( ... )` block. Nested blocks are dicts, repeated keys become lists
+    """
+    block = {}
+    for token in tokens:
+        if token == ')':
+            return block
+        value = next(tokens)
+        if value == '(':
+            value = _block(tokens)
+        if token in block:
+            if not isinstance(block[token], list):
+                block[token] = [block[token]]
+            block[token].append(value)
+        else:
+            block[token] = value
+    return block
+
+
+def iter_clrmamepro(filehandle, tag=''):
+    r"""
+    Stream roms from a ClrMamePro text datafile - one game block is held at a time
+
+    >>> import io
+    >>> data = '''clrmamepro (
+    ...     name "Nintendo - NES"
+    ... )
+    ...
+    ... game (
+    ...     name "Super Mario Bros. (World)"
+    ...     rom ( name "Super Mario Bros. (World).nes" size 40976 crc 3337EC46 sha1 EA343F4E445A9050D4B4FBAC2C77D0693B1D0922 )
+    ...     rom ( name b.bin size 1 crc 00000000 )
+    ... )
+    ... resource (
+    ...     name neogeo
+    ...     rom ( name sp-s2.sp1 sha1 4f5ed7105b7128794654ce82b51723e16e389543 )
+    ... )
+    ... '''
+    >>> for rom in iter_clrmamepro(io.StringIO(data), tag='nes'):
+    ...     print(rom.sha1[:8], rom.archive_name, rom.file_name, rom.size, rom.crc)
+    ea343f4e nes/Super Mario Bros. (World) Super Mario Bros. (World).nes 40976 3337ec46
+    4f5ed710 nes/neogeo sp-s2.sp1 None None
+    """
+    tokens = _tokens(filehandle)
+    for token in tokens:
+        if next(tokens, None) != '(':
+            continue
+        block = _block(tokens)
+        if token not in ('game', 'machine', 'resource') or not block.get('name'):
+            continue
+        archive_name = os.path.join(tag, block['name'])
+        roms = block.get('rom', ())
+        for attrs in (roms if isinstance(roms, list) else (roms, )):
+            rom = _rom_from_attrs(attrs, archive_name)
+            if rom:
+                yield rom
+
+
+# Files ------------------------------------------------------------------------
+
+def _sniff(filehandle):
+    return 'logiqx' if filehandle.peek(64).lstrip()[:1] == b'<' else 'clrmamepro'
+
+
+def _iter_dat_filehandle(filehandle, tag):
+    if _sniff(filehandle) == 'logiqx':
+        yield from iter_logiqx(filehandle, tag)
+    else:
+        yield from iter_clrmamepro(io.TextIOWrapper(filehandle, encoding='utf8', errors='replace'), tag)
+
+
+def iter_dat(filename, tag=''):
+    """
+    Roms from a Logiqx or ClrMamePro DAT (format detected), or every DAT in a .zip
+    """
+    if str(filename).endswith('.zip'):
+        with ZipFile(filename) as zipfile:
+            for _filename in zipfile.namelist():
+                if _filename.endswith(('.dat', '.xml')):
+                    with zipfile.open(_filename) as filehandle:
+                        yield from _iter_dat_filehandle(io.BufferedReader(filehandle), tag)
+        return
+    with open(filename, 'rb') as filehandle:
+        yield from _iter_dat_filehandle(filehandle, tag)
+
+
+def parse_dat_arg(arg):
+    """
+    `tag=path` - archives are prefixed with the tag (folder in the rom path). The tag defaults to the filename
+
+    >>> parse_dat_arg('nes=/dats/Nintendo - NES (20201010).dat')
+    ('nes', '/dats/Nintendo - NES (20201010).dat')
+    >>> parse_dat_arg('/dats/Sega - Mega Drive.dat')
+    ('Sega - Mega Drive', '/dats/Sega - Mega Drive.dat')
+    """
+    match = re.match(r'^([\w.-]+)=(.+)$', arg)
+    if match:
+        return match.groups()
+    return Path(arg).stem, arg
+
+
+# Parallel ---------------------------------------------------------------------
+
+def _parse_dat_to_file(args):
+    tag, filename, output_filename = args
+    count = 0
+    with open(output_filename, 'wt', encoding='utf8') as output:
+        for count, rom in enumerate(iter_dat(filename, tag), 1):
+            output.write(f'{rom}\n')
+    return count
+
+
+def iter_dats_parallel(dats, processes=None):
+    """
+    Parse (tag, filename) DATs in separate processes. Each writes roms lines to a temp file; files are yielded back in order
+    so memory stays flat and the output is deterministic
+    """
+    with tempfile.TemporaryDirectory() as tempdir:
+        jobs = tuple((tag, filename, os.path.join(tempdir, f'{index}.txt')) for index, (tag, filename) in enumerate(dats))
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for (tag, filename, output_filename), count in zip(jobs, executor.map(_parse_dat_to_file, jobs)):
+                log.info(f'{count} roms from {filename} as {tag}/')
+                with open(output_filename, 'rt', encoding='utf8') as filehandle:
+                    yield from filehandle
+
+
+def main(dats, processes=None, **kwargs):
+    for line in iter_dats_parallel(map(parse_dat_arg, dats), processes):
+        sys.stdout.write(line)
+
+
+def get_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description='''
+        Output `roms.txt` lines from Logiqx xml/ClrMamePro DATs (e.g. No-Intro, Redump, TOSEC)
+        ''',
+    )
+
+    parser.add_argument('dats', nargs='+', help='`tag=path` - archives are listed as `tag/game`. tag defaults to the DAT filename')
+    parser.add_argument('--processes', action='store', type=int, help='parse DATs in parallel (default cpu count)')
+    parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stderr', default=logging.INFO)
+
+    kwargs = vars(parser.parse_args())
+    return kwargs
+
+
+if __name__ == "__main__":
+    kwargs = get_args()
+    logging.basicConfig(level=kwargs['log_level'])
+    main(**kwargs)
@@ -4,15 +4,16 @@ from itertools import chain
 import subprocess
 from zipfile import ZipFile
 
-from _common.roms import Rom
-
+from _common.roms import Rom, LAYOUTS
+from romdata.parse_dat import parse_dat_arg, iter_dats_parallel
 
 def rom_from_xml_element(item, rom, parent='', folder=''):
     folder_name = item.get('name') if parent else ''
     return Rom(
         sha1=rom.get('sha1'),
         archive_name=os.path.join(folder, parent or item.get('name')),
-        file_name=os.path.join(folder_name, rom.get('name'))
+        file_name=os.path.join(folder_name, rom.get('name')),
+        size=int(rom.get('size')) if rom.get('size') else None,
     )
 
 
@@ -56,7 +57,12 @@ def _files_for_machine(machine, parents_to_exclude={}):
             rom=rom,
             parent=machine.get('romof') if machine.get('romof') not in parents_to_exclude else ''
         )
-def iter_mame(get_xml_filehandle):
+def _files_for_machine_split(machine, include_merged=False):
+    for rom in machine.findall('rom'):
+        if rom.get('status') == "nodump" or (rom.get('merge') and not include_merged):
+            continue
+        yield rom_from_xml_element(item=machine, rom=rom)
+def iter_mame(get_xml_filehandle, layout='merged'):
     r"""
     >>> data = '''<?xml version="1.0"?>
     ... <mame build="0.222 (unknown)" debug="no" mameconfig="10">
@@ -80,6 +86,16 @@ def iter_mame(get_xml_filehandle):
     >>> tuple(map(str, iter_mame(mock_filehandle)))
     ('91424d481ff99a8d3f4c45cea6d3f0eada049a6d naomi:epr-21576h.ic27', '2f32caf3906fc1408fd8126a500e74c682ff20fa 18wheelr:epr-22185a.ic22', '6db3bfa23246c250e334bbd54dcb5038a2d18dbc 18wheelr:18wheelro/epr-22185.ic22')
 
+    split - every set in its own archive without the files it shares with its parent/bios
+    >>> mock_filehandle.return_value.read.side_effect = (data, b'')
+    >>> tuple(map(str, iter_mame(mock_filehandle, layout='split')))
+    ('2f32caf3906fc1408fd8126a500e74c682ff20fa 18wheelr:epr-22185a.ic22', '6db3bfa23246c250e334bbd54dcb5038a2d18dbc 18wheelro:epr-22185.ic22', '91424d481ff99a8d3f4c45cea6d3f0eada049a6d naomi:epr-21576h.ic27')
+
+    nonmerged - every set in its own archive with every file it needs (parent and bios included)
+    >>> mock_filehandle.return_value.read.side_effect = (data, b'')
+    >>> sorted(map(str, iter_mame(mock_filehandle, layout='nonmerged')))[:3]
+    ['2f32caf3906fc1408fd8126a500e74c682ff20fa 18wheelr:epr-22185a.ic22', '6db3bfa23246c250e334bbd54dcb5038a2d18dbc 18wheelro:epr-22185.ic22', '6db3bfa23246c250e334bbd54dcb5038a2d18dbc naomi:epr-22185.ic22']
+
 
 
     <rom name="mach3fg0.bin" size="8192" crc="0bae12a5" sha1="7bc0b82ccab0e4498a7a2a9dc85f03125f25826e" region="sprites" offset="6000"/>
@@ -91,6 +107,11 @@ def iter_mame(get_xml_filehandle):
     mamboagg/a40jab02.chd
     """
     assert callable(get_xml_filehandle)
+    assert layout in LAYOUTS, f'{layout=}'
+    if layout != 'merged':
+        for machine in _tag_iterator(ET.iterparse(get_xml_filehandle()), 'machine'):
+            yield from _files_for_machine_split(machine, include_merged=layout == 'nonmerged')
+        return
     bioss = set()
     for machine in _tag_iterator(ET.iterparse(get_xml_filehandle()), 'machine'):
         if machine.get('isbios') == 'yes':
@@ -100,7 +121,7 @@ def iter_mame(get_xml_filehandle):
         yield from _files_for_machine(machine, parents_to_exclude=bioss)
 
 
-def iter_software(get_xml_filehandle):
+def iter_software(get_xml_filehandle, layout='merged'):
     r"""
     >>> data = '''<?xml version="1.0"?>
     ... <softwarelists>
@@ -127,24 +148,46 @@ def iter_software(get_xml_filehandle):
     >>> mock_filehandle.return_value.read.side_effect = (data, b'')
     >>> tuple(map(str, iter_software(mock_filehandle)))
     ('6d052e0cca3f2712434efd856f733c03011be41c sms/alexkidd:alex kidd in miracle world (usa, europe) (v1.1).bin', '8cecf8ed0f765163b2657be1b0a3ce2a9cb767f4 sms/alexkidd:alexkidd1/alex kidd in miracle world (usa, europe).bin')
+
+    >>> mock_filehandle.return_value.read.side_effect = (data, b'')
+    >>> tuple(map(str, iter_software(mock_filehandle, layout='split')))
+    ('6d052e0cca3f2712434efd856f733c03011be41c sms/alexkidd:alex kidd in miracle world (usa, europe) (v1.1).bin', '8cecf8ed0f765163b2657be1b0a3ce2a9cb767f4 sms/alexkidd1:alex kidd in miracle world (usa, europe).bin')
+
+    >>> mock_filehandle.return_value.read.side_effect = (data, b'')
+    >>> tuple(map(str, iter_software(mock_filehandle, layout='nonmerged')))
+    ('6d052e0cca3f2712434efd856f733c03011be41c sms/alexkidd:alex kidd in miracle world (usa, europe) (v1.1).bin', '8cecf8ed0f765163b2657be1b0a3ce2a9cb767f4 sms/alexkidd1:alex kidd in miracle world (usa, europe).bin', '6d052e0cca3f2712434efd856f733c03011be41c sms/alexkidd1:alex kidd in miracle world (usa, europe) (v1.1).bin')
     """
     callable(get_xml_filehandle)
+    assert layout in LAYOUTS, f'{layout=}'
     iterparse = ET.iterparse(source=get_xml_filehandle(), events=('start', 'end'))
     current_softwarelist = ''
+    software_roms = {}  # nonmerged: clones need their parents files - held for the current softwarelist
     for event, e in iterparse:
         if event == 'start' and e.tag == 'softwarelist':
             current_softwarelist = e.get('name')
+            software_roms = {}
         if event == 'end' and e.tag == 'software':
-            for rom in _find_recursively(e, lambda e: e.tag == 'rom'):
-                if not rom.get('name'):
-                    # log.warning(f"software {e.get('name')} has a rom with no name?")
-                    continue
+            roms = tuple(
+                rom
+                for rom in _find_recursively(e, lambda e: e.tag == 'rom')
+                if rom.get('name')  # log.warning(f"software {e.get('name')} has a rom with no name?")
+            )
+            if layout == 'nonmerged':
+                software_roms[e.get('name')] = (e.get('cloneof'), tuple((rom.get('name'), rom.get('sha1'), rom.get('size')) for rom in roms))
+                continue
+            for rom in roms:
                 yield rom_from_xml_element(
                     item=e,
                     rom=rom,
-                    parent=e.get('cloneof') or '',
+                    parent=(e.get('cloneof') or '') if layout == 'merged' else '',
                     folder=current_softwarelist,
                 )
+        if event == 'end' and e.tag == 'softwarelist' and layout == 'nonmerged':
+            for software_name, (cloneof, roms) in software_roms.items():
+                file_names = {file_name for file_name, _, _ in roms}
+                parent_roms = tuple(rom for rom in software_roms.get(cloneof, (None, ()))[1] if rom[0] not in file_names)
+                for file_name, sha1, size in roms + parent_roms:
+                    yield Rom(sha1=sha1, archive_name=os.path.join(current_softwarelist, software_name), file_name=file_name, size=int(size) if size else None)
 
 def _zip_filehandle(filename):
     #with ZipFile(filename) as zipfile:
@@ -154,26 +197,32 @@ def _zip_filehandle(filename):
     filehandle = zipfile.open(_filename)
     return filehandle
 
-def iter_software_zip(filename):
+def iter_software_zip(filename, layout='merged'):
     with ZipFile(filename) as zipfile:
         for _filename in zipfile.namelist():
             if _filename.endswith('.xml'):
                 with zipfile.open(_filename) as filehandle:
-                    yield from iter_software(lambda: filehandle)
+                    yield from iter_software(lambda: filehandle, layout=layout)
 
 #/Users/allancallaghan/Downloads/mame0222lx.zip
 #/Users/allancallaghan/Applications/mame/hash.zip
 
-def main():
+def main(layout='merged', dat=(), processes=None, **kwargs):
     #raise NotImplementedError('need to take args for files from commandline?')
+    dats = tuple(map(parse_dat_arg, dat))
+    if any(tag in ('', '.') for tag, _ in dats):
+        raise ValueError('DAT roms need a tag - they would collide with mame archive names')
     for rom in chain(
-        iter_mame(lambda: _zip_filehandle('mamelx.zip')),
-        iter_software_zip('hash.zip'),
+        iter_mame(lambda: _zip_filehandle('mamelx.zip'), layout=layout),
+        iter_software_zip('hash.zip', layout=layout),
         #iter_mame(lambda: _cmd_mame('-listxml')),
         #iter_software(lambda: _cmd_mame('-getsoftlist'))
         #iter_software_zip('/Users/allancallaghan/Applications/mame/hash.zip')
     ):
         print(rom)
+    # Non-mame DATs are layout independent - they are appended to every layout under their `tag/` folder
+    for line in iter_dats_parallel(dats, processes):
+        print(line, end='')
 
 
 # def postmortem(func, *args, **kwargs):
@@ -187,6 +236,24 @@ def main():
 #         traceback.print_exc()
 #         pdb.post_mortem(tb)
 
+def get_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description='''
+        Output `roms.txt` from mamelx.zip and hash.zip (plus any additional Logiqx/ClrMamePro DATs)
+        ''',
+    )
+
+    parser.add_argument('--layout', action='store', choices=LAYOUTS, default='merged', help='archive layout: merged (clones in parent `clone/` folder), split or nonmerged')
+    parser.add_argument('--dat', action='append', default=[], help='`tag=path` additional Logiqx xml/ClrMamePro DAT (or .zip of DATs) listed as `tag/game` - repeatable')
+    parser.add_argument('--processes', action='store', type=int, help='parse DATs in parallel (default cpu count)')
+
+    kwargs = vars(parser.parse_args())
+    return kwargs
+
+
 if __name__ == "__main__":
     #postmortem(main)
-    main()
+    main(**get_args())
@@ -1,39 +1,167 @@
 import os.path
 import json
 import re
+import hashlib
 import logging
+import threading
+import uuid
+import weakref
 from itertools import chain
 from functools import reduce
 from collections import defaultdict
 from pathlib import Path
+from types import MappingProxyType
 
 import falcon
 
-from _common.roms import RomData
-from _common.falcon_helpers import add_sink, func_path_normalizer_no_extension
+from _common.roms import RomData, LAYOUTS, layout_filename
+from _common.bloom import BloomFilter
+from _common.search import SearchResource
+from _common.falcon_helpers import add_sink, func_path_normalizer_no_extension, update_media_handlers, respond_index, negotiated_media_type
+from _common.profiling import add_profiling, add_profile_args
+from _common.metrics import add_metrics
 
 log = logging.getLogger(__name__)
 
 
 
+# Versions --------------------------------------------------------------------
+
+class RomDataVersions():
+    """
+    Several romdata versions, each {layout: RomData}, held at once. Roms and rom sets identical to an already loaded
+    version/layout are stored once (`RomData(share=)`) - a second MAME release costs roughly its differences
+
+    New versions load in a background thread and are swapped in atomically - `versions` is replaced, never mutated,
+    so a request keeps the mapping it looked up
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> with open(os.path.join(path, 'roms.txt'), 'wt') as f:
+    ...     _ = f.write('0000000000000000000000000000000000000000 sfa3:sz3.01\\n')
+    >>> versions = RomDataVersions()
+    >>> _ = versions.load('mame0222', os.path.join(path, 'roms.txt'))
+    .
+    >>> _ = versions.load('mame0223', os.path.join(path, 'roms.txt'))
+    .
+    >>> versions.default, tuple(versions.versions.keys())
+    ('mame0222', ('mame0222', 'mame0223'))
+    >>> versions.get('mame0223').archive['sfa3'] is versions.get('mame0222').archive['sfa3']
+    True
+    >>> versions.remove('mame0222'), versions.default
+    (True, 'mame0223')
+    >>> versions.loading['mame0224'] = 'loading'
+    >>> versions.load_background('mame0224', os.path.join(path, 'roms.txt')) is None
+    True
+    >>> versions.set_default('mame0224')
+    >>> versions.default
+    'mame0223'
+    >>> del versions.loading['mame0224']
+    >>> _ = versions.load('mame0224', os.path.join(path, 'roms.txt'))
+    .
+    >>> versions.default
+    'mame0224'
+    """
+    def __init__(self, on_change=None):
+        self.lock = threading.Lock()
+        self.versions = MappingProxyType({})
+        self.content_ids = MappingProxyType({})  # version: changes with the loaded files - a restart with a new `roms.txt` under the same name gets new ETags
+        self.default = None
+        self.default_pending = None  # a version still loading that becomes the default once loaded
+        self.loading = {}
+        self.on_change = on_change or (lambda versions: None)
+    def get(self, version=None, layout='merged'):
+        return self.versions[version or self.default][layout]
+    def load(self, version, rom_data_filename, default=False):
+        """
+        Load all available layouts for `version`, sharing storage with every version already loaded
+        """
+        log.info(f'Loading {version=} from {rom_data_filename}')
+        self.loading[version] = 'loading'
+        try:
+            share = [rom_data for rom_datas in self.versions.values() for rom_data in rom_datas.values()]
+            rom_datas = {}
+            content_id = hashlib.sha1()
+            for layout in LAYOUTS:
+                _filename = layout_filename(rom_data_filename, layout)
+                if layout == 'merged' or os.path.isfile(_filename):
+                    stat = os.stat(_filename)
+                    content_id.update(f'{layout} {stat.st_size} {stat.st_mtime_ns}\n'.encode('utf8'))
+                    rom_datas[layout] = RomData(_filename, share=share)
+                    share.append(rom_datas[layout])
+        except Exception as ex:
+            log.exception(f'Failed to load {version=}')
+            self.loading[version] = f'failed: {ex}'
+            raise
+        del share
+        self.add(version, rom_datas, default=default, content_id=content_id.hexdigest())
+        del self.loading[version]
+        return rom_datas
+    def is_loading(self, version):
+        return not self.loading.get(version, 'failed').startswith('failed')
+    def load_background(self, version, rom_data_filename, default=False):
+        """
+        None if `version` is already loaded or loading - only one load per version
+        """
+        with self.lock:
+            if version in self.versions or self.is_loading(version):
+                return None
+            self.loading[version] = 'queued'
+        thread = threading.Thread(target=self.load, args=(version, rom_data_filename), kwargs={'default': default}, name=f'load_{version}', daemon=True)
+        thread.start()
+        return thread
+    def add(self, version, rom_datas, default=False, content_id=None):
+        with self.lock:
+            self.versions = MappingProxyType({**self.versions, version: rom_datas})
+            self.content_ids = MappingProxyType({**self.content_ids, version: content_id or uuid.uuid4().hex})
+            if default or not self.default or self.default_pending == version:
+                self.default = version
+            if self.default_pending == version:
+                self.default_pending = None
+        log.info(f'Loaded {version=} - default {self.default}')
+        self.on_change(self)
+    def set_default(self, version):
+        """
+        A version still loading becomes the default once loaded
+        """
+        with self.lock:
+            if version in self.versions:
+                self.default = version
+                self.default_pending = None
+            elif self.is_loading(version):
+                self.default_pending = version
+            else:
+                raise KeyError(version)
+    def remove(self, version):
+        with self.lock:
+            if version not in self.versions:
+                return False
+            self.versions = MappingProxyType({_version: rom_datas for _version, rom_datas in self.versions.items() if _version != version})
+            self.content_ids = MappingProxyType({_version: content_id for _version, content_id in self.content_ids.items() if _version != version})
+            if self.default == version:
+                self.default = next(iter(self.versions.keys()), None)
+        self.on_change(self)
+        return True
+
+
 # Request Handler --------------------------------------------------------------
 
 class IndexResource():
-    def __init__(self, rom_data):
-        self.rom_data = rom_data
+    def __init__(self, versions):
+        self.versions = versions
     def on_get(self, request, response):
         response.media = {
-            'version': os.environ.get('MAME_GIT_TAG'),
-            'sha1': len(self.rom_data.sha1.keys()),
-            'archive': len(self.rom_data.archive.keys()),
+            'version': request.context.version,
+            'sha1': len(request.context.rom_data.sha1.keys()),
+            'archive': len(request.context.rom_data.archive.keys()),
+            'layouts': tuple(request.context.rom_datas.keys()),
+            'versions': tuple(self.versions.versions.keys()),
         }
         response.status = falcon.HTTP_200
 
 class SHA1InfoResource():
-    def __init__(self, rom_data):
-        self.rom_data = rom_data
     def on_get(self, request, response, sha1):
-        roms = self.rom_data.sha1.get(sha1)
+        roms = request.context.rom_data.sha1.get(sha1)
         if not roms:
             response.status = falcon.HTTP_404
             return
@@ -41,16 +169,14 @@ class SHA1InfoResource():
         response.status = falcon.HTTP_200
 
 class ArchiveResource():
-    def __init__(self, rom_data):
-        self.rom_data = rom_data
     def on_index(self, request, response):
-        response.media = tuple(self.rom_data.archive.keys())
-        response.status = falcon.HTTP_200
+        rom_data = request.context.rom_data
+        respond_index(request, response, iter(rom_data.archive.keys()), len(rom_data.archive))
     def on_get(self, request, response, archive_name):
         """
         TODO: I don't like the return - multiple archives?
         """
-        archive_roms = self.rom_data.archive.get(archive_name)
+        archive_roms = request.context.rom_data.archive.get(archive_name)
         if not archive_roms:
             response.status = falcon.HTTP_404
             return
@@ -62,9 +188,39 @@ class ArchiveResource():
         }
         response.status = falcon.HTTP_200
 
+class RomsResource():
+    """
+    GET /roms - every rom as `roms.txt` lines (streamed) for bulk consumers (catalog `/stats`)
+    """
+    def on_get(self, request, response):
+        archives = tuple(request.context.rom_data.archive.values())
+        def _lines(chunk_size=1000):
+            for index in range(0, len(archives), chunk_size):
+                yield ''.join(f'{rom}\n' for roms in archives[index:index + chunk_size] for rom in roms).encode('utf8')
+        response.content_type = falcon.MEDIA_TEXT
+        response.stream = _lines()
+        response.status = falcon.HTTP_200
+
+class SHA1FilterResource():
+    """
+    Bloom filter of every known sha1 - clients drop definite-unknowns locally before calling `/sets`
+    Versioned with the rest of romdata (`/version/{tag}/sha1_filter`) - one filter is cached per loaded `RomData`
+    """
+    def __init__(self, error_rate=0.001):
+        self.error_rate = error_rate
+        self._data = weakref.WeakKeyDictionary()
+    def data(self, rom_data):
+        if rom_data not in self._data:
+            bloom = BloomFilter.for_capacity(len(rom_data.sha1), self.error_rate)
+            bloom.update(rom_data.sha1.keys())
+            self._data[rom_data] = bloom.to_bytes()
+        return self._data[rom_data]
+    def on_get(self, request, response):
+        response.content_type = 'application/octet-stream'
+        response.data = self.data(request.context.rom_data)
+        response.status = falcon.HTTP_200
+
 class SetsResource():
-    def __init__(self, rom_data):
-        self.rom_data = rom_data
     def on_get(self, request, response):
         """
         curl \
@@ -75,36 +231,197 @@ class SetsResource():
             "http://localhost:9001/sets"
 
         {'roms': [{"airlbios": ["bd50a6bb8fa9bac121b076e21ea048a83a240a48"], "3do": ["3c912300775d1ad730dc35757e279c274c0acaad"]}, "unknown": []}
+
+        The body can also be raw 20 byte sha1s (`Content-Type: application/x-sha1`)
+        `?fields=matched,missing` drops `files` from each romset
+        `?layout=split` resolves against another archive layout
         """
+        rom_data = request.context.rom_data
+        fields = set(request.get_param('fields', default='matched,missing,files').split(','))
         response.media = {'romsets': {}, 'unknown': []}
         input_sha1 = set(request.media)
-        input_roms = chain.from_iterable(filter(None, map(lambda sha1: self.rom_data.sha1.get(sha1), input_sha1)))
+        input_roms = chain.from_iterable(filter(None, map(lambda sha1: rom_data.sha1.get(sha1), input_sha1)))
         input_archive_names = set(rom.archive_name for rom in input_roms)
         matched_sha1 = set()
         for archive_name in input_archive_names:
-            archive_roms = self.rom_data.archive.get(archive_name)
+            archive_roms = rom_data.archive.get(archive_name)
             archive_sha1s = set(rom.sha1 for rom in archive_roms)
             archive_sha1s_matched = archive_sha1s & input_sha1
-            response.media['romsets'][archive_name] = {
+            romset = {
                 'matched': tuple(archive_sha1s_matched),
                 'missing': tuple(archive_sha1s - archive_sha1s_matched),
-                'files': {rom.sha1: rom.file_name for rom in archive_roms},
             }
+            if 'files' in fields:
+                romset['files'] = {rom.sha1: rom.file_name for rom in archive_roms}
+            response.media['romsets'][archive_name] = {k: v for k, v in romset.items() if k in fields}
             matched_sha1 |= archive_sha1s_matched
         response.media['unknown'] = tuple(input_sha1 - matched_sha1)
         response.status = falcon.HTTP_200
 
 
-# Setup App -------------------------------------------------------------------
+class VersionsResource():
+    """
+    GET /versions/ - loaded/loading versions
+    POST /versions/{version}?default=true - load `{versions_path}/{version}/roms.txt` in the background (202 - also while already loading). Already loaded, just swap the default
+    DELETE /versions/{version}
+    """
+    def __init__(self, versions, versions_path=None, rom_data_filename='roms.txt'):
+        self.versions = versions
+        self.versions_path = versions_path
+        self.rom_data_filename = rom_data_filename
+    def on_get(self, request, response):
+        response.media = {
+            'default': self.versions.default,
+            'versions': {
+                version: {layout: {'sha1': len(rom_data.sha1), 'archive': len(rom_data.archive)} for layout, rom_data in rom_datas.items()}
+                for version, rom_datas in self.versions.versions.items()
+            },
+            'loading': dict(self.versions.loading),
+        }
+        response.status = falcon.HTTP_200
+    def on_post_version(self, request, response, version):
+        default = request.get_param_as_bool('default', default=False)
+        if version in self.versions.versions:
+            if default:
+                self.versions.set_default(version)
+            response.status = falcon.HTTP_200
+            return
+        if self.versions.is_loading(version):
+            if default:
+                self.versions.set_default(version)
+            response.media = {'version': version, 'loading': self.versions.loading.get(version)}
+            response.status = falcon.HTTP_202
+            return
+        if not self.versions_path or not re.match(r'^(?!\.+$)[\w.-]+$', version):
+            raise falcon.HTTPNotFound(description=f'{version=} is not loaded')
+        rom_data_filename = os.path.join(self.versions_path, version, self.rom_data_filename)
+        if os.path.commonpath((os.path.realpath(rom_data_filename), os.path.realpath(self.versions_path))) != os.path.realpath(self.versions_path):
+            raise falcon.HTTPNotFound(description=f'{version=} is outside versions_path')
+        if not os.path.isfile(rom_data_filename):
+            raise falcon.HTTPNotFound(description=f'{rom_data_filename} does not exist')
+        self.versions.load_background(version, rom_data_filename, default=default)
+        response.status = falcon.HTTP_202
+    def on_delete_version(self, request, response, version):
+        if version == self.versions.default:
+            raise falcon.HTTPConflict(description=f'{version=} is the default - POST another version with ?default=true first')
+        if not self.versions.remove(version):
+            raise falcon.HTTPNotFound()
+        response.status = falcon.HTTP_200
+
+
+class VersionMiddleware():
+    """
+    Select the romdata version - `/version/{tag}/...` prefix, `?version=` or the default
+     - `/version/{tag}/...` routes are immutable and can be cached forever by nginx/browsers
+     - Strong ETags (version + loaded content + request + negotiated media type) with `If-None-Match` short circuiting before any lookup
+     - json and msgpack share a url - `Vary: Accept` so caches keep them apart
+    """
+    PREFIX = '/version/'
+    def __init__(self, versions):
+        self.versions = versions
+    def etag(self, request):
+        _hash = hashlib.sha1(f'{request.context.version} {self.versions.content_ids.get(request.context.version)} {negotiated_media_type(request)} {request.path}?{request.query_string}'.encode('utf8'))
+        if request.content_length:
+            _hash.update(''.join(sorted(set(request.get_media()))).encode('utf8'))  # /sets - order independent; media is cached for the responder
+        return _hash.hexdigest()
+    def process_request(self, request, response):
+        request.context.versioned = False
+        version = request.get_param('version')
+        if request.path.startswith(self.PREFIX):
+            version, _, path = request.path[len(self.PREFIX):].partition('/')
+            request.path = f'/{path}'
+            request.context.versioned = True
+        request.context.version = version or self.versions.default
+        request.context.rom_datas = self.versions.versions.get(request.context.version)  # one lookup - a concurrent swap can't split a request across versions
+        if request.path.startswith(('/metrics', '/profile', '/versions')):
+            return
+        if request.context.rom_datas is None:
+            raise falcon.HTTPNotFound(description=f'version={request.context.version} not available - {tuple(self.versions.versions.keys())}')
+        if request.method not in ('GET', 'HEAD'):
+            return
+        request.context.etag = self.etag(request)
+        response.etag = request.context.etag
+        response.vary = ('Accept', )
+        response.cache_control = ('public', 'max-age=31536000', 'immutable') if request.context.versioned else ('no-cache', )
+        if request.if_none_match and any(etag == request.context.etag for etag in request.if_none_match):
+            response.status = falcon.HTTP_304
+            response.complete = True
+    def process_response(self, request, response, resource, req_succeeded):
+        if not falcon.http_status_to_code(response.status) in (200, 304):
+            response.etag = None
+            response.cache_control = None
+
+
+class LayoutMiddleware():
+    """
+    Select the `RomData` for (version, `?layout=` merged/split/nonmerged) as `request.context.rom_data`
+    """
+    def __init__(self, default='merged'):
+        self.default = default
+    def process_request(self, request, response):
+        rom_datas = request.context.rom_datas or {}
+        layout = request.get_param('layout', default=self.default)
+        if rom_datas and layout not in rom_datas:
+            raise falcon.HTTPBadRequest(description=f'{layout=} is not loaded for version={request.context.version} - {tuple(rom_datas.keys())}')
+        request.context.rom_data = rom_datas.get(layout)
+
+
+class VersionedSearchResource():
+    """
+    A `SearchResource` (name index over the merged layout) per loaded version, built on first use
+    """
+    def __init__(self, versions):
+        self.versions = versions
+        self._search = {}
+    def on_get(self, request, response):
+        rom_data = request.context.rom_datas['merged']
+        search = self._search.get(request.context.version)
+        if not search or search.rom_data is not rom_data:
+            search = SearchResource(lambda: chain.from_iterable(rom_data.archive.values()))
+            search.rom_data = rom_data
+            self._search = {version: _search for version, _search in self._search.items() if version in self.versions.versions}
+            self._search[request.context.version] = search
+        search.on_get(request, response)
 
-def create_wsgi_app(rom_data_filename, **kwargs):
-    rom_data = RomData(rom_data_filename)
 
+# Setup App -------------------------------------------------------------------
+
+def create_wsgi_app(rom_data_filename, load_version=(), versions_path=None, **kwargs):
+    """
+    Alternative archive layouts are loaded from `roms.{layout}.txt` alongside `rom_data_filename` when present
+    `rom_data_filename` is the default version (`MAME_GIT_TAG`); `load_version` (`tag=roms.txt`) are loaded in the background
+    """
     app = falcon.API()
-    app.add_route(r'/', IndexResource(rom_data))
-    app.add_route(r'/sha1/{sha1}', SHA1InfoResource(rom_data))
-    add_sink(app, 'archive', ArchiveResource(rom_data), func_path_normalizer=func_path_normalizer_no_extension)
-    app.add_route(r'/sets', SetsResource(rom_data))
+    metrics = add_metrics(app)
+    def update_gauges(versions):
+        for name in ('romdata_sha1', 'romdata_archive'):
+            metrics.remove_gauges(name)
+        for version, rom_datas in versions.versions.items():
+            for layout, _rom_data in rom_datas.items():
+                metrics.gauge('romdata_sha1', lambda _rom_data=_rom_data: len(_rom_data.sha1), layout=layout, version=version)
+                metrics.gauge('romdata_archive', lambda _rom_data=_rom_data: len(_rom_data.archive), layout=layout, version=version)
+    versions = RomDataVersions(on_change=update_gauges)
+    metrics.gauge('romdata_versions_loading', lambda: len(versions.loading))
+
+    versions.load(os.environ.get('MAME_GIT_TAG') or 'default', rom_data_filename)
+    for version_filename in load_version:
+        version, _, _filename = version_filename.partition('=')
+        versions.load_background(version, _filename)
+
+    app.add_middleware(VersionMiddleware(versions))
+    app.add_middleware(LayoutMiddleware())
+    app.add_route(r'/', IndexResource(versions))
+    app.add_route(r'/sha1/{sha1}', SHA1InfoResource())
+    add_sink(app, 'archive', ArchiveResource(), func_path_normalizer=func_path_normalizer_no_extension)
+    app.add_route(r'/sets', SetsResource())
+    app.add_route(r'/roms', RomsResource())
+    app.add_route(r'/sha1_filter', SHA1FilterResource())
+    app.add_route(r'/search', VersionedSearchResource(versions))
+    versions_resource = VersionsResource(versions, versions_path=versions_path, rom_data_filename=os.path.basename(rom_data_filename))
+    app.add_route(r'/versions/', versions_resource)
+    app.add_route(r'/versions/{version}', versions_resource, suffix='version')
+    update_media_handlers(app)
+    add_profiling(app, **kwargs)
     return app
 
 
@@ -119,11 +436,15 @@ def get_args():
         ''',
     )
 
-    parser.add_argument('rom_data_filename', action='store', default='./roms.txt', help='')
+    parser.add_argument('rom_data_filename', action='store', default='./roms.txt', help='default version (`MAME_GIT_TAG`)')
+    parser.add_argument('--load_version', action='append', default=[], help='`tag=roms.txt` additional version loaded in the background and selected with `?version=tag` or `/version/tag/` - repeatable')
+    parser.add_argument('--versions_path', action='store', help='`{versions_path}/{tag}/roms.txt` can be loaded at runtime with `POST /versions/{tag}`')
 
     parser.add_argument('--host', action='store', default='0.0.0.0', help='')
     parser.add_argument('--port', action='store', default=9001, type=int, help='')
 
+    add_profile_args(parser)
+
     parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stdout', default=logging.INFO)
 
     kwargs = vars(parser.parse_args())
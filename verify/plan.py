@@ -0,0 +1,289 @@
+import sys
+import json
+import logging
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from _common.roms import RomData
+
+
+log = logging.getLogger(__name__)
+
+
+# Plan -------------------------------------------------------------------------
+
+OPS = ('extract', 'create', 'repack', 'rename_files', 'rename', 'delete')
+OPS_MODIFYING = frozenset(('repack', 'rename_files', 'rename', 'delete'))  # an archive read by others must wait for its readers
+
+
+def _changes():
+    return {'add': {}, 'remove': set(), 'rename_files': {}, 'rename_to': None}
+
+
+def _collect_changes(catalog_archives, verify_results, remove_unknown=False):
+    """
+    Group every change verify suggests into one set of changes per archive file
+    `move` sources are the archive verified (verify reports the renamed name for an archive it would rename)
+    """
+    changes = {}
+    conflicts = []
+    rename_targets = {}
+    for archive_name, result in verify_results:
+        if archive_name not in catalog_archives:
+            log.warning(f'{archive_name} is not in the catalog - ignored')
+            continue
+        _archive = changes.setdefault(archive_name, _changes())
+        rename_archive = set(result.get('rename_archive') or ()) - {archive_name}
+        if len(rename_archive) > 1:
+            conflicts.append({'archive_name': archive_name, 'reason': 'ambiguous_rename', 'rename_to': tuple(sorted(rename_archive))})
+        elif rename_archive:
+            rename_to = rename_archive.pop()
+            if rename_to in catalog_archives or rename_to in rename_targets:
+                conflicts.append({'archive_name': archive_name, 'reason': 'rename_target_exists', 'rename_to': rename_to})
+            else:
+                _archive['rename_to'] = rename_targets[rename_to] = rename_to
+        for rename in (result.get('rename_files') or {}).values():
+            _archive['rename_files'][rename['current']] = rename['expected']
+        unknown = set(result.get('unknown') or ())
+        if remove_unknown and unknown:
+            _archive['remove'] |= {rom.file_name for rom in catalog_archives[archive_name] if rom.sha1 in unknown}
+        for source, destination in result.get('move') or ():
+            _archive['remove'].add(source['file_name'])
+            changes.setdefault(destination['archive_name'], _changes())['add'][destination['file_name']] = {
+                'sha1': destination['sha1'],
+                'source_archive': archive_name,
+                'source_file_name': source['file_name'],
+            }
+    # Files moved to an archive that another archive is being renamed to are added to that archive, not a new one
+    for archive_name, archive_changes in tuple(changes.items()):
+        rename_to = archive_changes['rename_to']
+        if rename_to in changes and rename_to not in catalog_archives:
+            archive_changes['add'].update(changes.pop(rename_to)['add'])
+    return changes, conflicts
+
+
+def _step(archive_name, archive_changes, current_roms, sizes):
+    """
+    The single operation that applies all `archive_changes` to one archive
+    """
+    current = {rom.file_name: rom.sha1 for rom in current_roms}
+    contents = {
+        archive_changes['rename_files'].get(file_name, file_name): sha1
+        for file_name, sha1 in current.items() if file_name not in archive_changes['remove']
+    }
+    add = {
+        file_name: _add for file_name, _add in archive_changes['add'].items()
+        if contents.get(file_name) != _add['sha1']
+    }
+    contents.update({file_name: _add['sha1'] for file_name, _add in add.items()})
+    if not current_roms:
+        op = 'create'
+    elif not contents:
+        op = 'delete'
+    elif add or archive_changes['remove'] & current.keys():
+        op = 'repack'
+    elif archive_changes['rename_files']:
+        op = 'rename_files'
+    elif archive_changes['rename_to']:
+        op = 'rename'
+    else:
+        return None
+    step = {'op': op, 'archive_name': archive_name}
+    if archive_changes['rename_to'] and op != 'delete':
+        step['rename_to'] = archive_changes['rename_to']
+    if add:
+        step['add'] = [{'file_name': file_name, **_add} for file_name, _add in sorted(add.items())]
+    if op in ('repack', 'delete') and archive_changes['remove'] & current.keys():
+        step['remove'] = sorted(archive_changes['remove'] & current.keys())
+    if archive_changes['rename_files'] and op != 'delete':
+        step['rename_files'] = dict(sorted(archive_changes['rename_files'].items()))
+    step['files'] = len(contents)
+    step['bytes_to_recompress'] = sum(sizes.get(sha1) or 0 for sha1 in contents.values()) if op in ('create', 'repack') else 0
+    step['unknown_sizes'] = sum(sizes.get(sha1) is None for sha1 in contents.values()) if op in ('create', 'repack') else 0
+    return step
+
+
+def _order(steps):
+    """
+    Readers first - an archive is modified only once every step reading from it has run
+    Archives that read from each other (a cycle) have the files involved extracted to staging first
+
+    >>> steps = {
+    ...     'a': {'op': 'repack', 'archive_name': 'a', 'add': [{'file_name': 'x', 'sha1': '1', 'source_archive': 'b', 'source_file_name': 'x'}]},
+    ...     'b': {'op': 'repack', 'archive_name': 'b', 'add': [{'file_name': 'y', 'sha1': '2', 'source_archive': 'a', 'source_file_name': 'y'}]},
+    ...     'c': {'op': 'create', 'archive_name': 'c', 'add': [{'file_name': 'z', 'sha1': '3', 'source_archive': 'a', 'source_file_name': 'z'}]},
+    ... }
+    >>> [(step['op'], step['archive_name']) for step in _order(steps)]
+    [('create', 'c'), ('extract', None), ('repack', 'a'), ('repack', 'b')]
+    >>> steps['a']['add'][0]['source_archive'], steps['a']['add'][0]['staged']
+    ('b', True)
+    """
+    readers = {archive_name: set() for archive_name in steps}
+    for archive_name, step in steps.items():
+        for _add in step.get('add', ()):
+            if _add['source_archive'] in steps and steps[_add['source_archive']]['op'] in OPS_MODIFYING and _add['source_archive'] != archive_name:
+                readers[_add['source_archive']].add(archive_name)
+    ordered = []
+    remaining = set(steps)
+    while remaining:
+        ready = sorted(archive_name for archive_name in remaining if not readers[archive_name] & remaining)
+        if not ready:
+            # Cycle - stage every file read from a remaining archive, then the remaining archives can go in any order
+            extract = [
+                {'archive_name': _add['source_archive'], 'file_name': _add['source_file_name'], 'sha1': _add['sha1']}
+                for archive_name in sorted(remaining) for _add in steps[archive_name].get('add', ())
+                if _add['source_archive'] in remaining
+            ]
+            for archive_name in remaining:
+                for _add in steps[archive_name].get('add', ()):
+                    if _add['source_archive'] in remaining:
+                        _add['staged'] = True
+            ordered.append({'op': 'extract', 'archive_name': None, 'extract': extract})
+            ready = sorted(remaining)
+        for archive_name in ready:
+            ordered.append(steps[archive_name])
+            remaining.discard(archive_name)
+    return ordered
+
+
+def plan_fixes(catalog_archives, verify_results, remove_unknown=False):
+    """
+    A global plan from bulk verify output - every change to an archive is folded into one step, so each archive is
+    rewritten at most once. Steps are ordered so source files are read before the archives holding them are rewritten
+
+    `catalog_archives` {archive_name: roms} from the catalog (`RomData.archive` of `catalog.txt` - sizes are used for `bytes_to_recompress`)
+    `verify_results` iterable of (archive_name, verify result)
+
+    >>> from _common.roms import Rom
+    >>> catalog_archives = {
+    ...     'sfa3': {Rom('0'*40, 'sfa3', 'sz3.01', size=4), Rom('2'*40, 'sfa3', 'sz2.01', size=2)},
+    ...     'mslug': {Rom('3'*40, 'mslug', 'p1.bin', size=8)},
+    ...     'unsorted/x': {Rom('4'*40, 'unsorted/x', 'sz.01', size=1)},
+    ...     'mvsc': {Rom('5'*40, 'mvsc', 'a.bin', size=1), Rom('6'*40, 'mvsc', 'b.bin', size=1)},
+    ... }
+    >>> verify_results = (
+    ...     ('sfa3', {'move': [({'sha1': '2'*40, 'archive_name': 'sfa3', 'file_name': 'sz2.01'}, {'sha1': '2'*40, 'archive_name': 'sfa2', 'file_name': 'sz2.01'})]}),
+    ...     ('mslug', {'rename_files': {'3'*40: {'current': 'p1.bin', 'expected': '201-p1.p1'}}}),
+    ...     ('unsorted/x', {'rename_archive': ['sfz']}),
+    ...     ('mvsc', {'unknown': ['5'*40, '6'*40]}),
+    ... )
+    >>> plan = plan_fixes(catalog_archives, verify_results, remove_unknown=True)
+    >>> [(step['op'], step['archive_name'], step.get('rename_to'), step['bytes_to_recompress']) for step in plan['steps']]
+    [('rename_files', 'mslug', None, 0), ('delete', 'mvsc', None, 0), ('create', 'sfa2', None, 2), ('rename', 'unsorted/x', 'sfz', 0), ('repack', 'sfa3', None, 4)]
+    >>> plan['summary']
+    {'archives': 5, 'create': 1, 'repack': 1, 'rename_files': 1, 'rename': 1, 'delete': 1, 'bytes_to_recompress': 6, 'unknown_sizes': 0, 'conflicts': 0}
+
+    From `verify_results` - a rom belonging to `sfa2` (not yet in the collection) is held in `sfa3`
+    >>> from verify.verify import verify_results
+    >>> catalog = {'0'*40: 'sz3.01', '2'*40: 'sz2.01'}
+    >>> romdata = {'romsets': {
+    ...     'sfa3': {'matched': ['0'*40], 'missing': ['1'*40], 'files': {'0'*40: 'sz3.01', '1'*40: 'sz3.02'}},
+    ...     'sfa2': {'matched': ['2'*40], 'missing': [], 'files': {'2'*40: 'sfa2.bin'}},
+    ... }, 'unknown': []}
+    >>> result = verify_results('sfa3', catalog, romdata)
+    >>> result['move']
+    [({'sha1': '2222222222222222222222222222222222222222', 'archive_name': 'sfa3', 'file_name': 'sz2.01'}, {'sha1': '2222222222222222222222222222222222222222', 'archive_name': 'sfa2', 'file_name': 'sfa2.bin'})]
+    >>> plan = plan_fixes({'sfa3': {Rom('0'*40, 'sfa3', 'sz3.01', size=4), Rom('2'*40, 'sfa3', 'sz2.01', size=2)}}, (('sfa3', result), ))
+    >>> [(step['op'], step['archive_name'], step.get('add', [{}])[0].get('source_archive'), step.get('remove')) for step in plan['steps']]
+    [('create', 'sfa2', 'sfa3', None), ('repack', 'sfa3', None, ['sz2.01'])]
+    """
+    changes, conflicts = _collect_changes(catalog_archives, verify_results, remove_unknown=remove_unknown)
+    sizes = {rom.sha1: rom.size for roms in catalog_archives.values() for rom in roms if rom.size is not None}
+    steps = {}
+    for archive_name, archive_changes in changes.items():
+        step = _step(archive_name, archive_changes, catalog_archives.get(archive_name, ()), sizes)
+        if step:
+            steps[archive_name] = step
+    ordered = _order(steps)
+    return {
+        'steps': ordered,
+        'conflicts': conflicts,
+        'summary': summarise(ordered, conflicts),
+    }
+
+
+def summarise(steps, conflicts=()):
+    summary = {'archives': sum(step['op'] != 'extract' for step in steps)}
+    summary.update({op: sum(step['op'] == op for step in steps) for op in OPS if op != 'extract'})
+    summary['bytes_to_recompress'] = sum(step.get('bytes_to_recompress', 0) for step in steps)
+    summary['unknown_sizes'] = sum(step.get('unknown_sizes', 0) for step in steps)
+    summary['conflicts'] = len(conflicts)
+    return summary
+
+
+# Bulk verify ------------------------------------------------------------------
+
+def iter_verify_jsonl(filehandle):
+    """
+    Bulk verify output - json lines of `{"archive_name": ..., "verify": {...}}`
+    """
+    for line in filehandle:
+        if line.strip():
+            record = json.loads(line)
+            yield record['archive_name'], record['verify']
+
+
+def iter_verify_api(url_api_verify, archive_names, threads=8):
+    """
+    `/verify/{archive_name}` for every archive. Archives verify can't answer yet (202/404/422) are logged and skipped
+    """
+    session = requests.Session()
+    def _verify(archive_name):
+        response = session.get(f'{url_api_verify}/verify/{archive_name}')
+        if response.status_code != 200:
+            log.warning(f'{archive_name} not verified - {response.status_code}')
+            return archive_name, None
+        return archive_name, response.json()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for archive_name, result in executor.map(_verify, archive_names):
+            if result is not None:
+                yield archive_name, result
+
+
+def main(catalog_data_filename, verify_filename=None, url_api_verify=None, save_verify=None, remove_unknown=False, summary=False, threads=8, **kwargs):
+    with redirect_stdout(sys.stderr):  # RomData progress
+        catalog_data = RomData(catalog_data_filename)
+    if verify_filename:
+        verify_results = tuple(iter_verify_jsonl(sys.stdin if verify_filename == '-' else open(verify_filename, 'rt')))
+    elif url_api_verify:
+        verify_results = tuple(iter_verify_api(url_api_verify, sorted(catalog_data.archive.keys()), threads=threads))
+    else:
+        raise ValueError('verify_filename or url_api_verify required')
+    if save_verify:
+        with open(save_verify, 'wt') as filehandle:
+            for archive_name, result in verify_results:
+                filehandle.write(json.dumps({'archive_name': archive_name, 'verify': result}) + '\n')
+    plan = plan_fixes(catalog_data.archive, verify_results, remove_unknown=remove_unknown)
+    print(json.dumps(plan['summary'] if summary else plan, indent=2))
+
+
+def get_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=__name__,
+        description='''
+        Collection-wide fix plan from bulk verify output - create/repack/rename/delete steps touching each archive at most once
+        ''',
+    )
+
+    parser.add_argument('catalog_data_filename', action='store', help='catalog.txt')
+    parser.add_argument('--verify_filename', action='store', help='bulk verify json lines `{"archive_name", "verify"}` (`-` for stdin)')
+    parser.add_argument('--url_api_verify', action='store', help='verify every catalogued archive via the verify api instead of --verify_filename')
+    parser.add_argument('--save_verify', action='store', help='write the bulk verify json lines fetched from --url_api_verify')
+    parser.add_argument('--threads', action='store', type=int, default=8, help='concurrent verify requests')
+    parser.add_argument('--remove_unknown', action='store_true', help='drop files romdata does not know (default keeps them)')
+    parser.add_argument('--summary', action='store_true', help='totals only')
+
+    parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stderr', default=logging.WARNING)
+
+    kwargs = vars(parser.parse_args())
+    return kwargs
+
+
+if __name__ == "__main__":
+    kwargs = get_args()
+    logging.basicConfig(level=kwargs['log_level'])
+    main(**kwargs)
@@ -1,17 +1,23 @@
 import os
+import time
 from collections import defaultdict
-from functools import reduce
+from functools import reduce, lru_cache
 import json
 
 import requests
 import falcon
 
-from _common.falcon_helpers import add_sink, func_path_normalizer_no_extension, update_json_handlers
+from _common.falcon_helpers import add_sink, func_path_normalizer_no_extension, update_media_handlers, response_media, msgpack, MEDIA_SHA1
+from _common.profiling import add_profiling, add_profile_args
+from _common.metrics import Metrics, add_metrics
+from _common.bloom import BloomFilter
+from _common.shard import ShardRouter, add_shard_args
 
 import logging
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+SHA1_FILTER_RETRY_SECONDS = 60
 
 
 def verify_results(archive_name, catalog, romdata):
@@ -37,8 +43,8 @@ def verify_results(archive_name, catalog, romdata):
     # Filenames
     def _rename_files_reducer(acc, catalog_pair):
         sha1, file_name = catalog_pair
-        _expected_filename = romset['files'][sha1]
-        if _expected_filename != file_name:
+        _expected_filename = romset['files'].get(sha1)
+        if _expected_filename and _expected_filename != file_name:  # sha1s not in this romset are reported as `unknown`/`move`
             acc[sha1] = {'current': file_name, 'expected': _expected_filename}
         return acc
     _return['rename_files'] = reduce(_rename_files_reducer, catalog.items(), {})
@@ -62,7 +68,7 @@ def verify_results(archive_name, catalog, romdata):
         if sha1 in identified_sha1s:
             return acc
         for _archive_name, _data in romdata['romsets'].items():
-            if _archive_name in completed_archive_names:
+            if _archive_name == archive_name:
                 continue
             if sha1 in set(_data['matched']):
                 acc.append((
@@ -80,33 +86,119 @@ def verify_results(archive_name, catalog, romdata):
 # ------------------------------------------------------------------------------
 
 class VerifyResource():
-    def __init__(self, get_romdata, get_catalog):
+    MAX_WAIT_SECONDS = 300
+    def __init__(self, get_romdata, get_catalog, prioritise_catalog, poll_seconds=0.5):
         self.get_romdata = get_romdata
         self.get_catalog = get_catalog
+        self.prioritise_catalog = prioritise_catalog
+        self.poll_seconds = poll_seconds
+    def _wait_for_catalog(self, archive_name, seconds):
+        deadline = time.monotonic() + min(seconds, self.MAX_WAIT_SECONDS)
+        catalog = {}
+        while not catalog and time.monotonic() < deadline:
+            time.sleep(self.poll_seconds)
+            catalog = self.get_catalog(archive_name)
+        return catalog
     def on_get(self, request, response, archive_name):
+        """
+        `?layout=split|nonmerged` verifies against another romdata archive layout (default merged)
+        An archive the catalog has not hashed yet is moved to the front of the catalog queue
+        `?wait=seconds` waits for it to be hashed - otherwise (or on timeout) 202 Accepted
+        """
         catalog = self.get_catalog(archive_name)
-        romdata = self.get_romdata(catalog.keys())
+        if not catalog:
+            status = self.prioritise_catalog(archive_name)
+            if not status:
+                raise falcon.HTTPNotFound(description=f'{archive_name} is not in the catalog rom_path')
+            if status == 'failed':
+                raise falcon.HTTPUnprocessableEntity(description=f'catalog workers failed to hash {archive_name} - see catalog /failed/')
+            if status == 'queued':
+                catalog = self._wait_for_catalog(archive_name, request.get_param_as_float('wait', default=0, min_value=0))
+            if not catalog and status == 'queued':
+                response.media = {'catalog': status}
+                response.status = falcon.HTTP_202
+                return
+        romdata = self.get_romdata(catalog.keys(), layout=request.get_param('layout'))
         response.media = verify_results(archive_name, catalog, romdata)
         response.status = falcon.HTTP_200
 
 
 # Setup App -------------------------------------------------------------------
 
-def create_wsgi_app(url_api_romdata, url_api_catalog, **kwargs):
+def create_wsgi_app(url_api_romdata, url_api_catalog, shard_by='archive', **kwargs):
+    """
+    `url_api_catalog` is a comma separated list of catalog shards (in shard index order)
+    """
+    metrics = Metrics()
+    catalog_router = ShardRouter(url_api_catalog, by=shard_by)
+    @lru_cache(maxsize=1)
+    def get_url_api_romdata():
+        """
+        Use the immutable `/version/{tag}/` routes so repeat lookups can be served from the nginx cache
+        """
+        version = requests.get(url_api_romdata).json().get('version')
+        return os.path.join(url_api_romdata, 'version', version) if version else url_api_romdata
+    @lru_cache(maxsize=1)
+    def _get_sha1_filter():
+        response = requests.get(os.path.join(get_url_api_romdata(), 'sha1_filter'))
+        response.raise_for_status()
+        return BloomFilter.from_bytes(response.content)
+    sha1_filter_retry = {'time': 0}
+    def get_sha1_filter():
+        """
+        Failures are not cached - the filter is fetched again after `SHA1_FILTER_RETRY_SECONDS`
+        """
+        if time.time() < sha1_filter_retry['time']:
+            return None
+        try:
+            return _get_sha1_filter()
+        except (requests.RequestException, ValueError) as ex:
+            log.warning(f'romdata sha1_filter unavailable - all sha1s will be sent to /sets for {SHA1_FILTER_RETRY_SECONDS}s - {ex}')
+            sha1_filter_retry['time'] = time.time() + SHA1_FILTER_RETRY_SECONDS
+            return None
     def get_catalog(archive_name):
-        return requests.get(os.path.join(url_api_catalog, 'archive', archive_name)).json()
-    def get_romdata(sha1s):
-        return requests.get(
-            os.path.join(url_api_romdata, 'sets'),
-            json=tuple(sha1s),
-            headers={'Content-Type': 'application/json'},
-        ).json()
+        with metrics.timer('verify_upstream_seconds', service='catalog'):
+            return requests.get(os.path.join(catalog_router.url(archive_name), 'archive', archive_name)).json()
+    def prioritise_catalog(archive_name):
+        return requests.post(os.path.join(catalog_router.url(archive_name), 'priority', archive_name)).json().get('status')
+    def get_romdata(sha1s, layout=None, retry=True):
+        """
+        sha1s that are definitely not in romdata (bloom filter) are classified `unknown` without a call to `/sets`
+        """
+        sha1_filter = get_sha1_filter()
+        if sha1_filter:
+            sha1s = tuple(sha1s)
+            unknown = tuple(sha1 for sha1 in sha1s if sha1 not in sha1_filter)
+            metrics.inc('verify_sha1_filtered_total', len(unknown))
+            if unknown:
+                known = set(sha1s) - set(unknown)
+                romdata = _get_romdata(known, layout, retry) if known else {'romsets': {}, 'unknown': ()}
+                return {**romdata, 'unknown': (*romdata['unknown'], *unknown)}
+        return _get_romdata(sha1s, layout, retry)
+    def _get_romdata(sha1s, layout=None, retry=True):
+        with metrics.timer('verify_upstream_seconds', service='romdata'):
+            response = requests.get(
+                os.path.join(get_url_api_romdata(), 'sets'),
+                data=b''.join(map(bytes.fromhex, sha1s)),
+                params={'layout': layout} if layout else None,
+                headers={'Content-Type': MEDIA_SHA1, 'Accept': falcon.MEDIA_MSGPACK if msgpack else falcon.MEDIA_JSON},
+            )
+            if response.status_code == 404:  # romdata has been redeployed with a new version
+                if not retry:
+                    raise falcon.HTTPBadGateway(description=f'romdata /sets 404 after refreshing the version - {response.text}')
+                get_url_api_romdata.cache_clear()
+                _get_sha1_filter.cache_clear()
+                sha1_filter_retry['time'] = 0
+                return get_romdata(sha1s, layout, retry=False)
+            return response_media(response)
 
 
     app = falcon.API()
     #app.add_route(r'/', IndexResource(rom_data))
-    add_sink(app, 'verify', VerifyResource(get_romdata, get_catalog), func_path_normalizer=func_path_normalizer_no_extension)
-    update_json_handlers(app)
+    add_sink(app, 'verify', VerifyResource(get_romdata, get_catalog, prioritise_catalog), func_path_normalizer=func_path_normalizer_no_extension)
+    update_media_handlers(app)
+    add_metrics(app, metrics)
+    add_profiling(app, **kwargs)
     return app
 
 
@@ -122,11 +214,14 @@ def get_args():
     )
 
     parser.add_argument('--url_api_romdata', action='store', required=True, help='')
-    parser.add_argument('--url_api_catalog', action='store', required=True, help='')
+    parser.add_argument('--url_api_catalog', action='store', required=True, help='comma separated for a sharded catalog')
+    add_shard_args(parser)
 
     parser.add_argument('--host', action='store', default='0.0.0.0', help='')
     parser.add_argument('--port', action='store', default=9003, type=int, help='')
 
+    add_profile_args(parser)
+
     parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stdout', default=logging.INFO)
 
     kwargs = vars(parser.parse_args())
@@ -153,7 +248,10 @@ if __name__ == '__main__':
     logging.basicConfig(level=kwargs['log_level'])
 
     from wsgiref import simple_server
-    httpd = simple_server.make_server(kwargs['host'], kwargs['port'], create_wsgi_app(**kwargs))
+    from socketserver import ThreadingMixIn
+    class ThreadingWSGIServer(ThreadingMixIn, simple_server.WSGIServer):
+        daemon_threads = True  # `?wait=` holds a request open - don't block other verify requests
+    httpd = simple_server.make_server(kwargs['host'], kwargs['port'], create_wsgi_app(**kwargs), server_class=ThreadingWSGIServer)
     try:
         log.info('start')
         httpd.serve_forever()
@@ -1,18 +1,38 @@
 import os
+import json
+import shutil
+import hashlib
 import logging
 import pathlib
 import datetime
 import tempfile
+import threading
 import time
+from contextlib import contextmanager
 
 import requests
 
 from _common.scan import fast_scan
+from _common.digests import hash_file
 from _common.p7zip import P7Zip
+from _common.metrics import Metrics
+from _common.profiling import Profiler, ProfileResource, init_profile_signal_handler, add_profile_args
+from _common.throttle import create_throttle, add_throttle_args
 
 
 log = logging.getLogger(__name__)
 p7zip = P7Zip()
+metrics = Metrics()
+
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+POST_RETRIES = 3
+CLAIM_RENEW_SECONDS = 5 * 60  # well inside the catalog `CLAIM_TIMEOUT_SECONDS`
+
+
+class PostFailed(Exception):
+    """
+    The archive was hashed but the catalog did not take the result - not a failure of the archive
+    """
 
 
 def hash_archive(rom_path, archive):
@@ -22,34 +42,374 @@ def hash_archive(rom_path, archive):
         # Extract Archive - to tempdir
         destination_folder = os.path.abspath(os.path.join(tempdir, archive_name))
         os.makedirs(destination_folder)
-        p7zip.extract(
-            cwd=tempdir,
-            source_file=rom_path.joinpath(archive).resolve(),
-            destination_folder=destination_folder,
-        )
+        with metrics.timer('worker_stage_seconds', buckets=STAGE_BUCKETS, stage='extract'):
+            p7zip.extract(
+                cwd=tempdir,
+                source_file=rom_path.joinpath(archive).resolve(),
+                destination_folder=destination_folder,
+            )
         # Hash check archive content as Rom list
-        return tuple(
-            dict(
-                sha1=p7zip.hash(tempdir, rom_file.abspath),
-                archive_name=archive_name,
-                file_name=rom_file.relative,
+        with metrics.timer('worker_stage_seconds', buckets=STAGE_BUCKETS, stage='hash'):
+            return tuple(
+                dict(
+                    **_hash_file(rom_file.abspath),
+                    archive_name=archive_name,
+                    file_name=rom_file.relative,
+                )
+                for rom_file in fast_scan(destination_folder)
+            )
+
+
+def _hash_file(filename):
+    """
+    size/crc/md5/sha1 in one (throttled) read
+    """
+    if p7zip.throttle:
+        return hash_file(filename, read=p7zip.throttle.read)
+    return hash_file(filename)
+
+
+def claim_next_file(url_api_catalogs, start=0):
+    """
+    Claim from each catalog shard in turn (starting at `start`) - returns (url_api_catalog, next_file) of the first with work
+    The archive is posted back to the shard it was claimed from
+    """
+    remaining = 0
+    for url_api_catalog in url_api_catalogs[start:] + url_api_catalogs[:start]:
+        next_file = requests.get(f'{url_api_catalog}/next_file').json()
+        remaining += next_file.get('remaining', 0)
+        if next_file['file']:
+            return url_api_catalog, {**next_file, 'remaining': remaining}
+    return None, {'file': None, 'remaining': remaining}
+
+
+def renew_claim(url_api_catalog, _file):
+    try:
+        requests.post(f'{url_api_catalog}/claim/{_file}').raise_for_status()
+    except requests.RequestException as ex:
+        log.warning(f'Unable to renew claim of {_file} - {ex}')
+
+
+@contextmanager
+def claim_renewed(url_api_catalog, _file, renew_seconds=CLAIM_RENEW_SECONDS):
+    """
+    Renew the catalog claim every `renew_seconds` while an archive is hashed - a multi hour solid archive is not handed to another worker
+    """
+    stop = threading.Event()
+    def _renew():
+        while not stop.wait(renew_seconds):
+            renew_claim(url_api_catalog, _file)
+    thread = threading.Thread(target=_renew, daemon=True, name='renew_claim')
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+# Checkpointing ----------------------------------------------------------------
+
+class Checkpoint():
+    """
+    Per member progress hashing one large archive - json lines appended as each member is hashed so a restarted worker resumes after the last completed member
+    The first line identifies the archive version; the checkpoint of a changed archive is discarded
+
+    >>> import tempfile, types
+    >>> tempdir = tempfile.TemporaryDirectory()
+    >>> stat = types.SimpleNamespace(st_mtime=1.0, st_size=1024)
+    >>> checkpoint = Checkpoint(tempdir.name, 'big.7z', stat, url_api_catalog='http://catalog:9002')
+    >>> checkpoint.add(dict(sha1='0'*40, archive_name='big', file_name='a.bin'))
+    >>> checkpoint.close()
+    >>> with open(checkpoint.filename, 'at') as filehandle:
+    ...     _ = filehandle.write('{"sha1": "tor')  # killed mid write
+    >>> tuple(Checkpoint(tempdir.name, 'big.7z', stat).roms)
+    ('a.bin',)
+    >>> [header['archive'] for header in Checkpoint.pending(tempdir.name)]
+    ['big.7z']
+    >>> tuple(Checkpoint(tempdir.name, 'big.7z', types.SimpleNamespace(st_mtime=2.0, st_size=1024)).roms)
+    ()
+    >>> checkpoint.clear()
+    >>> tuple(Checkpoint.pending(tempdir.name))
+    ()
+
+    A checkpoint for an archive that is gone (or no longer checkpointed) is discarded by name
+    >>> Checkpoint(tempdir.name, 'big.7z', stat).add(dict(sha1='0'*40, archive_name='big', file_name='a.bin'))
+    >>> Checkpoint.discard(tempdir.name, 'big.7z')
+    >>> tuple(Checkpoint.pending(tempdir.name))
+    ()
+    >>> tempdir.cleanup()
+    """
+    def __init__(self, path, archive, stat, url_api_catalog=None):
+        self.header = {'archive': str(archive), 'mtime': str(stat.st_mtime), 'size': stat.st_size}
+        self.url_api_catalog = url_api_catalog
+        self.filename, self.workdir = self._paths(path, archive)
+        self.roms = self._load()
+        self._filehandle = None
+
+    @staticmethod
+    def _paths(path, archive):
+        name = hashlib.sha1(str(archive).encode('utf8')).hexdigest()
+        return os.path.join(path, f'{name}.jsonl'), os.path.join(path, name)
+
+    @staticmethod
+    def _read(filename):
+        with open(filename, 'rt', encoding='utf8') as filehandle:
+            yield json.loads(filehandle.readline())
+            for line in filehandle:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return  # torn final line
+
+    def _load(self):
+        try:
+            header, *roms = self._read(self.filename)
+        except (OSError, ValueError):
+            return {}
+        if {k: header.get(k) for k in self.header} != self.header:
+            log.info(f'Discarding checkpoint for changed {self.header["archive"]}')
+            return {}
+        return {rom['file_name']: rom for rom in roms}
+
+    @classmethod
+    def pending(cls, path):
+        """
+        Headers of the checkpoints left by a previous run
+        """
+        if not os.path.isdir(path):
+            return
+        for dir_entry in os.scandir(path):
+            if dir_entry.name.endswith('.jsonl'):
+                try:
+                    yield next(cls._read(dir_entry.path))
+                except (OSError, ValueError, StopIteration):
+                    pass
+
+    def add(self, rom):
+        if not self._filehandle:
+            # Rewrite what was loaded - drops a torn final line before appending
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            self._filehandle = open(self.filename, 'wt', encoding='utf8')
+            self._filehandle.write(json.dumps({**self.header, 'catalog': self.url_api_catalog}) + '\n')
+            self._filehandle.writelines(json.dumps(_rom) + '\n' for _rom in self.roms.values())
+        self.roms[rom['file_name']] = rom
+        self._filehandle.write(json.dumps(rom) + '\n')
+        self._filehandle.flush()
+
+    def close(self):
+        if self._filehandle:
+            self._filehandle.close()
+            self._filehandle = None
+
+    def clear_workdir(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def clear(self):
+        self.close()
+        self.clear_workdir()
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+    @classmethod
+    def discard(cls, path, archive):
+        """
+        Remove any checkpoint for `archive` without reading it (the archive may no longer exist to `stat`)
+        """
+        filename, workdir = cls._paths(path, archive)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if os.path.isfile(filename):
+            log.info(f'Discarding checkpoint for {archive}')
+            os.remove(filename)
+
+
+def hash_archive_resumable(rom_path, archive, checkpoint):
+    """
+    `hash_archive` for large archives - members already hashed (checkpoint) or completely extracted (previous run) are not redone
+    Members are extracted to the checkpoint workdir and removed once hashed
+    """
+    archive_name = os.path.join(archive.parent.name, archive.stem)
+    source_file = rom_path.joinpath(archive).resolve()
+    members = p7zip.list(source_file)
+    todo = tuple(member for member in members if member.path not in checkpoint.roms)
+    if len(todo) < len(members):
+        log.info(f'Resuming {archive_name} - {len(members) - len(todo)}/{len(members)} members hashed')
+    os.makedirs(checkpoint.workdir, exist_ok=True)
+    def _checkpoint(member, digests):
+        checkpoint.add(dict(**digests, archive_name=archive_name, file_name=member.path))
+        os.remove(os.path.join(checkpoint.workdir, member.path))
+        metrics.set('worker_last_progress_timestamp_seconds', time.time())
+    # Members completely extracted by a previous run (size and crc match the listing) are hashed without extracting again
+    missing = []
+    with metrics.timer('worker_stage_seconds', buckets=STAGE_BUCKETS, stage='hash'):
+        for member in todo:
+            filename = os.path.join(checkpoint.workdir, member.path)
+            if member.crc and os.path.isfile(filename) and os.path.getsize(filename) == member.size:
+                digests = _hash_file(filename)
+                if digests['crc'] == member.crc:
+                    _checkpoint(member, digests)
+                    continue
+            missing.append(member)
+    with metrics.timer('worker_stage_seconds', buckets=STAGE_BUCKETS, stage='extract'):
+        if missing:
+            p7zip.extract(
+                cwd=checkpoint.workdir,
+                source_file=source_file,
+                destination_folder=checkpoint.workdir,
+                files=tuple(member.path for member in missing),
             )
-            for rom_file in fast_scan(destination_folder)
-        )
+    with metrics.timer('worker_stage_seconds', buckets=STAGE_BUCKETS, stage='hash'):
+        for member in missing:
+            _checkpoint(member, _hash_file(os.path.join(checkpoint.workdir, member.path)))
+    return tuple(checkpoint.roms.values())
+
+
+# Worker -----------------------------------------------------------------------
+
+def process_archive(rom_path, url_api_catalog, _file, profiler=None, checkpoint_path=None, checkpoint_min_bytes=0):
+    """
+    Hash and post one archive. Archives over `checkpoint_min_bytes` are checkpointed per member
+    """
+    archive = pathlib.Path(_file)
+    try:
+        stat = rom_path.joinpath(archive).stat()
+    except FileNotFoundError:
+        if checkpoint_path:
+            Checkpoint.discard(checkpoint_path, archive)  # otherwise resumed (and failed) on every restart
+        raise
+    checkpoint = None
+    if checkpoint_path and stat.st_size >= checkpoint_min_bytes:
+        checkpoint = Checkpoint(checkpoint_path, archive, stat, url_api_catalog=url_api_catalog)
+    elif checkpoint_path:
+        Checkpoint.discard(checkpoint_path, archive)  # shrunk below `checkpoint_min_bytes` since checkpointed
+    def _hash_archive():
+        if checkpoint:
+            return hash_archive_resumable(rom_path, archive, checkpoint)
+        return hash_archive(rom_path, archive)
+    start = time.perf_counter()
+    try:
+        with claim_renewed(url_api_catalog, _file):  # stopped before the post - a late renewal can't reclaim a catalogued archive
+            if profiler:
+                with profiler.profile(_file):
+                    roms = _hash_archive()
+            else:
+                roms = _hash_archive()
+    except Exception:
+        if checkpoint:
+            checkpoint.close()
+            checkpoint.clear_workdir()  # keep the hashed members - free the disk
+        raise
+    metrics.inc('worker_archives_total')
+    metrics.inc('worker_bytes_total', stat.st_size)
+    metrics.set('worker_bytes_per_second', stat.st_size / max(time.perf_counter() - start, 1e-6))
+    with metrics.timer('worker_stage_seconds', buckets=STAGE_BUCKETS, stage='post'):
+        try:
+            requests.post(f'{url_api_catalog}/archive/{_file}', json={
+                #'archive_file': _file,
+                'mtime': str(stat.st_mtime),
+                'roms': roms,
+            }).raise_for_status()
+        except requests.RequestException as ex:
+            if checkpoint:
+                checkpoint.close()  # kept - a retry re-reads the hashed members
+            raise PostFailed(f'{url_api_catalog} did not accept {_file} - {ex}') from ex
+    if checkpoint:
+        checkpoint.clear()
+
+
+def report_failure(url_api_catalog, rom_path, _file, ex):
+    """
+    The catalog skips failed archives until they change
+    """
+    metrics.inc('worker_failures_total')
+    try:
+        mtime = str(rom_path.joinpath(_file).stat().st_mtime)
+    except OSError:
+        mtime = None
+    try:
+        requests.post(f'{url_api_catalog}/failed/{_file}', json={
+            'mtime': mtime,
+            'error': f'{type(ex).__name__}: {ex}',
+        })
+    except requests.RequestException:
+        log.exception(f'Unable to report failure of {_file}')
 
 
-def worker_catalog(rom_path, url_api_catalog, sleep, **kwags):
+def worker_catalog(rom_path, url_api_catalog, sleep, profiler=None, checkpoint_path=None, checkpoint_min_bytes=0, postmortem=False, **kwags):
+    """
+    `url_api_catalog` is a comma separated list of catalog shards
+    Archives checkpointed by a previous run are resumed first
+    A failed archive is reported to the catalog and the worker moves on (`postmortem` raises for debugging)
+    An archive the catalog did not accept is retried (`POST_RETRIES`) - it is not reported as failed
+    """
+    url_api_catalogs = tuple(url.strip() for url in url_api_catalog.split(','))
+    resume = [
+        (header.get('catalog') if header.get('catalog') in url_api_catalogs else url_api_catalogs[0], header['archive'])
+        for header in Checkpoint.pending(checkpoint_path)
+    ] if checkpoint_path else []
+    for url_api_catalog, _file in resume:
+        renew_claim(url_api_catalog, _file)  # not handed to another worker while this one resumes
+    shard_start = 0
+    post_attempts = {}
     while True:
-        _file = requests.get(f'{url_api_catalog}/next_file').json()['file']
+        metrics.set('worker_last_progress_timestamp_seconds', time.time())
+        if resume:
+            url_api_catalog, _file = resume.pop()
+            log.info(f'Resuming checkpointed {_file}')
+        else:
+            try:
+                with metrics.timer('worker_stage_seconds', buckets=STAGE_BUCKETS, stage='claim'):
+                    url_api_catalog, next_file = claim_next_file(url_api_catalogs, shard_start)
+            except requests.RequestException as ex:
+                log.warning(f'Unable to claim from catalog - {ex}')
+                time.sleep(sleep.total_seconds())
+                continue
+            shard_start = (shard_start + 1) % len(url_api_catalogs)
+            _file = next_file['file']
+            metrics.set('worker_queue_depth', next_file.get('remaining', 0))
         if not _file:
+            metrics.set('worker_busy', 0)
             time.sleep(sleep.total_seconds())
             continue
-        archive = pathlib.Path(_file)
-        requests.post(f'{url_api_catalog}/archive/{_file}', json={
-            #'archive_file': _file,
-            'mtime': str(rom_path.joinpath(archive).stat().st_mtime),
-            'roms': hash_archive(rom_path, archive),
-        })
+        metrics.set('worker_busy', 1)
+        try:
+            process_archive(rom_path, url_api_catalog, _file, profiler, checkpoint_path, checkpoint_min_bytes)
+            post_attempts.pop(_file, None)
+        except PostFailed as ex:
+            post_attempts[_file] = post_attempts.get(_file, 0) + 1
+            if post_attempts[_file] < POST_RETRIES:
+                log.warning(f'{ex} - retrying')
+                resume.append((url_api_catalog, _file))
+            else:
+                log.error(f'{ex} - giving up after {POST_RETRIES} attempts')
+                del post_attempts[_file]
+            time.sleep(sleep.total_seconds())
+        except Exception as ex:
+            if postmortem:
+                raise
+            log.exception(f'Failed {_file}')
+            report_failure(url_api_catalog, rom_path, _file, ex)
+
+
+def serve_metrics(host, port, profiler=None):
+    """
+    `/metrics` for the worker in a background thread
+    A stuck worker shows `worker_busy 1` with a stale `worker_last_progress_timestamp_seconds`
+    """
+    import threading
+    from wsgiref import simple_server
+    import falcon
+    from _common.metrics import add_metrics
+    app = falcon.API()
+    add_metrics(app, metrics)
+    if profiler:
+        resource = ProfileResource(profiler)
+        app.add_route(r'/profile', resource)
+        app.add_route(r'/profile/collapsed', resource, suffix='collapsed')
+        app.add_route(r'/profile/tracemalloc', resource, suffix='tracemalloc')
+    httpd = simple_server.make_server(host, port, app)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
 
 
 def get_args():
@@ -62,15 +422,24 @@ def get_args():
     )
 
     parser.add_argument('--rom_path', action='store', required=True, default='', help='')
-    parser.add_argument('--url_api_catalog', action='store', required=True, default='', help='')
+    parser.add_argument('--url_api_catalog', action='store', required=True, default='', help='comma separated for a sharded catalog')
 
     parser.add_argument('--sleep', action='store', type=int, default=60)
+    parser.add_argument('--metrics_host', action='store', default='0.0.0.0', help='')
+    parser.add_argument('--metrics_port', action='store', type=int, help='serve prometheus `/metrics` on this port')
+    parser.add_argument('--checkpoint_path', action='store', help='folder for per member checkpoints of large archives - resumed after a restart')
+    parser.add_argument('--checkpoint_min_mb', action='store', type=int, default=256, help='archives this size or larger are checkpointed')
+    parser.add_argument('--postmortem', action='store_true', help='drop into pdb on failure rather than reporting it to the catalog')
+    add_throttle_args(parser)
+    add_profile_args(parser)
+
     parser.add_argument('--log_level', action='store', type=int, help='loglevel of output to stdout', default=logging.INFO)
 
     kwargs = vars(parser.parse_args())
 
     kwargs['rom_path'] = pathlib.Path(kwargs['rom_path'])
     kwargs['sleep'] = datetime.timedelta(seconds=kwargs['sleep'])
+    kwargs['checkpoint_min_bytes'] = kwargs.pop('checkpoint_min_mb') * 1024 * 1024
     return kwargs
 
 
@@ -90,4 +459,17 @@ def postmortem(func, *args, **kwargs):
 if __name__ == '__main__':
     kwargs = get_args()
     logging.basicConfig(level=kwargs['log_level'])
-    postmortem(worker_catalog, **kwargs)
+    if kwargs['profile']:
+        kwargs['profiler'] = Profiler(kwargs['profile_path'], sample_rate=kwargs['profile_sample_rate'], slow_seconds=kwargs['profile_slow_seconds'])
+        init_profile_signal_handler(kwargs['profiler'])
+    p7zip.throttle = create_throttle(**kwargs)
+    if p7zip.throttle:
+        metrics.gauge('worker_throttle_read_bytes_per_second', lambda: p7zip.throttle.rate)
+        metrics.gauge('worker_throttle_paused_seconds_total', lambda: p7zip.throttle.paused_seconds)
+        metrics.gauge('worker_io_pressure', lambda: (p7zip.throttle.adaptive and p7zip.throttle.adaptive.pressure) or 0)
+    if kwargs['metrics_port']:
+        serve_metrics(kwargs['metrics_host'], kwargs['metrics_port'], kwargs.get('profiler'))
+    if kwargs['postmortem']:
+        postmortem(worker_catalog, **kwargs)
+    else:
+        worker_catalog(**kwargs)